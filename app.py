@@ -8,8 +8,24 @@ from datetime import datetime, date, timedelta
 from dotenv import load_dotenv
 import re
 from functools import wraps
-from flask import session
+from flask import session, g, has_app_context
 from user_agents import parse
+import bisect
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+
+# PostgreSQL driver is only needed when DATABASE_URL points at a PostgreSQL server
+try:
+    import psycopg2
+    import psycopg2.extensions
+    from psycopg2.pool import ThreadedConnectionPool
+except ImportError:
+    psycopg2 = None
 # Make sure this import exists at the TOP of your file (around line 12)
 from apscheduler.schedulers.background import BackgroundScheduler
 from urllib.parse import quote
@@ -33,6 +49,47 @@ else:
     IS_AWS = False
     print(f"💻 Local Environment - Database: {DB_FILE}")
 
+# Connection pool / SQLite tuning (override via environment if needed)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))),
+    ('mmap_size', int(os.environ.get('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))),
+    ('cache_size', int(os.environ.get('SQLITE_CACHE_SIZE', -8000))),  # negative = KiB
+]
+
+# Online backup snapshots served by /admin/download-db
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(os.path.dirname(__file__), 'backups'))
+SNAPSHOT_KEEP = int(os.environ.get('SNAPSHOT_KEEP', 12))
+SNAPSHOT_MAX_AGE_MINUTES = int(os.environ.get('SNAPSHOT_MAX_AGE_MINUTES', 60))
+SNAPSHOT_COMPRESS = os.environ.get('SNAPSHOT_COMPRESS', 'true').lower() == 'true'
+SNAPSHOT_PAGES_PER_STEP = 256
+
+# Log retention - visitor/admin login rows older than LOG_RETENTION_DAYS are moved out of the
+# main database: 'archive' copies them into monthly files in ARCHIVE_DIR, 'rollup' keeps only
+# per-day counts in log_daily_rollup
+LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', 90))
+LOG_RETENTION_MODE = os.environ.get('LOG_RETENTION_MODE', 'archive').lower()
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(__file__), 'archives'))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', 2000))
+RETENTION_LOCK_FILE = os.environ.get('RETENTION_LOCK_FILE', DB_FILE + '.retention.lock')
+
+# APK reminder stages in days before expiry (each with its own apk_reminder_<days> template when
+# there is one), always followed by stage 0: the expired notice, sent up to the grace period after
+APK_REMINDER_STAGES = sorted({int(days) for days in os.environ.get('APK_REMINDER_STAGES', '60,30,7').split(',')
+                              if days.strip()} - {0}, reverse=True) + [0]
+APK_EXPIRED_NOTICE_GRACE_DAYS = int(os.environ.get('APK_EXPIRED_NOTICE_GRACE_DAYS', 14))
+
+# Set DATABASE_URL=postgresql://... to share one database between several instances
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+
+if DATABASE_URL.startswith(('postgres://', 'postgresql://')) and psycopg2 is None:
+    print("❌ DATABASE_URL points at PostgreSQL but psycopg2 is not installed")
+    print("Install it with: pip install psycopg2-binary")
+    exit(1)
+
 print(f"🗄️ Database file path: {DB_FILE}")
 print(f"📁 Database file exists: {os.path.exists(DB_FILE)}")
 
@@ -50,6 +107,8 @@ GOOGLE_PLACE_ID = os.environ.get('GOOGLE_PLACE_ID')
 # Admin Configuration (SECURE - no hardcoded fallbacks)  
 ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME')
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD')
+# Partner batch booking API: comma-separated "partner:key" pairs (API disabled when empty)
+PARTNER_API_KEYS = dict(pair.split(':', 1) for pair in os.environ.get('PARTNER_API_KEYS', '').split(',') if ':' in pair)
 
 # Add validation to ensure critical variables exist (CORRECTED)
 required_env_vars = [
@@ -139,6 +198,9 @@ BUSINESS_HOURS = {
     'sunday': 'gesloten',
 }
 
+# Booking grid; also the duration of a booking whose service is unknown
+SLOT_MINUTES = 30
+
 def consolidate_databases():
     """Consolidate data from multiple database files into main one"""
     try:
@@ -166,320 +228,2198 @@ def consolidate_databases():
         print(f"❌ Database consolidation error: {e}")
         return False
 
-def init_db():
-    """Initialize database with tables and default data"""
-    try:
-        print(f"🔧 Initializing database schema...")
-        
-        connection = sqlite3.connect(DB_FILE)
-        cursor = connection.cursor()
-        
-        # Create services table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS services (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE,
-                description TEXT,
-                price REAL DEFAULT 0.0,
-                duration_minutes INTEGER DEFAULT 60,
-                active BOOLEAN DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create bookings table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bookings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                email TEXT NOT NULL,
-                phone TEXT NOT NULL,
-                service TEXT NOT NULL,
-                date TEXT NOT NULL,
-                time TEXT NOT NULL,
-                message TEXT,
-                status TEXT DEFAULT 'confirmed',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create visitor tracking table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS visitor_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ip_address TEXT,
-                user_agent TEXT,
-                page_visited TEXT,
-                referrer TEXT,
-                country TEXT,
-                city TEXT,
-                device_type TEXT,
-                browser TEXT,
-                os TEXT,
-                session_id TEXT,
-                visit_duration INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create admin login tracking table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admin_login_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT,
-                ip_address TEXT,
-                user_agent TEXT,
-                login_successful BOOLEAN,
-                failure_reason TEXT,
-                country TEXT,
-                city TEXT,
-                browser TEXT,
-                os TEXT,
-                session_duration INTEGER,
-                logout_time TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create page analytics table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS page_analytics (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                page_name TEXT NOT NULL,
-                page_url TEXT,
-                visitor_ip TEXT,
-                session_id TEXT,
-                time_spent INTEGER DEFAULT 0,
-                scroll_depth INTEGER DEFAULT 0,
-                clicks_count INTEGER DEFAULT 0,
-                form_interactions INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create APK tables
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS apk_clients (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                email TEXT NOT NULL,
-                phone TEXT,
-                licence_plate TEXT NOT NULL UNIQUE,
-                car_brand TEXT,
-                car_model TEXT,
-                car_year INTEGER,
-                apk_expiry_date DATE,
-                last_reminder_sent DATE,
-                reminder_count INTEGER DEFAULT 0,
-                is_active BOOLEAN DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
+# Schema migrations - numbered, applied once per database and recorded in schema_version
+def migration_001_base_tables(cursor, dialect):
+    """Create the original booking, analytics and APK tables"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS services (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            description TEXT,
+            price REAL DEFAULT 0.0,
+            duration_minutes INTEGER DEFAULT 60,
+            active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            service TEXT NOT NULL,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            message TEXT,
+            status TEXT DEFAULT 'confirmed',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS visitor_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ip_address TEXT,
+            user_agent TEXT,
+            page_visited TEXT,
+            referrer TEXT,
+            country TEXT,
+            city TEXT,
+            device_type TEXT,
+            browser TEXT,
+            os TEXT,
+            session_id TEXT,
+            visit_duration INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admin_login_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT,
+            ip_address TEXT,
+            user_agent TEXT,
+            login_successful BOOLEAN,
+            failure_reason TEXT,
+            country TEXT,
+            city TEXT,
+            browser TEXT,
+            os TEXT,
+            session_duration INTEGER,
+            logout_time TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS page_analytics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            page_name TEXT NOT NULL,
+            page_url TEXT,
+            visitor_ip TEXT,
+            session_id TEXT,
+            time_spent INTEGER DEFAULT 0,
+            scroll_depth INTEGER DEFAULT 0,
+            clicks_count INTEGER DEFAULT 0,
+            form_interactions INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS apk_clients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT NOT NULL,
+            phone TEXT,
+            licence_plate TEXT NOT NULL UNIQUE,
+            car_brand TEXT,
+            car_model TEXT,
+            car_year INTEGER,
+            apk_expiry_date DATE,
+            last_reminder_sent DATE,
+            reminder_count INTEGER DEFAULT 0,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS apk_reminder_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER,
+            client_name TEXT,
+            client_email TEXT,
+            client_licence_plate TEXT,
+            reminder_type TEXT DEFAULT 'automatic',
+            email_subject TEXT,
+            days_until_expiry INTEGER,
+            email_sent BOOLEAN DEFAULT 0,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            error_message TEXT,
+            FOREIGN KEY (client_id) REFERENCES apk_clients (id)
+        )
+    """)
+
+def migration_002_services_duration(cursor, dialect):
+    """Add services.duration_minutes to databases created before it existed"""
+    if dialect == 'postgres':
+        # PostgreSQL databases are always created by migration 001, which has the column
+        return
+
+    cursor.execute("PRAGMA table_info(services)")
+    columns = [row[1] for row in cursor.fetchall()]
+
+    if 'duration_minutes' not in columns:
+        print("🔧 Adding duration_minutes column to services table...")
+        cursor.execute("ALTER TABLE services ADD COLUMN duration_minutes INTEGER DEFAULT 60")
+
+def migration_003_default_services(cursor, dialect):
+    """Seed the default services (and make sure 'Overig' exists)"""
+    default_services = [
+        ("APK Keuring", "Officiële APK keuring voor uw voertuig", 0.0, 45),
+        ("Grote Beurt", "Uitgebreide onderhoudsbeurt", 0.0, 120),
+        ("Kleine Beurt", "Basis onderhoudsbeurt", 0.0, 60),
+        ("Reparatie", "Diagnose en reparatie van defecten", 0.0, 90),
+        ("Banden Service", "Bandenwissel en balanceren", 0.0, 30),
+        ("Airco Service", "Airco onderhoud en reparatie", 0.0, 60),
+        ("Remmen Service", "Remmen controle en onderhoud", 0.0, 90),
+        ("Motor Diagnostiek", "Uitgebreide motor diagnose", 0.0, 60),
+        ("Overig", "Andere diensten en specifieke wensen", 0.0, 60)
+    ]
+
+    cursor.execute("SELECT COUNT(*) FROM services")
+    if cursor.fetchone()[0] == 0:
+        print("📝 Adding default services...")
+        services_to_add = default_services
+    else:
+        services_to_add = [service for service in default_services if service[0] == "Overig"]
+
+    cursor.executemany("""
+        INSERT INTO services (name, description, price, duration_minutes)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT DO NOTHING
+    """, services_to_add)
+
+def migration_004_hot_path_indexes(cursor, dialect):
+    """Secondary indexes for the slot lookups, analytics windows and APK scans"""
+    # Slot lookups only ever look at non-cancelled bookings
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bookings_active_date_time
+        ON bookings (date, time) WHERE status != 'cancelled'
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_created_at ON bookings (created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visitor_logs_created_at ON visitor_logs (created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_login_logs_created_at ON admin_login_logs (created_at)")
+    # Reminder/expiry range scans only ever look at active clients with a known date
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_apk_clients_active_expiry
+        ON apk_clients (apk_expiry_date) WHERE is_active = 1 AND apk_expiry_date IS NOT NULL
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_apk_reminder_log_client ON apk_reminder_log (client_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_apk_reminder_log_sent_at ON apk_reminder_log (sent_at)")
+
+def migration_005_unique_active_slot(cursor, dialect):
+    """One non-cancelled booking per (date, time) - enforced by the database, not by a SELECT"""
+    cursor.execute("""
+        SELECT date, time, COUNT(*) FROM bookings
+        WHERE status != 'cancelled'
+        GROUP BY date, time HAVING COUNT(*) > 1
+    """)
+    # Double bookings left behind by the old check-then-insert: the first booking keeps the
+    # slot, later ones are cancelled and logged so the admin can contact those customers
+    for slot_date, slot_time, count in cursor.fetchall():
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS apk_reminder_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                client_id INTEGER,
-                client_name TEXT,
-                client_email TEXT,
-                client_licence_plate TEXT,
-                reminder_type TEXT DEFAULT 'automatic',
-                email_subject TEXT,
-                days_until_expiry INTEGER,
-                email_sent BOOLEAN DEFAULT 0,
-                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                error_message TEXT,
-                FOREIGN KEY (client_id) REFERENCES apk_clients (id)
-            )
-        """)
-        
-        # Check if services exist, if not add default ones
-        cursor.execute("SELECT COUNT(*) FROM services")
-        service_count = cursor.fetchone()[0]
-        
-        if service_count == 0:
-            print("📝 Adding default services...")
-            default_services = [
-                ("APK Keuring", "Officiële APK keuring voor uw voertuig", 0.0, 45),
-                ("Grote Beurt", "Uitgebreide onderhoudsbeurt", 0.0, 120),
-                ("Kleine Beurt", "Basis onderhoudsbeurt", 0.0, 60),
-                ("Reparatie", "Diagnose en reparatie van defecten", 0.0, 90),
-                ("Banden Service", "Bandenwissel en balanceren", 0.0, 30),
-                ("Airco Service", "Airco onderhoud en reparatie", 0.0, 60),
-                ("Remmen Service", "Remmen controle en onderhoud", 0.0, 90),
-                ("Motor Diagnostiek", "Uitgebreide motor diagnose", 0.0, 60),
-                ("Overig", "Andere diensten en specifieke wensen", 0.0, 60)  # Add this line
-            ]
-            
-            for service in default_services:
-                cursor.execute("""
-                    INSERT INTO services (name, description, price, duration_minutes) 
-                    VALUES (?, ?, ?, ?)
-                """, service)
-            
+            SELECT id FROM bookings
+            WHERE date = ? AND time = ? AND status != 'cancelled'
+            ORDER BY id
+        """, (slot_date, slot_time))
+        extra_ids = [row[0] for row in cursor.fetchall()[1:]]
+        cursor.executemany("UPDATE bookings SET status = 'cancelled' WHERE id = ?", [(booking_id,) for booking_id in extra_ids])
+        print(f"⚠️ Double booking on {slot_date} {slot_time}: cancelled booking(s) {', '.join(map(str, extra_ids))} - contact these customers")
+
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_bookings_active_slot
+        ON bookings (date, time) WHERE status != 'cancelled'
+    """)
+    # The unique index covers the same lookups
+    cursor.execute("DROP INDEX IF EXISTS idx_bookings_active_date_time")
+
+def migration_006_log_rollups(cursor, dialect):
+    """Per-day event counts kept for log rows removed by the retention job"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS log_daily_rollup (
+            table_name TEXT NOT NULL,
+            day TEXT NOT NULL,
+            rollup_key TEXT NOT NULL,
+            events INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (table_name, day, rollup_key)
+        )
+    """)
+
+def migration_007_booking_duration(cursor, dialect):
+    """Store each booking's duration so it blocks every slot it overlaps"""
+    if dialect == 'postgres':
+        cursor.execute("ALTER TABLE bookings ADD COLUMN IF NOT EXISTS duration_minutes INTEGER")
+    else:
+        cursor.execute("PRAGMA table_info(bookings)")
+        if 'duration_minutes' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE bookings ADD COLUMN duration_minutes INTEGER")
+
+    # Existing bookings take the current duration of their service
+    cursor.execute("""
+        UPDATE bookings SET duration_minutes = COALESCE(
+            (SELECT duration_minutes FROM services WHERE services.name = bookings.service), ?)
+        WHERE duration_minutes IS NULL
+    """, (SLOT_MINUTES,))
+
+def migration_008_resources(cursor, dialect):
+    """Work bays/mechanics that bookings are allocated to; one active booking per resource per start time"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS resources (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            kind TEXT DEFAULT 'bay',
+            active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # No rows for a resource means it can do every service
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS resource_services (
+            resource_id INTEGER NOT NULL,
+            service_id INTEGER NOT NULL,
+            PRIMARY KEY (resource_id, service_id),
+            FOREIGN KEY (resource_id) REFERENCES resources (id),
+            FOREIGN KEY (service_id) REFERENCES services (id)
+        )
+    """)
+
+    if dialect == 'postgres':
+        cursor.execute("ALTER TABLE bookings ADD COLUMN IF NOT EXISTS resource_id INTEGER")
+    else:
+        cursor.execute("PRAGMA table_info(bookings)")
+        if 'resource_id' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE bookings ADD COLUMN resource_id INTEGER")
+
+    # Existing bookings all belong to the single bay the garage was modelled with so far
+    cursor.execute("SELECT COUNT(*) FROM resources")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute("INSERT INTO resources (name, kind) VALUES (?, ?)", ("Brug 1", "bay"))
+    cursor.execute("SELECT MIN(id) FROM resources")
+    cursor.execute("UPDATE bookings SET resource_id = ? WHERE resource_id IS NULL", (cursor.fetchone()[0],))
+
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_bookings_active_resource_slot
+        ON bookings (date, time, resource_id) WHERE status != 'cancelled'
+    """)
+    cursor.execute("DROP INDEX IF EXISTS ux_bookings_active_slot")
+
+def migration_009_closures(cursor, dialect):
+    """Closed days and partial closures (holidays, staff days) on top of BUSINESS_HOURS"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS closures (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            start_time TEXT,
+            end_time TEXT,
+            reason TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+def migration_010_email_outbox(cursor, dialect):
+    """Outgoing mail queued in the same transaction as the booking, sent by a background worker"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            to_email TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            html_body TEXT NOT NULL,
+            text_body TEXT,
+            booking_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            last_error TEXT,
+            sent_at TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_email_outbox_due
+        ON email_outbox (status, next_attempt_at)
+    """)
+
+def migration_011_idempotency_keys(cursor, dialect):
+    """Idempotency-Key -> stored /api/book response, so retried submissions are answered, not re-run"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key_hash TEXT PRIMARY KEY,
+            request_hash TEXT NOT NULL,
+            status_code INTEGER NOT NULL,
+            response_body TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires
+        ON idempotency_keys (expires_at)
+    """)
+
+def migration_012_apk_reminder_runs(cursor, dialect):
+    """One row per APK reminder run: how many were selected/sent/failed and how long it took"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS apk_reminder_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TEXT NOT NULL,
+            duration_seconds REAL NOT NULL,
+            selected INTEGER NOT NULL,
+            sent INTEGER NOT NULL,
+            failed INTEGER NOT NULL,
+            workers INTEGER NOT NULL,
+            per_second REAL NOT NULL
+        )
+    """)
+
+def rdw_date(value):
+    """RDW dates ('20270115', or '2027-01-15T00:00:00.000' in the *_dt fields) as YYYY-MM-DD"""
+    value = str(value or '')
+    if len(value) == 8 and value.isdigit():
+        return f"{value[:4]}-{value[4:6]}-{value[6:]}"
+    return value[:10] or None
+
+def apk_reminder_schedule(apk_expiry_date, after_stage=None):
+    """(due date, stage) of the first reminder stage after `after_stage` (None: the first stage), or (None, None)"""
+    expiry = datetime.strptime(str(apk_expiry_date)[:10], '%Y-%m-%d').date()
+    for stage in APK_REMINDER_STAGES:
+        if after_stage is None or stage < after_stage:
+            return (expiry - timedelta(days=stage)).isoformat(), stage
+    return None, None
+
+def migration_013_apk_reminder_queue(cursor, dialect):
+    """Precomputed next reminder (date + stage) per APK client, so the daily job is an indexed pop"""
+    if dialect == 'postgres':
+        cursor.execute("ALTER TABLE apk_clients ADD COLUMN IF NOT EXISTS next_reminder_due TEXT")
+        cursor.execute("ALTER TABLE apk_clients ADD COLUMN IF NOT EXISTS next_reminder_stage INTEGER")
+    else:
+        cursor.execute("PRAGMA table_info(apk_clients)")
+        columns = [column[1] for column in cursor.fetchall()]
+        if 'next_reminder_due' not in columns:
+            cursor.execute("ALTER TABLE apk_clients ADD COLUMN next_reminder_due TEXT")
+        if 'next_reminder_stage' not in columns:
+            cursor.execute("ALTER TABLE apk_clients ADD COLUMN next_reminder_stage INTEGER")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_apk_clients_next_reminder
+        ON apk_clients (next_reminder_due) WHERE next_reminder_due IS NOT NULL
+    """)
+
+    # Clients created from raw RDW data may hold YYYYMMDD expiry dates; normalise to YYYY-MM-DD first.
+    # Existing clients: a reminder sent in the last month before expiry counts as that stage
+    today = datetime.now().date()
+    cursor.execute("SELECT id, apk_expiry_date, last_reminder_sent FROM apk_clients WHERE apk_expiry_date IS NOT NULL")
+    normalised = []
+    schedule = []
+    for client_id, apk_expiry_date, last_reminder_sent in cursor.fetchall():
+        expiry_text, last_sent_text = rdw_date(apk_expiry_date), rdw_date(last_reminder_sent)
+        try:
+            expiry = datetime.strptime(expiry_text, '%Y-%m-%d').date()
+            last_sent = datetime.strptime(last_sent_text, '%Y-%m-%d').date() if last_sent_text else None
+        except ValueError:
+            print(f"⚠️ APK client {client_id}: unreadable date {apk_expiry_date!r}/{last_reminder_sent!r}, not scheduled")
+            continue
+        if (expiry_text, last_sent_text) != (str(apk_expiry_date), last_reminder_sent and str(last_reminder_sent)):
+            normalised.append((expiry_text, last_sent_text, client_id))
+        after_stage = None
+        if last_sent and 0 <= (expiry - last_sent).days <= 31:
+            after_stage = (expiry - last_sent).days
+        due, stage = apk_reminder_schedule(expiry, after_stage)
+        if (today - expiry).days > APK_EXPIRED_NOTICE_GRACE_DAYS:
+            due, stage = None, None
+        schedule.append((due, stage, client_id))
+    cursor.executemany("UPDATE apk_clients SET apk_expiry_date = ?, last_reminder_sent = ? WHERE id = ?", normalised)
+    cursor.executemany("UPDATE apk_clients SET next_reminder_due = ?, next_reminder_stage = ? WHERE id = ?", schedule)
+
+def migration_014_rdw_vehicle_cache(cursor, dialect):
+    """Full RDW open data answer per kenteken, so repeat lookups never leave the building"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS rdw_vehicle_cache (
+            kenteken TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            fetched_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        )
+    """)
+
+def migration_015_availability_versions(cursor, dialect):
+    """Per-date change counters (plus '*' for settings) shared by every process's availability cache"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS availability_versions (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    """)
+
+SCHEMA_MIGRATIONS = [
+    (1, 'Base tables', migration_001_base_tables),
+    (2, 'services.duration_minutes column', migration_002_services_duration),
+    (3, 'Default services', migration_003_default_services),
+    (4, 'Hot path indexes', migration_004_hot_path_indexes),
+    (5, 'Unique active booking slot', migration_005_unique_active_slot),
+    (6, 'Log retention rollups', migration_006_log_rollups),
+    (7, 'bookings.duration_minutes column', migration_007_booking_duration),
+    (8, 'Resources (bays/mechanics)', migration_008_resources),
+    (9, 'Closures', migration_009_closures),
+    (10, 'Email outbox', migration_010_email_outbox),
+    (11, 'Idempotency keys', migration_011_idempotency_keys),
+    (12, 'APK reminder runs', migration_012_apk_reminder_runs),
+    (13, 'APK reminder queue', migration_013_apk_reminder_queue),
+    (14, 'RDW vehicle cache', migration_014_rdw_vehicle_cache),
+    (15, 'Availability versions', migration_015_availability_versions),
+]
+
+def get_schema_version(connection):
+    """Return the highest applied migration number (0 for a fresh database)"""
+    row = connection.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def run_migrations(connection, dialect='sqlite'):
+    """Apply all pending migrations, each in its own write transaction"""
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    connection.commit()
+
+    applied = 0
+    for version, description, migration in SCHEMA_MIGRATIONS:
+        if version <= get_schema_version(connection):
+            continue
+
+        try:
+            # Parallel workers (or instances) starting up serialize here
+            if dialect == 'postgres':
+                connection.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+            else:
+                connection.execute("BEGIN IMMEDIATE")
+            if version <= get_schema_version(connection):
+                connection.rollback()
+                continue
+
+            print(f"🔧 Applying migration {version:03d}: {description}")
+            cursor = connection.cursor()
+            migration(cursor, dialect)
+            cursor.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                           (version, description))
             connection.commit()
-            print(f"✅ Added {len(default_services)} default services")
-        
-        cursor.close()
-        connection.close()
-        print("✅ Database initialization complete")
+            cursor.close()
+            applied += 1
+
+        except Exception as e:
+            connection.rollback()
+            print(f"❌ Migration {version:03d} ({description}) failed: {e}")
+            import traceback
+            traceback.print_exc()
+            return False
+
+    current = get_schema_version(connection)
+    if applied:
+        print(f"✅ Database schema migrated to version {current} ({applied} applied)")
+    return True
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def ensure_database_initialized():
+    """Create/migrate the database once per process"""
+    global _schema_ready
+    if _schema_ready:
         return True
-        
-    except Exception as e:
-        print(f"❌ Database initialization error: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+
+    with _schema_lock:
+        if _schema_ready:
+            return True
+
+        try:
+            _schema_ready = database.initialize()
+
+        except Exception as e:
+            print(f"❌ Database initialization error: {e}")
+            import traceback
+            traceback.print_exc()
+
+        return _schema_ready
+
+# Hot queries - shared by the routes and check_query_plans() so the plan check tests the real SQL
+BOOKED_SLOTS_SQL = """
+    SELECT time, duration_minutes, resource_id FROM bookings 
+    WHERE date = ? AND status != 'cancelled'
+"""
+
+BOOKED_SLOTS_RANGE_SQL = """
+    SELECT date, time, duration_minutes, resource_id FROM bookings 
+    WHERE date >= ? AND date <= ? AND status != 'cancelled'
+    ORDER BY date
+"""
+
+# The daily reminder pop: an indexed range on the precomputed next_reminder_due (see migration 013)
+APK_REMINDERS_DUE_SQL = """
+    SELECT id, name, email, licence_plate, car_brand, car_model, apk_expiry_date, last_reminder_sent, next_reminder_stage
+    FROM apk_clients 
+    WHERE next_reminder_due <= ?
+    AND is_active = 1
+    ORDER BY next_reminder_due ASC
+"""
+
+APK_EXPIRING_SQL = """
+    SELECT COUNT(*) FROM apk_clients 
+    WHERE is_active = 1 AND apk_expiry_date IS NOT NULL
+    AND apk_expiry_date >= ? 
+    AND apk_expiry_date <= ?
+"""
+
+VISITOR_STATS_SQL = """
+    SELECT 
+        COUNT(DISTINCT session_id) as unique_visitors,
+        COUNT(*) as total_page_views,
+        COUNT(DISTINCT DATE(created_at)) as active_days
+    FROM visitor_logs 
+    WHERE created_at >= ?
+"""
+
+POPULAR_PAGES_SQL = """
+    SELECT page_visited, COUNT(*) as visits
+    FROM visitor_logs 
+    WHERE created_at >= ?
+    GROUP BY page_visited
+    ORDER BY visits DESC
+    LIMIT 10
+"""
+
+HOT_QUERIES = [
+    ('booked_slots', BOOKED_SLOTS_SQL, ('2030-01-07',)),
+    ('booked_slots_range', BOOKED_SLOTS_RANGE_SQL, ('2030-01-01', '2030-01-31')),
+    ('apk_reminders_due', APK_REMINDERS_DUE_SQL, ('2030-01-07',)),
+    ('apk_expiring_soon', APK_EXPIRING_SQL, ('2030-01-07', '2030-02-06')),
+    ('visitor_stats_30d', VISITOR_STATS_SQL, ('2029-12-08 00:00:00',)),
+    ('popular_pages_30d', POPULAR_PAGES_SQL, ('2029-12-08 00:00:00',)),
+    ('recent_visitors', "SELECT ip_address FROM visitor_logs ORDER BY created_at DESC LIMIT 50", ()),
+    ('admin_logins', "SELECT username FROM admin_login_logs ORDER BY created_at DESC LIMIT 100", ()),
+    ('recent_bookings', "SELECT id FROM bookings ORDER BY created_at DESC LIMIT 8", ()),
+    ('apk_reminder_logs', "SELECT id FROM apk_reminder_log ORDER BY sent_at DESC LIMIT 100", ()),
+]
+
+def check_query_plans(connection, queries=None):
+    """EXPLAIN QUERY PLAN every hot query; returns a list of (name, plan, ok)
+
+    A query fails the check when any step is a plain 'SCAN <table>' (full table scan).
+    Index scans ('SCAN x USING INDEX ...') and temp b-trees for GROUP BY are fine.
+    """
+    results = []
+    for name, sql, params in (queries or HOT_QUERIES):
+        rows = connection.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        plan = [row[3] for row in rows]
+        full_scans = [step for step in plan
+                      if step.startswith('SCAN ') and 'USING' not in step]
+        results.append((name, plan, not full_scans))
+    return results
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that goes back to its pool when closed"""
+    pool = None
+    checked_out = False
+    lease = None  # new object per checkout, so a stale holder can tell it no longer owns the connection
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            sqlite3.Connection.close(self)
+
+    def discard(self):
+        """Really close the underlying sqlite3 connection"""
+        sqlite3.Connection.close(self)
+
+
+class SQLiteConnectionPool:
+    """Small thread-safe pool of pragma-tuned SQLite connections"""
+
+    def __init__(self, db_file, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, pragmas=None):
+        self.db_file = db_file
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Called on creation and after a fork (gunicorn workers must not share handles)
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self.stats = {
+            'opens': 0,
+            'reuses': 0,
+            'discards': 0,
+            'waits': 0,
+            'wait_time_ms': 0.0,
+            'in_use': 0,
+        }
+
+    def _open(self):
+        if self.db_file == DB_FILE:
+            ensure_database_initialized()
+
+        connection = sqlite3.connect(self.db_file, factory=PooledConnection,
+                                     timeout=self.timeout, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        for pragma, value in self.pragmas:
+            connection.execute(f"PRAGMA {pragma} = {value}")
+        connection.pool = self
+        return connection
+
+    def acquire(self):
+        """Take a connection from the pool, opening one if the pool is not full yet"""
+        if os.getpid() != self._pid:
+            with self._lock:
+                if os.getpid() != self._pid:
+                    self._reset()
+
+        connection = None
+        try:
+            connection = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            reused = False
+            with self._lock:
+                can_open = self._created < self.size
+                if can_open:
+                    self._created += 1
+            if can_open:
+                try:
+                    connection = self._open()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                started = time.perf_counter()
+                try:
+                    connection = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No database connection available after {self.timeout}s")
+                reused = True
+                with self._lock:
+                    self.stats['waits'] += 1
+                    self.stats['wait_time_ms'] += (time.perf_counter() - started) * 1000
+
+        with self._lock:
+            self.stats['reuses' if reused else 'opens'] += 1
+            self.stats['in_use'] += 1
+        connection.checked_out = True
+        connection.lease = object()
+        return connection
+
+    def release(self, connection):
+        """Return a connection to the pool (safe to call more than once)"""
+        if not connection.checked_out:
+            return
+        connection.checked_out = False
+        with self._lock:
+            self.stats['in_use'] -= 1
+
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+            connection.row_factory = sqlite3.Row
+        except sqlite3.Error as e:
+            print(f"⚠️ Discarding broken pooled connection: {e}")
+            connection.discard()
+            with self._lock:
+                self._created -= 1
+                self.stats['discards'] += 1
+            return
+
+        if connection.pool is not self or os.getpid() != self._pid:
+            connection.discard()
+            return
+        self._idle.put(connection)
+
+    def close_all(self):
+        """Close every idle connection (e.g. before replacing the database file)"""
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.discard()
+            with self._lock:
+                self._created -= 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['open_connections'] = self._created
+            stats['idle_connections'] = self._idle.qsize()
+            stats['pool_size'] = self.size
+        stats['wait_time_ms'] = round(stats['wait_time_ms'], 3)
+        return stats
+
+
+db_pool = SQLiteConnectionPool(DB_FILE)
 
 def get_db_connection():
-    """Get database connection with proper path handling"""
+    """Get a pooled database connection (close() hands it back to the pool)"""
     try:
-        # Ensure we're using the correct database
-        if not os.path.exists(DB_FILE):
-            print(f"⚠️ Database not found: {DB_FILE}")
-            
-            # Try to consolidate from other database files
-            consolidate_databases()
-            
-            # If still doesn't exist, create it
-            if not os.path.exists(DB_FILE):
-                print(f"📝 Creating new database: {DB_FILE}")
-                init_db()
-        
-        connection = sqlite3.connect(DB_FILE)
-        connection.row_factory = sqlite3.Row
+        connection = db_pool.acquire()
+
+        # Anything a route forgets to close is returned at app context teardown; the lease
+        # tells teardown whether the connection was closed and handed to someone else since
+        if has_app_context():
+            g.setdefault('db_connections', []).append((connection, connection.lease))
+
         return connection
-        
+
     except Exception as e:
         print(f"❌ Database connection error: {e}")
         return None
 
-def test_database_connection():
-    """Test database connection and functionality"""
-    try:
-        print(f"🔍 Testing database connection to: {DB_FILE}")
-        
-        connection = get_db_connection()
-        if connection is None:
-            return False
-        
-        cursor = connection.cursor()
-        
-        # Test query
-        cursor.execute("SELECT COUNT(*) FROM services")
-        service_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM bookings")
-        booking_count = cursor.fetchone()[0]
-        
-        print(f"✅ Database test successful!")
-        print(f"📊 Services: {service_count}, Bookings: {booking_count}")
-        
-        cursor.close()
-        connection.close()
-        return True
-        
-    except Exception as e:
-        print(f"❌ Database test failed: {e}")
-        return False
+@app.teardown_appcontext
+def release_db_connections(exception=None):
+    """Return every connection this request took and did not close to the pool"""
+    for connection, lease in g.pop('db_connections', []):
+        if connection.checked_out and connection.lease is lease:
+            db_pool.release(connection)
 
-def generate_time_slots(selected_date=None):
-    """Generate 30-minute time slots based on business hours for the selected day"""
-    try:
-        time_slots = []
-        
-        # If no date provided, use today
-        if selected_date:
-            try:
-                booking_date = datetime.strptime(selected_date, '%Y-%m-%d').date()
-            except:
-                booking_date = datetime.now().date()
-        else:
-            booking_date = datetime.now().date()
-        
-        # Get day name (0=Monday, 6=Sunday)
-        day_name = booking_date.strftime('%A').lower()
-        day_number = booking_date.weekday()
-        
-        print(f"📅 Generating time slots for {day_name} ({booking_date})")
-        
-        # Check business hours for this day
-        if day_name not in BUSINESS_HOURS:
-            print(f"❌ Day {day_name} not in business hours")
-            return []
-        
-        day_hours = BUSINESS_HOURS[day_name]
-        
-        # If day is closed (value is 'gesloten'), return empty list - FIXED: removed 'gestolen'
-        if day_hours == 'gesloten':
-            print(f"⛔ {day_name.capitalize()} is gesloten (closed)")
-            return []
-        
-        # Parse opening hours
+# Storage backends - SQLite (single instance) or PostgreSQL (DATABASE_URL, multi-instance)
+class SQLiteDatabase:
+    """Storage backend on top of the pooled SQLite file"""
+    dialect = 'sqlite'
+    integrity_error = sqlite3.IntegrityError
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def initialize(self):
+        """Consolidate old database files and apply migrations"""
+        if self.pool.db_file == DB_FILE and not os.path.exists(DB_FILE):
+            print(f"⚠️ Database not found: {DB_FILE}")
+            consolidate_databases()
+
+        connection = sqlite3.connect(self.pool.db_file, timeout=self.pool.timeout)
         try:
-            start_time_str = day_hours['start']  # e.g., "08:00"
-            end_time_str = day_hours['end']      # e.g., "17:30"
-            
-            start_hour = int(start_time_str.split(':')[0])
-            start_minute = int(start_time_str.split(':')[1])
-            
-            end_hour = int(end_time_str.split(':')[0])
-            end_minute = int(end_time_str.split(':')[1])
-            
-            print(f"🕐 Business hours: {start_time_str} - {end_time_str}")
-            
-        except Exception as parse_error:
-            print(f"❌ Error parsing business hours: {parse_error}")
-            return []
-        
-        # Generate time slots in 30-minute intervals
-        current_hour = start_hour
-        current_minute = start_minute
-        
-        while True:
-            # Create time string
-            time_str = f"{current_hour:02d}:{current_minute:02d}"
-            
-            # Check if this time is before closing time
-            current_total_minutes = current_hour * 60 + current_minute
-            end_total_minutes = end_hour * 60 + end_minute
-            
-            if current_total_minutes >= end_total_minutes:
-                break
-            
-            time_slots.append(time_str)
-            
-            # Add 30 minutes
-            current_minute += 30
-            if current_minute >= 60:
-                current_minute = 0
-                current_hour += 1
-        
-        print(f"✅ Generated {len(time_slots)} time slots: {time_slots[:3]}...{time_slots[-3:] if len(time_slots) > 3 else ''}")
-        return time_slots
-        
-    except Exception as e:
-        print(f"❌ Error generating time slots: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
-def test_godaddy_smtp_variants():
-    """Test different GoDaddy SMTP configurations"""
-    configs = [
-        {'server': 'smtpout.secureserver.net', 'port': 587, 'tls': True},
-        {'server': 'smtpout.secureserver.net', 'port': 465, 'tls': False, 'ssl': True},
-        {'server': 'smtp.secureserver.net', 'port': 587, 'tls': True},
-        {'server': 'smtp.secureserver.net', 'port': 465, 'tls': False, 'ssl': True},
-    ]
-    
-    for i, config in enumerate(configs, 1):
+            return run_migrations(connection, self.dialect)
+        finally:
+            connection.close()
+
+    def connect(self):
+        return self.pool.acquire()
+
+    @contextmanager
+    def connection(self):
+        connection = self.connect()
         try:
-            print(f"\n🔍 Testing config {i}: {config['server']}:{config['port']}")
-            
-            if config.get('ssl'):
-                server = smtplib.SMTP_SSL(config['server'], config['port'])
-            else:
+            yield connection
+        finally:
+            connection.close()
+
+    def begin_write(self, connection, *lock_keys):
+        """Start a write transaction; SQLite has one writer, so the lock keys are not needed"""
+        connection.execute("BEGIN IMMEDIATE")
+
+    def insert(self, connection, sql, params):
+        """Run an INSERT and return the new row id"""
+        return connection.execute(sql, params).lastrowid
+
+    def get_stats(self):
+        stats = self.pool.get_stats()
+        stats['backend'] = self.dialect
+        return stats
+
+
+@lru_cache(maxsize=512)
+def to_postgres_sql(sql):
+    """Translate the SQLite flavoured SQL used in this file to PostgreSQL
+
+    '?' placeholders become '%s' (outside string literals) and CREATE TABLE column
+    types are mapped: AUTOINCREMENT keys become SERIAL, BOOLEAN flags stay 0/1
+    integers and DATE/TIMESTAMP columns stay ISO text (UTC, like SQLite's
+    CURRENT_TIMESTAMP), so rows look the same on both backends.
+    """
+    parts = sql.replace('%', '%%').split("'")
+    for i in range(0, len(parts), 2):
+        parts[i] = parts[i].replace('?', '%s')
+    sql = "'".join(parts)
+
+    if re.match(r'\s*CREATE TABLE', sql, re.IGNORECASE):
+        sql = re.sub(r'INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY', sql)
+        sql = re.sub(r'\bBOOLEAN\b', 'INTEGER', sql)
+        sql = re.sub(r'(\w+) DATE\b', r'\1 TEXT', sql)
+        sql = re.sub(r'TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
+                     "TEXT DEFAULT (to_char(now() AT TIME ZONE 'utc', 'YYYY-MM-DD HH24:MI:SS'))", sql)
+        sql = re.sub(r'\bTIMESTAMP\b', 'TEXT', sql)
+    return sql
+
+
+class PostgresCursor:
+    """psycopg2 cursor that accepts the SQLite placeholder style"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.lastrowid = None
+
+    def execute(self, sql, params=()):
+        self.raw.execute(to_postgres_sql(sql), tuple(params))
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self.raw.executemany(to_postgres_sql(sql), [tuple(params) for params in seq_of_params])
+        return self
+
+    @property
+    def rowcount(self):
+        return self.raw.rowcount
+
+    @property
+    def description(self):
+        return self.raw.description
+
+    def fetchone(self):
+        return self.raw.fetchone()
+
+    def fetchall(self):
+        return self.raw.fetchall()
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def close(self):
+        self.raw.close()
+
+
+class PostgresConnection:
+    """Pooled psycopg2 connection with the subset of the sqlite3 API this app uses"""
+
+    def __init__(self, database, raw):
+        self.database = database
+        self.raw = raw
+
+    def cursor(self):
+        return PostgresCursor(self.raw.cursor())
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    @property
+    def in_transaction(self):
+        return self.raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        if self.raw is not None:
+            self.database.release(self.raw)
+            self.raw = None
+
+
+class PostgresDatabase:
+    """Storage backend on a pooled PostgreSQL server, shared by every app instance"""
+    dialect = 'postgres'
+
+    def __init__(self, dsn, size=DB_POOL_SIZE):
+        if psycopg2 is None:
+            raise RuntimeError("DATABASE_URL points at PostgreSQL but psycopg2 is not installed")
+        self.dsn = dsn
+        self.size = size
+        self.integrity_error = psycopg2.IntegrityError
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self.stats = {'acquired': 0, 'broken': 0, 'in_use': 0}
+
+    def _get_pool(self):
+        # Created lazily (and again after a fork) so gunicorn workers never share sockets
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = ThreadedConnectionPool(1, self.size, self.dsn)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def initialize(self):
+        connection = self.connect()
+        try:
+            return run_migrations(connection, self.dialect)
+        finally:
+            connection.close()
+
+    def connect(self):
+        raw = self._get_pool().getconn()
+        with self._lock:
+            self.stats['acquired'] += 1
+            self.stats['in_use'] += 1
+        return PostgresConnection(self, raw)
+
+    def release(self, raw):
+        broken = False
+        try:
+            if raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                raw.rollback()
+        except psycopg2.Error:
+            broken = True
+
+        with self._lock:
+            self.stats['in_use'] -= 1
+            self.stats['broken'] += broken
+        self._get_pool().putconn(raw, close=broken or raw.closed)
+
+    @contextmanager
+    def connection(self):
+        connection = self.connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def begin_write(self, connection, *lock_keys):
+        """Serialize writers that share a lock key across all instances (held until commit)"""
+        # Always in sorted order, so two multi-key writers cannot deadlock
+        for lock_key in sorted(lock_keys) or ['global']:
+            connection.execute("SELECT pg_advisory_xact_lock(hashtext(?))", (lock_key,))
+
+    def insert(self, connection, sql, params):
+        return connection.execute(sql + " RETURNING id", params).fetchone()[0]
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['backend'] = self.dialect
+        stats['pool_size'] = self.size
+        return stats
+
+
+def create_database():
+    """Pick the storage backend from DATABASE_URL (SQLite file when unset)"""
+    if DATABASE_URL.startswith(('postgres://', 'postgresql://')):
+        print("🐘 Using PostgreSQL storage backend")
+        return PostgresDatabase(DATABASE_URL)
+    return SQLiteDatabase(db_pool)
+
+
+# Repositories - all table access from the routes goes through these
+AVAILABILITY_BUMP_SQL = """
+    INSERT INTO availability_versions (scope, version) VALUES (?, 1)
+    ON CONFLICT (scope) DO UPDATE SET version = availability_versions.version + 1
+"""
+
+def bump_availability_versions(connection, scopes):
+    """Mark dates (or '*': everything) changed, on the caller's transaction, for every process's cache"""
+    connection.executemany(AVAILABILITY_BUMP_SQL, [(scope,) for scope in sorted(set(scopes))])
+
+class BookingRepository:
+    def __init__(self, db):
+        self.db = db
+        # Called with {"type", "date", "time", "duration_minutes"} after every committed booking change
+        self.listeners = []
+
+    def notify(self, event_type, date, time, duration_minutes):
+        event = {"type": event_type, "date": date, "time": time, "duration_minutes": duration_minutes}
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"❌ Booking listener error: {e}")
+
+    def booked_slots(self, date):
+        """(start 'HH:MM', duration in minutes, resource id) of every active booking on a date"""
+        with self.db.connection() as connection:
+            return [(row[0], row[1] or SLOT_MINUTES, row[2])
+                    for row in connection.execute(BOOKED_SLOTS_SQL, (date,)).fetchall()]
+
+    def booked_slots_between(self, first_date, last_date):
+        """{date: [(start 'HH:MM', duration, resource id), ...]} for every active booking in the range, one query"""
+        slots_by_date = {}
+        with self.db.connection() as connection:
+            for row in connection.execute(BOOKED_SLOTS_RANGE_SQL, (first_date, last_date)).fetchall():
+                slots_by_date.setdefault(row[0], []).append((row[1], row[2] or SLOT_MINUTES, row[3]))
+        return slots_by_date
+
+    def reserve(self, name, email, phone, service, date, time, message,
+                duration_minutes=SLOT_MINUTES, resource_ids=None, on_insert=None):
+        """Allocate [time, time + duration) on the first free resource and insert the booking
+
+        Returns the booking id, or None when every candidate resource (default: all
+        active resources) overlaps. on_insert(connection, booking_id) runs inside the
+        same transaction (e.g. to queue the confirmation emails). begin_write() takes
+        the write lock up front (BEGIN IMMEDIATE on SQLite, a per-date advisory lock on PostgreSQL) so the
+        overlap check and the INSERT see the same state; the unique partial index
+        ux_bookings_active_resource_slot rejects anything that still races past the
+        check. The check is one pass over the day's bookings.
+        """
+        start = minutes_of_day(time)
+        end = start + duration_minutes
+
+        with self.db.connection() as connection:
+            try:
+                self.db.begin_write(connection, f"slot:{date}")
+
+                if resource_ids is None:
+                    resource_ids = [row[0] for row in connection.execute(
+                        "SELECT id FROM resources WHERE active = 1 ORDER BY id").fetchall()]
+
+                busy = set()
+                for booked_time, booked_duration, resource_id in connection.execute(BOOKED_SLOTS_SQL, (date,)).fetchall():
+                    booked_start = minutes_of_day(booked_time)
+                    if booked_start < end and start < booked_start + (booked_duration or SLOT_MINUTES):
+                        busy.add(resource_id)
+
+                resource_id = next((rid for rid in resource_ids if rid not in busy), None)
+                if resource_id is None:
+                    connection.rollback()
+                    return None
+
+                booking_id = self.db.insert(connection, """
+                    INSERT INTO bookings (name, email, phone, service, date, time, message, status, duration_minutes, resource_id) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 'confirmed', ?, ?)
+                """, (name, email, phone, service, date, time, message, duration_minutes, resource_id))
+                bump_availability_versions(connection, [date])
+                if on_insert is not None:
+                    on_insert(connection, booking_id)
+                connection.commit()
+                self.notify('slot-taken', date, time, duration_minutes)
+                return booking_id
+
+            except self.db.integrity_error:
+                connection.rollback()
+                return None
+
+    def reserve_many(self, requests, all_or_nothing=False, on_insert=None):
+        """Allocate and insert many bookings in one write transaction
+
+        requests: dicts with name, email, phone, service, date, time, message,
+        duration_minutes and resource_ids (None = all active resources). Existing
+        bookings of the affected dates are loaded with one range query and kept as
+        per-(date, resource) slot bitmasks, so each request is checked against the
+        database and the earlier requests in memory; the accepted ones go in with
+        one executemany. Returns (booking ids, conflicts): one id per request (None
+        when not inserted) and the indexes of the requests that had no free resource.
+        With all_or_nothing a single conflict rolls everything back (all ids None).
+        on_insert(connection, [(request, booking_id), ...]) runs before the commit.
+        """
+        if not requests:
+            return [], []
+        dates = sorted({booking['date'] for booking in requests})
+
+        with self.db.connection() as connection:
+            try:
+                self.db.begin_write(connection, *(f"slot:{day}" for day in dates))
+
+                active_resources = [row[0] for row in connection.execute(
+                    "SELECT id FROM resources WHERE active = 1 ORDER BY id").fetchall()]
+
+                templates = {day: get_slot_template(datetime.strptime(day, '%Y-%m-%d').weekday()) for day in dates}
+                occupied = {}
+                for day, booked_time, booked_duration, resource_id in connection.execute(
+                        BOOKED_SLOTS_RANGE_SQL, (dates[0], dates[-1])).fetchall():
+                    if day in templates:
+                        start = minutes_of_day(booked_time)
+                        occupied[(day, resource_id)] = occupied.get((day, resource_id), 0) | \
+                            templates[day].range_bits(start, start + (booked_duration or SLOT_MINUTES))
+
+                allocated = []
+                for booking in requests:
+                    start = minutes_of_day(booking['time'])
+                    needed = templates[booking['date']].range_bits(start, start + booking['duration_minutes'])
+                    resource_id = next((rid for rid in (booking.get('resource_ids') or active_resources)
+                                        if not occupied.get((booking['date'], rid), 0) & needed), None)
+                    if resource_id is not None:
+                        occupied[(booking['date'], resource_id)] = occupied.get((booking['date'], resource_id), 0) | needed
+                    allocated.append(resource_id)
+
+                conflicts = [index for index, resource_id in enumerate(allocated) if resource_id is None]
+                if all_or_nothing and conflicts:
+                    connection.rollback()
+                    return [None] * len(requests), conflicts
+
+                accepted = [(booking, resource_id) for booking, resource_id in zip(requests, allocated) if resource_id is not None]
+                connection.executemany("""
+                    INSERT INTO bookings (name, email, phone, service, date, time, message, status, duration_minutes, resource_id) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 'confirmed', ?, ?)
+                """, [(booking['name'], booking['email'], booking['phone'], booking['service'], booking['date'],
+                       booking['time'], booking['message'], booking['duration_minutes'], resource_id)
+                      for booking, resource_id in accepted])
+
+                # executemany gives no ids back; (date, time, resource) is unique among active bookings
+                ids = {(row[1], row[2], row[3]): row[0] for row in connection.execute("""
+                    SELECT id, date, time, resource_id FROM bookings 
+                    WHERE date >= ? AND date <= ? AND status != 'cancelled'
+                """, (dates[0], dates[-1])).fetchall()}
+                booking_ids = [ids[(booking['date'], booking['time'], resource_id)] if resource_id is not None else None
+                               for booking, resource_id in zip(requests, allocated)]
+
+                bump_availability_versions(connection, [booking['date'] for booking, resource_id in accepted])
+                if on_insert is not None:
+                    on_insert(connection, [(booking, booking_id) for booking, booking_id in zip(requests, booking_ids)
+                                           if booking_id is not None])
+                connection.commit()
+
+            except self.db.integrity_error:
+                connection.rollback()
+                return [None] * len(requests), list(range(len(requests)))
+
+        for booking, booking_id in zip(requests, booking_ids):
+            if booking_id is not None:
+                self.notify('slot-taken', booking['date'], booking['time'], booking['duration_minutes'])
+        return booking_ids, conflicts
+
+    def cancel(self, booking_id):
+        """Mark a booking cancelled, freeing its slot; returns False when it was not active"""
+        with self.db.connection() as connection:
+            booking = connection.execute("""
+                SELECT date, time, duration_minutes FROM bookings 
+                WHERE id = ? AND status != 'cancelled'
+            """, (booking_id,)).fetchone()
+            if booking is None:
+                return False
+
+            self.db.begin_write(connection, f"slot:{booking[0]}")
+            cursor = connection.execute(
+                "UPDATE bookings SET status = 'cancelled' WHERE id = ? AND status != 'cancelled'", (booking_id,))
+            bump_availability_versions(connection, [booking[0]])
+            connection.commit()
+            if not cursor.rowcount:
+                return False
+            self.notify('slot-freed', booking[0], booking[1], booking[2] or SLOT_MINUTES)
+            return True
+
+    def get(self, booking_id):
+        with self.db.connection() as connection:
+            return connection.execute("""
+                SELECT id, name, email, phone, service, date, time, message 
+                FROM bookings 
+                WHERE id = ?
+            """, (booking_id,)).fetchone()
+
+    def list_all(self):
+        with self.db.connection() as connection:
+            return connection.execute("""
+                SELECT id, name, email, phone, service, date, time, message, status, created_at 
+                FROM bookings 
+                ORDER BY date DESC, time DESC
+            """).fetchall()
+
+    def list_for_export(self):
+        with self.db.connection() as connection:
+            return connection.execute("""
+                SELECT id, name, email, phone, service, date, time, message, status, created_at 
+                FROM bookings 
+                ORDER BY created_at DESC
+            """).fetchall()
+
+    def recent(self, limit=8):
+        with self.db.connection() as connection:
+            return connection.execute("""
+                SELECT id, name, email, phone, service, date, time, status, created_at 
+                FROM bookings 
+                ORDER BY created_at DESC 
+                LIMIT ?
+            """, (limit,)).fetchall()
+
+    def dashboard_counts(self, today):
+        with self.db.connection() as connection:
+            total = connection.execute("SELECT COUNT(*) FROM bookings").fetchone()[0]
+            recent = connection.execute("""
+                SELECT COUNT(*) FROM bookings 
+                WHERE date >= ?
+            """, ((today - timedelta(days=7)).isoformat(),)).fetchone()[0]
+            upcoming = connection.execute("""
+                SELECT COUNT(*) FROM bookings 
+                WHERE date >= ? AND status = 'confirmed'
+            """, (today.isoformat(),)).fetchone()[0]
+        return total, recent, upcoming
+
+
+class ServiceRepository:
+    def __init__(self, db):
+        self.db = db
+
+    def list_active(self):
+        with self.db.connection() as connection:
+            return connection.execute(
+                "SELECT id, name, description, duration_minutes FROM services WHERE active = 1"
+            ).fetchall()
+
+    def list_all(self):
+        with self.db.connection() as connection:
+            return connection.execute("""
+                SELECT id, name, description, price, duration_minutes, active, created_at
+                FROM services 
+                ORDER BY name ASC
+            """).fetchall()
+
+    def find(self, service_id=None, name=None):
+        """(id, duration in minutes) of an active service looked up by id or name (None if unknown)"""
+        with self.db.connection() as connection:
+            if service_id is not None:
+                row = connection.execute(
+                    "SELECT id, duration_minutes FROM services WHERE id = ? AND active = 1", (service_id,)
+                ).fetchone()
+            else:
+                row = connection.execute(
+                    "SELECT id, duration_minutes FROM services WHERE name = ? AND active = 1", (name,)
+                ).fetchone()
+        if row is None:
+            return None
+        return row[0], int(row[1]) if row[1] else SLOT_MINUTES
+
+    def toggle_active(self, service_id):
+        with self.db.connection() as connection:
+            connection.execute("UPDATE services SET active = 1 - active WHERE id = ?", (service_id,))
+            connection.commit()
+
+    def add_if_missing(self, name, description, price=0.0, duration_minutes=60):
+        """Insert a service unless one with this name exists; returns True if it was added"""
+        with self.db.connection() as connection:
+            cursor = connection.execute("""
+                INSERT INTO services (name, description, price, duration_minutes, active) 
+                VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT DO NOTHING
+            """, (name, description, price, duration_minutes))
+            connection.commit()
+            return cursor.rowcount > 0
+
+
+class ResourceRepository:
+    """Work bays / mechanics that bookings are allocated to"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def for_service(self, service_id=None):
+        """Ids of the active resources that can do a service (all active resources if None), in allocation order"""
+        allowed = {}
+        with self.db.connection() as connection:
+            for resource_id, restricted_to in connection.execute("""
+                SELECT r.id, rs.service_id
+                FROM resources r
+                LEFT JOIN resource_services rs ON rs.resource_id = r.id
+                WHERE r.active = 1
+                ORDER BY r.id
+            """).fetchall():
+                allowed.setdefault(resource_id, set())
+                if restricted_to is not None:
+                    allowed[resource_id].add(restricted_to)
+
+        # Specialised resources first, so general bays stay free for everything else
+        return sorted((resource_id for resource_id, service_ids in allowed.items()
+                       if service_id is None or not service_ids or service_id in service_ids),
+                      key=lambda resource_id: (not allowed[resource_id], resource_id))
+
+    def list_all(self):
+        """(id, name, kind, active, created_at, [service names]) for the admin page"""
+        with self.db.connection() as connection:
+            resources = connection.execute("""
+                SELECT id, name, kind, active, created_at FROM resources ORDER BY id
+            """).fetchall()
+            services = {}
+            for resource_id, service_name in connection.execute("""
+                SELECT rs.resource_id, s.name
+                FROM resource_services rs
+                JOIN services s ON s.id = rs.service_id
+                ORDER BY s.name
+            """).fetchall():
+                services.setdefault(resource_id, []).append(service_name)
+
+        return [tuple(resource) + (services.get(resource[0], []),) for resource in resources]
+
+    def create(self, name, kind, service_ids=()):
+        with self.db.connection() as connection:
+            resource_id = self.db.insert(connection, "INSERT INTO resources (name, kind) VALUES (?, ?)", (name, kind))
+            connection.executemany(
+                "INSERT INTO resource_services (resource_id, service_id) VALUES (?, ?)",
+                [(resource_id, service_id) for service_id in service_ids]
+            )
+            connection.commit()
+            return resource_id
+
+    def toggle_active(self, resource_id):
+        with self.db.connection() as connection:
+            connection.execute("UPDATE resources SET active = 1 - active WHERE id = ?", (resource_id,))
+            connection.commit()
+
+
+class ClosureRepository:
+    """Closed days / partial closures; start_time and end_time are NULL for a whole day"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def list_all(self):
+        with self.db.connection() as connection:
+            return connection.execute("""
+                SELECT id, start_date, end_date, start_time, end_time, reason
+                FROM closures 
+                ORDER BY start_date, start_time
+            """).fetchall()
+
+    def create(self, start_date, end_date, start_time=None, end_time=None, reason=None):
+        with self.db.connection() as connection:
+            closure_id = self.db.insert(connection, """
+                INSERT INTO closures (start_date, end_date, start_time, end_time, reason)
+                VALUES (?, ?, ?, ?, ?)
+            """, (start_date, end_date, start_time, end_time, reason))
+            connection.commit()
+            return closure_id
+
+    def delete(self, closure_id):
+        with self.db.connection() as connection:
+            connection.execute("DELETE FROM closures WHERE id = ?", (closure_id,))
+            connection.commit()
+
+
+class ApkClientRepository:
+    def __init__(self, db):
+        self.db = db
+
+    def list_all(self):
+        with self.db.connection() as connection:
+            return connection.execute("""
+                SELECT id, name, email, phone, licence_plate, car_brand, car_model, 
+                       apk_expiry_date, last_reminder_sent, reminder_count, is_active, created_at
+                FROM apk_clients 
+                ORDER BY apk_expiry_date ASC, created_at DESC
+            """).fetchall()
+
+    def plate_exists(self, licence_plate):
+        with self.db.connection() as connection:
+            return connection.execute(
+                "SELECT id FROM apk_clients WHERE licence_plate = ?", (licence_plate,)
+            ).fetchone() is not None
+
+    def create(self, name, email, phone, licence_plate, car_brand, car_model, car_year, apk_expiry_date):
+        next_due, next_stage = apk_reminder_schedule(apk_expiry_date) if apk_expiry_date else (None, None)
+        with self.db.connection() as connection:
+            client_id = self.db.insert(connection, """
+                INSERT INTO apk_clients (name, email, phone, licence_plate, car_brand, car_model, car_year, apk_expiry_date,
+                                         next_reminder_due, next_reminder_stage)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (name, email, phone, licence_plate, car_brand, car_model, car_year, apk_expiry_date, next_due, next_stage))
+            connection.commit()
+            return client_id
+
+    def delete(self, client_id):
+        """Delete a client together with its reminder log"""
+        with self.db.connection() as connection:
+            connection.execute("DELETE FROM apk_reminder_log WHERE client_id = ?", (client_id,))
+            connection.execute("DELETE FROM apk_clients WHERE id = ?", (client_id,))
+            connection.commit()
+
+    def reminders_due(self, today):
+        """Active clients whose next reminder is due today or was missed on an earlier day"""
+        with self.db.connection() as connection:
+            return connection.execute(APK_REMINDERS_DUE_SQL, (today.isoformat(),)).fetchall()
+
+    def record_reminders(self, results, today):
+        """Log reminder attempts in one transaction and move the clients that were sent one to their next stage
+
+        results: (client_id, subject, days_until_expiry, email_sent, error_message, next_due, next_stage);
+        a failed send keeps its due date, so the next run retries it.
+        """
+        if not results:
+            return
+        with self.db.connection() as connection:
+            connection.executemany("""
+                INSERT INTO apk_reminder_log (client_id, reminder_type, email_subject, days_until_expiry, email_sent, error_message)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [(client_id, 'automatic', subject, days_until_expiry, int(email_sent), error_message)
+                  for client_id, subject, days_until_expiry, email_sent, error_message, next_due, next_stage in results])
+            connection.executemany("""
+                UPDATE apk_clients 
+                SET last_reminder_sent = ?, reminder_count = reminder_count + 1,
+                    next_reminder_due = ?, next_reminder_stage = ?
+                WHERE id = ?
+            """, [(today.isoformat(), result[5], result[6], result[0]) for result in results if result[3]])
+            connection.commit()
+
+    def skip_reminders(self, skipped):
+        """Move clients to their next stage without sending: [(next_due, next_stage, client_id), ...]"""
+        if not skipped:
+            return
+        with self.db.connection() as connection:
+            connection.executemany(
+                "UPDATE apk_clients SET next_reminder_due = ?, next_reminder_stage = ? WHERE id = ?", skipped)
+            connection.commit()
+
+    def record_run(self, started_at, duration_seconds, selected, sent, failed, workers):
+        with self.db.connection() as connection:
+            connection.execute("""
+                INSERT INTO apk_reminder_runs (started_at, duration_seconds, selected, sent, failed, workers, per_second)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (started_at, round(duration_seconds, 3), selected, sent, failed, workers,
+                  round(selected / duration_seconds, 2) if duration_seconds else 0.0))
+            connection.commit()
+
+    def recent_runs(self, limit=10):
+        with self.db.connection() as connection:
+            return connection.execute("""
+                SELECT id, started_at, duration_seconds, selected, sent, failed, workers, per_second
+                FROM apk_reminder_runs ORDER BY id DESC LIMIT ?
+            """, (limit,)).fetchall()
+
+    def dashboard_counts(self, today):
+        with self.db.connection() as connection:
+            total = connection.execute("SELECT COUNT(*) FROM apk_clients WHERE is_active = 1").fetchone()[0]
+            expiring_soon = connection.execute(APK_EXPIRING_SQL, (
+                today.isoformat(), (today + timedelta(days=30)).isoformat()
+            )).fetchone()[0]
+            expired = connection.execute("""
+                SELECT COUNT(*) FROM apk_clients 
+                WHERE is_active = 1 AND apk_expiry_date IS NOT NULL
+                AND apk_expiry_date < ?
+            """, (today.isoformat(),)).fetchone()[0]
+        return total, expiring_soon, expired
+
+    def recent_reminders(self, limit=100):
+        with self.db.connection() as connection:
+            return connection.execute("""
+                SELECT l.id, c.name, c.email, c.licence_plate, l.reminder_type, 
+                       l.email_subject, l.days_until_expiry, l.email_sent, l.sent_at, l.error_message
+                FROM apk_reminder_log l
+                JOIN apk_clients c ON l.client_id = c.id
+                ORDER BY l.sent_at DESC
+                LIMIT ?
+            """, (limit,)).fetchall()
+
+
+class AnalyticsRepository:
+    def __init__(self, db):
+        self.db = db
+
+    def record_visit(self, client_info, page_name, session_id):
+        with self.db.connection() as connection:
+            connection.execute("""
+                INSERT INTO visitor_logs 
+                (ip_address, user_agent, page_visited, referrer, country, city, 
+                 device_type, browser, os, session_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                client_info['ip_address'],
+                client_info['user_agent'],
+                page_name,
+                client_info['referrer'],
+                client_info['country'],
+                client_info['city'],
+                client_info['device_type'],
+                client_info['browser'],
+                client_info['os'],
+                session_id
+            ))
+            connection.commit()
+
+    def record_admin_login(self, client_info, username, success, failure_reason=None):
+        with self.db.connection() as connection:
+            connection.execute("""
+                INSERT INTO admin_login_logs 
+                (username, ip_address, user_agent, login_successful, failure_reason,
+                 country, city, browser, os)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                username,
+                client_info['ip_address'],
+                client_info['user_agent'],
+                int(bool(success)),
+                failure_reason,
+                client_info['country'],
+                client_info['city'],
+                client_info['browser'],
+                client_info['os']
+            ))
+            connection.commit()
+
+    def summary(self, days=30):
+        """Visitor and admin login statistics for the analytics page"""
+        # created_at is stored as UTC 'YYYY-MM-DD HH:MM:SS' (CURRENT_TIMESTAMP)
+        since = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+        with self.db.connection() as connection:
+            visitor_stats = connection.execute(VISITOR_STATS_SQL, (since,)).fetchone()
+            popular_pages = connection.execute(POPULAR_PAGES_SQL, (since,)).fetchall()
+            browser_stats = connection.execute("""
+                SELECT browser, COUNT(*) as count
+                FROM visitor_logs 
+                WHERE created_at >= ?
+                AND browser != 'unknown' AND browser IS NOT NULL AND browser != ''
+                GROUP BY browser
+                ORDER BY count DESC
+                LIMIT 10
+            """, (since,)).fetchall()
+            device_stats = connection.execute("""
+                SELECT device_type, COUNT(*) as count
+                FROM visitor_logs 
+                WHERE created_at >= ?
+                AND device_type IS NOT NULL AND device_type != ''
+                GROUP BY device_type
+                ORDER BY count DESC
+            """, (since,)).fetchall()
+            recent_visitors = connection.execute("""
+                SELECT ip_address, page_visited, browser, device_type, created_at
+                FROM visitor_logs 
+                ORDER BY created_at DESC
+                LIMIT 50
+            """).fetchall()
+            admin_logins = connection.execute("""
+                SELECT username, ip_address, login_successful, failure_reason, 
+                       browser, created_at
+                FROM admin_login_logs 
+                ORDER BY created_at DESC
+                LIMIT 100
+            """).fetchall()
+
+        return {
+            'visitor_stats': {
+                'unique_visitors': (visitor_stats[0] if visitor_stats else 0) or 0,
+                'total_page_views': (visitor_stats[1] if visitor_stats else 0) or 0,
+                'active_days': (visitor_stats[2] if visitor_stats else 0) or 0
+            },
+            'popular_pages': popular_pages,
+            'browser_stats': browser_stats,
+            'device_stats': device_stats,
+            'recent_visitors': recent_visitors,
+            'admin_logins': admin_logins,
+            'daily_stats': []
+        }
+
+
+class EmailOutboxRepository:
+    """Queued emails; rows are claimed with a lease so a crashed sender's mail is retried"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def enqueue(self, connection, messages, booking_id=None):
+        """Queue (to, subject, html, text) messages on the caller's connection/transaction"""
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        connection.executemany("""
+            INSERT INTO email_outbox (to_email, subject, html_body, text_body, booking_id, next_attempt_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(to_email, subject, html_body, text_body, booking_id, now)
+              for to_email, subject, html_body, text_body in messages])
+
+    def claim_due(self, limit, lease_seconds):
+        """Pending rows whose next attempt is due, each leased to this sender until it reports back"""
+        now = datetime.utcnow()
+        now_text = now.strftime('%Y-%m-%d %H:%M:%S')
+        lease_until = (now + timedelta(seconds=lease_seconds)).strftime('%Y-%m-%d %H:%M:%S')
+        claimed = []
+        with self.db.connection() as connection:
+            due = connection.execute("""
+                SELECT id, to_email, subject, html_body, text_body, attempts, next_attempt_at
+                FROM email_outbox 
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ?
+            """, (now_text, limit)).fetchall()
+            for row in due:
+                # Only one sender wins the row: the UPDATE matches the attempt time it read
+                cursor = connection.execute("""
+                    UPDATE email_outbox SET attempts = attempts + 1, next_attempt_at = ?
+                    WHERE id = ? AND status = 'pending' AND next_attempt_at = ?
+                """, (lease_until, row[0], row[6]))
+                if cursor.rowcount:
+                    claimed.append(tuple(row[:5]) + (row[5] + 1,))
+            connection.commit()
+        return claimed
+
+    def mark_sent(self, outbox_id):
+        with self.db.connection() as connection:
+            connection.execute("""
+                UPDATE email_outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?
+            """, (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), outbox_id))
+            connection.commit()
+
+    def mark_retry(self, outbox_id, delay_seconds, error, give_up=False):
+        next_attempt = (datetime.utcnow() + timedelta(seconds=delay_seconds)).strftime('%Y-%m-%d %H:%M:%S')
+        with self.db.connection() as connection:
+            connection.execute("""
+                UPDATE email_outbox SET status = ?, next_attempt_at = ?, last_error = ? WHERE id = ?
+            """, ('failed' if give_up else 'pending', next_attempt, error, outbox_id))
+            connection.commit()
+
+    def counts(self):
+        with self.db.connection() as connection:
+            return {row[0]: row[1] for row in connection.execute(
+                "SELECT status, COUNT(*) FROM email_outbox GROUP BY status").fetchall()}
+
+
+class IdempotencyRepository:
+    """Stored responses per idempotency key; keys are kept as hashes and expire after a TTL"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def find(self, key_hash):
+        """(request hash, status code, response body) for a live key, or None"""
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        with self.db.connection() as connection:
+            return connection.execute("""
+                SELECT request_hash, status_code, response_body FROM idempotency_keys 
+                WHERE key_hash = ? AND expires_at > ?
+            """, (key_hash, now)).fetchone()
+
+    def store(self, connection, key_hash, request_hash, status_code, response_body, ttl_seconds):
+        """Save a response on the caller's transaction; expired keys are purged on the way"""
+        now = datetime.utcnow()
+        now_text = now.strftime('%Y-%m-%d %H:%M:%S')
+        connection.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now_text,))
+        connection.execute("""
+            INSERT INTO idempotency_keys (key_hash, request_hash, status_code, response_body, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (key_hash, request_hash, status_code, response_body,
+              (now + timedelta(seconds=ttl_seconds)).strftime('%Y-%m-%d %H:%M:%S')))
+
+
+class RdwCacheRepository:
+    """Cached RDW responses (raw JSON) per kenteken"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def find(self, kenteken):
+        """(payload JSON, expires_at) even when expired, or None"""
+        with self.db.connection() as connection:
+            return connection.execute(
+                "SELECT payload, expires_at FROM rdw_vehicle_cache WHERE kenteken = ?", (kenteken,)
+            ).fetchone()
+
+    def store(self, kenteken, payload, ttl_seconds):
+        now = datetime.utcnow()
+        expires_at = (now + timedelta(seconds=ttl_seconds)).strftime('%Y-%m-%d %H:%M:%S')
+        with self.db.connection() as connection:
+            connection.execute("DELETE FROM rdw_vehicle_cache WHERE kenteken = ?", (kenteken,))
+            connection.execute("""
+                INSERT INTO rdw_vehicle_cache (kenteken, payload, fetched_at, expires_at)
+                VALUES (?, ?, ?, ?)
+            """, (kenteken, payload, now.strftime('%Y-%m-%d %H:%M:%S'), expires_at))
+            connection.commit()
+        return expires_at
+
+    def count(self):
+        with self.db.connection() as connection:
+            return connection.execute("SELECT COUNT(*) FROM rdw_vehicle_cache").fetchone()[0]
+
+
+class AvailabilityVersionRepository:
+    """Reads/bumps of the availability_versions counters"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def current(self, date):
+        """(version of this date, settings version '*'); 0 for scopes never bumped"""
+        with self.db.connection() as connection:
+            versions = dict(connection.execute(
+                "SELECT scope, version FROM availability_versions WHERE scope IN (?, '*')", (date,)).fetchall())
+        return versions.get(date, 0), versions.get('*', 0)
+
+    def bump(self, scopes):
+        with self.db.connection() as connection:
+            bump_availability_versions(connection, scopes)
+            connection.commit()
+
+
+class LogRetentionRepository:
+    """Batch access to the append-only log tables for the retention job"""
+    # table -> SQL expression used as the roll-up key
+    TABLES = {
+        'visitor_logs': "COALESCE(page_visited, 'unknown')",
+        'admin_login_logs': "CASE WHEN login_successful = 1 THEN 'success' ELSE 'failed' END",
+    }
+
+    def __init__(self, db):
+        self.db = db
+
+    def oldest_rows(self, table, before, limit):
+        """Up to `limit` rows created before `before`, oldest first; returns (columns, rows)"""
+        with self.db.connection() as connection:
+            cursor = connection.execute(f"""
+                SELECT * FROM {table}
+                WHERE created_at < ?
+                ORDER BY created_at
+                LIMIT ?
+            """, (before, limit))
+            rows = cursor.fetchall()
+            return [column[0] for column in cursor.description], rows
+
+    def remove(self, table, ids, rollup=False):
+        """Delete rows by id in one short write transaction, optionally counting them per day first"""
+        placeholders = ', '.join('?' * len(ids))
+        with self.db.connection() as connection:
+            self.db.begin_write(connection, f"retention:{table}")
+
+            if rollup:
+                counts = connection.execute(f"""
+                    SELECT SUBSTR(created_at, 1, 10), {self.TABLES[table]}, COUNT(*)
+                    FROM {table}
+                    WHERE id IN ({placeholders})
+                    GROUP BY 1, 2
+                """, ids).fetchall()
+                connection.executemany("""
+                    INSERT INTO log_daily_rollup (table_name, day, rollup_key, events)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (table_name, day, rollup_key)
+                    DO UPDATE SET events = log_daily_rollup.events + excluded.events
+                """, [(table, day, key, events) for day, key, events in counts])
+
+            deleted = connection.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids).rowcount
+            connection.commit()
+            return deleted
+
+    def free_bytes(self):
+        """Bytes in SQLite's free page list (0 for other backends)"""
+        if self.db.dialect != 'sqlite':
+            return 0
+        with self.db.connection() as connection:
+            page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+            return connection.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+
+
+class Storage:
+    """Entry point to the repositories for one backend"""
+
+    def __init__(self, db):
+        self.db = db
+        self.bookings = BookingRepository(db)
+        self.services = ServiceRepository(db)
+        self.resources = ResourceRepository(db)
+        self.closures = ClosureRepository(db)
+        self.apk_clients = ApkClientRepository(db)
+        self.analytics = AnalyticsRepository(db)
+        self.log_retention = LogRetentionRepository(db)
+        self.outbox = EmailOutboxRepository(db)
+        self.idempotency = IdempotencyRepository(db)
+        self.rdw_cache = RdwCacheRepository(db)
+        self.availability_versions = AvailabilityVersionRepository(db)
+
+
+database = create_database()
+storage = Storage(database)
+
+def test_database_connection():
+    """Test database connection and functionality"""
+    try:
+        print(f"🔍 Testing {database.dialect} database connection")
+        
+        with database.connection() as connection:
+            service_count = connection.execute("SELECT COUNT(*) FROM services").fetchone()[0]
+            booking_count = connection.execute("SELECT COUNT(*) FROM bookings").fetchone()[0]
+        
+        print(f"✅ Database test successful!")
+        print(f"📊 Services: {service_count}, Bookings: {booking_count}")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Database test failed: {e}")
+        return False
+
+WEEKDAY_NAMES = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+def minutes_of_day(time_label):
+    """'HH:MM' -> minutes since midnight"""
+    hours, minutes = time_label.split(':')
+    return int(hours) * 60 + int(minutes)
+
+class SlotTemplate(namedtuple('SlotTemplate', 'offsets labels index mask closes')):
+    """Bookable start times of one weekday, compiled once from BUSINESS_HOURS
+
+    offsets: minutes since midnight, labels: the matching 'HH:MM' strings,
+    index: label -> bit number, mask: one bit per slot, closes: closing minute.
+    A set of slots on a day is an int bitmask over this template, so filtering
+    is plain bit arithmetic.
+    """
+    __slots__ = ()
+
+    def range_bits(self, start, end):
+        """Bitmask of the slots overlapping minutes [start, end)"""
+        # Slot [offset, offset + SLOT_MINUTES) overlaps [start, end)
+        first = bisect.bisect_right(self.offsets, start - SLOT_MINUTES)
+        last = bisect.bisect_left(self.offsets, end)
+        return ((1 << (last - first)) - 1) << first if first < last else 0
+
+    def occupied_bits(self, bookings):
+        """Bitmask of the slots overlapped by (start 'HH:MM', duration minutes) bookings"""
+        bits = 0
+        for start_label, duration in bookings:
+            start = minutes_of_day(start_label)
+            bits |= self.range_bits(start, start + duration)
+        return bits
+
+    def start_bits(self, free_bits, duration):
+        """Bitmask of free slots where a job of `duration` minutes fits entirely before closing
+
+        A start is usable when it and the following slots it spans are all free,
+        i.e. the AND of free_bits shifted by 0..n-1.
+        """
+        fits = free_bits
+        for step in range(1, -(-duration // SLOT_MINUTES)):
+            fits &= free_bits >> step
+        # Last start that still ends by closing time
+        latest = bisect.bisect_right(self.offsets, self.closes - duration)
+        return fits & ((1 << latest) - 1)
+
+    def bits_after(self, minute_of_day):
+        """Bitmask of the slots that start strictly after minute_of_day"""
+        passed = bisect.bisect_right(self.offsets, minute_of_day)
+        return self.mask & ~((1 << passed) - 1)
+
+    def labels_for(self, bits):
+        """'HH:MM' labels of the set bits, in time order"""
+        return [label for position, label in enumerate(self.labels) if bits >> position & 1]
+
+def compile_slot_template(day_hours):
+    """Build the slot grid for one BUSINESS_HOURS entry ('gesloten' gives an empty grid)"""
+    if not isinstance(day_hours, dict):
+        return SlotTemplate((), (), {}, 0, 0)
+
+    start_hour, start_minute = map(int, day_hours['start'].split(':'))
+    end_hour, end_minute = map(int, day_hours['end'].split(':'))
+    closes = end_hour * 60 + end_minute
+    offsets = tuple(range(start_hour * 60 + start_minute, closes, SLOT_MINUTES))
+    labels = tuple(f"{offset // 60:02d}:{offset % 60:02d}" for offset in offsets)
+
+    return SlotTemplate(offsets, labels, {label: i for i, label in enumerate(labels)},
+                        (1 << len(offsets)) - 1, closes)
+
+@lru_cache(maxsize=4)
+def _compile_slot_templates(hours_key):
+    templates = tuple(compile_slot_template(BUSINESS_HOURS.get(day_name)) for day_name in WEEKDAY_NAMES)
+    print(f"🕐 Slot templates compiled: {[len(template.offsets) for template in templates]} slots per weekday")
+    return templates
+
+def get_slot_template(weekday):
+    """Slot grid for a weekday (0 = Monday); recompiled only when BUSINESS_HOURS changes"""
+    hours_key = tuple(
+        (day_name, (hours['start'], hours['end']) if isinstance(hours, dict) else hours)
+        for day_name, hours in BUSINESS_HOURS.items()
+    )
+    return _compile_slot_templates(hours_key)[weekday]
+
+def resource_start_bits(template, booking_date, booked_slots, resource_ids, duration=SLOT_MINUTES, now=None):
+    """{resource id: bitmask of start times where that resource is free for `duration` minutes}
+
+    Each resource gets its own occupancy bitmask from the bookings allocated to it;
+    free = grid minus closures minus occupied minus (today) slots that already started,
+    and a start qualifies when every slot the job spans is free before closing.
+    """
+    now = now or datetime.now()
+    upcoming = template.mask & ~closure_index.blocked_bits(template, booking_date)
+    if booking_date == now.date():
+        upcoming &= template.bits_after(now.hour * 60 + now.minute + now.second / 60)
+
+    busy = {}
+    for start_label, booked_duration, resource_id in booked_slots:
+        busy.setdefault(resource_id, []).append((start_label, booked_duration))
+
+    return {
+        resource_id: template.start_bits(upcoming & ~template.occupied_bits(busy.get(resource_id, ())), duration)
+        for resource_id in resource_ids
+    }
+
+def free_start_bits(template, booking_date, booked_slots, resource_ids, duration=SLOT_MINUTES, now=None):
+    """Bitmask of start times where at least one of the resources is free for `duration` minutes"""
+    bits = 0
+    for resource_bits in resource_start_bits(template, booking_date, booked_slots, resource_ids, duration, now).values():
+        bits |= resource_bits
+    return bits
+
+def slot_capacity(template, per_resource_bits):
+    """{'HH:MM': number of resources that can still start a job there} for every bookable start"""
+    capacity = {}
+    for resource_bits in per_resource_bits.values():
+        for label in template.labels_for(resource_bits):
+            capacity[label] = capacity.get(label, 0) + 1
+    return {label: capacity[label] for label in template.labels if label in capacity}
+
+# Availability cache - /api/available-times responses per (date, service), invalidated by bookings
+AVAILABILITY_CACHE_SIZE = int(os.environ.get('AVAILABILITY_CACHE_SIZE', 2048))
+
+class AvailabilityCache:
+    """In-process cache of rendered availability responses
+
+    An entry is only served while the version it was rendered at is current. The
+    versions live in availability_versions and are bumped inside the booking write
+    transactions (per date) and on settings changes ('*'), so a booking made by any
+    process or instance is seen by all of them; checking costs one primary-key read
+    instead of the availability computation. The version also feeds the ETag, so
+    clients revalidate with 304s, whichever worker answers.
+    """
+
+    def __init__(self, versions, max_entries=AVAILABILITY_CACHE_SIZE, enabled=True):
+        self.versions = versions
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Versions outlive restarts; opening hours are code, so they go into the ETag as well
+        self._config = hashlib.sha1(repr((BUSINESS_HOURS, SLOT_MINUTES)).encode()).hexdigest()[:8]
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'invalidations': 0}
+
+    def version(self, date):
+        return self.versions.current(date)
+
+    def etag(self, key, version):
+        """Opaque ETag for one cache key at one version of its date"""
+        raw = f"{self._config}|{version}|{'|'.join(str(part) for part in key)}"
+        return hashlib.sha1(raw.encode()).hexdigest()[:20]
+
+    def is_fresh(self, if_none_match, etag):
+        """True when the client's If-None-Match already has this ETag (answer 304)"""
+        if not self.enabled or not if_none_match.contains_weak(etag):
+            return False
+        with self._lock:
+            self.stats['not_modified'] += 1
+        return True
+
+    def get(self, key, version):
+        """Cached body for key if it was rendered at this version, else None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if self.enabled and entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key, version, body):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_all(self):
+        """Services/resources/closures changed: every date is stale, in every process"""
+        self.versions.bump(['*'])
+        with self._lock:
+            self._entries.clear()
+            self.stats['invalidations'] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, entries=len(self._entries), enabled=self.enabled)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
+
+availability_cache = AvailabilityCache(storage.availability_versions)
+
+# Slot events - booking changes pushed to open booking forms over server-sent events
+# Every open stream holds a worker thread for up to SLOT_EVENTS_STREAM_SECONDS, so by default the streams
+# may take at most a quarter of WORKER_THREADS (threads per process, e.g. gunicorn --threads). Raise
+# SLOT_EVENTS_MAX_CLIENTS only when serving from an async worker (gunicorn -k gevent).
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 8))
+SLOT_EVENTS_QUEUE_SIZE = int(os.environ.get('SLOT_EVENTS_QUEUE_SIZE', 32))
+SLOT_EVENTS_MAX_CLIENTS = int(os.environ.get('SLOT_EVENTS_MAX_CLIENTS', max(1, WORKER_THREADS // 4)))
+SLOT_EVENTS_MAX_DATES = 31
+SLOT_EVENTS_KEEPALIVE_SECONDS = 15
+SLOT_EVENTS_STREAM_SECONDS = 300
+
+class SlotEventBroker:
+    """In-process pub/sub from the booking write path to SSE clients, keyed by date
+
+    Every subscriber has a bounded queue; a client that stops reading loses its
+    oldest events and gets a single 'resync' instead, so memory per client is
+    capped and the client just reloads its times. The broker is per-process (unlike
+    the availability cache versions, which live in the database): with several
+    workers, a booking made on another worker does not reach this worker's streams
+    until the client resyncs and reloads its times.
+    """
+
+    RESYNC = {"type": "resync"}
+
+    def __init__(self, queue_size=SLOT_EVENTS_QUEUE_SIZE, max_clients=SLOT_EVENTS_MAX_CLIENTS):
+        self.queue_size = queue_size
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._watchers = {}
+        self._clients = 0
+        self.stats = {'published': 0, 'delivered': 0, 'dropped': 0, 'rejected': 0}
+
+    def subscribe(self, dates):
+        """Bounded queue receiving the events for these dates, or None when full up"""
+        with self._lock:
+            if self._clients >= self.max_clients:
+                self.stats['rejected'] += 1
+                return None
+            self._clients += 1
+            client_queue = queue.Queue(maxsize=self.queue_size)
+            for watched_date in dates:
+                self._watchers.setdefault(watched_date, set()).add(client_queue)
+        return client_queue
+
+    def unsubscribe(self, client_queue, dates):
+        with self._lock:
+            self._clients -= 1
+            for watched_date in dates:
+                watchers = self._watchers.get(watched_date)
+                if watchers is not None:
+                    watchers.discard(client_queue)
+                    if not watchers:
+                        del self._watchers[watched_date]
+
+    def publish(self, event):
+        with self._lock:
+            watchers = list(self._watchers.get(event['date'], ()))
+            self.stats['published'] += 1
+        delivered = dropped = 0
+        for client_queue in watchers:
+            try:
+                client_queue.put_nowait(event)
+                delivered += 1
+            except queue.Full:
+                # Slow reader: drop what it has queued and tell it to reload instead
+                dropped += 1
+                try:
+                    while True:
+                        client_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    client_queue.put_nowait(self.RESYNC)
+                except queue.Full:
+                    pass
+        with self._lock:
+            self.stats['delivered'] += delivered
+            self.stats['dropped'] += dropped
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, clients=self._clients, watched_dates=len(self._watchers))
+
+slot_events = SlotEventBroker()
+storage.bookings.listeners.append(slot_events.publish)
+
+def availability_response(body, etag, status=200):
+    """JSON response with an ETag; no-cache makes browsers/proxies revalidate every time"""
+    from flask import Response
+    
+    response = Response(body, status=status, mimetype='application/json')
+    if availability_cache.enabled:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Closures - the closures table as a sorted interval index, consulted per day without a query
+CLOSURES_REFRESH_SECONDS = int(os.environ.get('CLOSURES_REFRESH_SECONDS', 300))
+
+class ClosureIndex:
+    """Closures cut into disjoint date segments for O(log n) lookups
+
+    Every closure start and end+1 date becomes a boundary; each segment between two
+    boundaries stores the closed minute ranges that apply to all of its days. A
+    lookup is one bisect over the boundaries. The table is re-read after admin
+    changes (reload()) and every CLOSURES_REFRESH_SECONDS, so other instances pick
+    up changes too.
+    """
+    WHOLE_DAY = (0, 24 * 60)
+
+    def __init__(self, loader, refresh_seconds=CLOSURES_REFRESH_SECONDS):
+        self._loader = loader
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._boundaries = []
+        self._segments = []
+        self._loaded_at = None
+
+    def reload(self, changed=False):
+        """Rebuild the index; changed=True (an admin edit) invalidates cached availability in every process"""
+        closures = []
+        for _, start_date, end_date, start_time, end_time, reason in self._loader():
+            minutes = (minutes_of_day(start_time), minutes_of_day(end_time)) if start_time and end_time else self.WHOLE_DAY
+            closures.append((date.fromisoformat(start_date).toordinal(),
+                             date.fromisoformat(end_date).toordinal() + 1,
+                             minutes + (reason or 'Gesloten',)))
+
+        boundaries = sorted({closure[0] for closure in closures} | {closure[1] for closure in closures})
+        segments = [tuple(ranges for first, after, ranges in closures if first <= segment_start and segment_end <= after)
+                    for segment_start, segment_end in zip(boundaries, boundaries[1:])]
+
+        with self._lock:
+            # The first load only fills this process's index; its cache is still empty
+            changed = changed or (self._loaded_at is not None and (boundaries, segments) != (self._boundaries, self._segments))
+            self._boundaries, self._segments = boundaries, segments
+            self._loaded_at = time.monotonic()
+        if changed:
+            # Cached /api/available-times bodies were computed without these closures
+            availability_cache.invalidate_all()
+        print(f"📅 Closure index loaded: {len(closures)} closures, {len(segments)} segments")
+
+    def closed_ranges(self, day):
+        """((start minute, end minute, reason), ...) closed on this date"""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_seconds:
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"❌ Closure index reload error: {e}")
+                if self._loaded_at is None:
+                    return ()
+
+        with self._lock:
+            position = bisect.bisect_right(self._boundaries, day.toordinal()) - 1
+            if 0 <= position < len(self._segments):
+                return self._segments[position]
+            return ()
+
+    def blocked_bits(self, template, day):
+        """Bitmask of the template's slots that overlap a closure on this date"""
+        bits = 0
+        for start, end, _ in self.closed_ranges(day):
+            bits |= template.range_bits(start, end)
+        return bits
+
+    def overlaps(self, day, start, end):
+        """Reason of the first closure overlapping minutes [start, end) on this date, or None"""
+        for closed_start, closed_end, reason in self.closed_ranges(day):
+            if closed_start < end and start < closed_end:
+                return reason
+        return None
+
+closure_index = ClosureIndex(storage.closures.list_all)
+
+def generate_time_slots(selected_date=None):
+    """Generate 30-minute time slots based on business hours for the selected day"""
+    try:
+        # If no date provided, use today
+        if selected_date:
+            try:
+                booking_date = datetime.strptime(selected_date, '%Y-%m-%d').date()
+            except:
+                booking_date = datetime.now().date()
+        else:
+            booking_date = datetime.now().date()
+        
+        template = get_slot_template(booking_date.weekday())
+        return template.labels_for(template.mask & ~closure_index.blocked_bits(template, booking_date))
+        
+    except Exception as e:
+        print(f"❌ Error generating time slots: {e}")
+        import traceback
+        traceback.print_exc()
+        return []
+def test_godaddy_smtp_variants():
+    """Test different GoDaddy SMTP configurations"""
+    configs = [
+        {'server': 'smtpout.secureserver.net', 'port': 587, 'tls': True},
+        {'server': 'smtpout.secureserver.net', 'port': 465, 'tls': False, 'ssl': True},
+        {'server': 'smtp.secureserver.net', 'port': 587, 'tls': True},
+        {'server': 'smtp.secureserver.net', 'port': 465, 'tls': False, 'ssl': True},
+    ]
+    
+    for i, config in enumerate(configs, 1):
+        try:
+            print(f"\n🔍 Testing config {i}: {config['server']}:{config['port']}")
+            
+            if config.get('ssl'):
+                server = smtplib.SMTP_SSL(config['server'], config['port'])
+            else:
                 server = smtplib.SMTP(config['server'], config['port'])
                 if config.get('tls'):
                     server.starttls()
@@ -496,12 +2436,159 @@ def test_godaddy_smtp_variants():
             print(f"❌ Config {i} failed: {e}")
     
     return None
+# SMTP connection pool - authenticated sessions are reused instead of a TLS handshake + login per mail
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', 2))
+SMTP_IDLE_SECONDS = 240
+SMTP_NOOP_AFTER_SECONDS = 30
+
+class SMTPConnectionPool:
+    """Keeps up to SMTP_POOL_SIZE logged-in SMTP sessions
+
+    A session idle for SMTP_NOOP_AFTER_SECONDS is checked with NOOP before reuse, and
+    one idle longer than SMTP_IDLE_SECONDS is closed (servers drop them anyway). A
+    session that fails while sending is discarded and the message retried once on a
+    fresh one. Sessions are per process; after a fork the inherited ones are dropped.
+    """
+
+    def __init__(self, size=SMTP_POOL_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+        self._latencies = deque(maxlen=500)
+        self.stats = {'handshakes': 0, 'reused': 0, 'noop_failures': 0, 'reconnects': 0, 'sent': 0, 'failed': 0}
+
+    def _connect(self):
+        # Method 1: Regular SMTP with STARTTLS (port 587)
+        if MAIL_PORT == 587:
+            print("🔗 Connecting with STARTTLS...")
+            server = smtplib.SMTP(MAIL_SERVER, MAIL_PORT, timeout=30)
+            server.starttls()
+        
+        # Method 2: SMTP_SSL (port 465)  
+        elif MAIL_PORT == 465:
+            print("🔗 Connecting with SSL...")
+            server = smtplib.SMTP_SSL(MAIL_SERVER, MAIL_PORT, timeout=30)
+        
+        # Method 3: Regular SMTP (port 25)
+        else:
+            print("🔗 Connecting without encryption...")
+            server = smtplib.SMTP(MAIL_SERVER, MAIL_PORT, timeout=30)
+        
+        try:
+            print("👤 Logging in...")
+            server.login(MAIL_USERNAME, MAIL_PASSWORD)
+        except Exception:
+            self._close(server)
+            raise
+        with self._lock:
+            self.stats['handshakes'] += 1
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _checkout(self):
+        """An idle session that still answers NOOP, or a new one"""
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Forked: the sockets belong to the parent
+                    self._idle, self._pid = [], os.getpid()
+                if not self._idle:
+                    break
+                server, last_used = self._idle.pop()
+            idle_for = time.monotonic() - last_used
+            if idle_for > SMTP_IDLE_SECONDS:
+                self._close(server)
+                continue
+            if idle_for > SMTP_NOOP_AFTER_SECONDS:
+                try:
+                    if server.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected('NOOP rejected')
+                except Exception:
+                    with self._lock:
+                        self.stats['noop_failures'] += 1
+                    self._close(server)
+                    continue
+            with self._lock:
+                self.stats['reused'] += 1
+            return server
+        return self._connect()
+
+    def _checkin(self, server):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append((server, time.monotonic()))
+                return
+        self._close(server)
+
+    def send(self, msg):
+        """Send over a pooled session; a broken session is replaced once"""
+        started = time.perf_counter()
+        server = self._checkout()
+        try:
+            server.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError):
+            # Stale session (timed out / reset by the server): one retry on a fresh login
+            self._close(server)
+            with self._lock:
+                self.stats['reconnects'] += 1
+            server = self._connect()
+            try:
+                server.send_message(msg)
+            except Exception:
+                self._close(server)
+                raise
+        except Exception:
+            self._close(server)
+            raise
+        self._checkin(server)
+        with self._lock:
+            self.stats['sent'] += 1
+            self._latencies.append(time.perf_counter() - started)
+
+    def record_failure(self):
+        with self._lock:
+            self.stats['failed'] += 1
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._close(server)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, idle=len(self._idle), pool_size=self.size)
+            latencies = sorted(self._latencies)
+        if latencies:
+            stats['latency_ms'] = {
+                'count': len(latencies),
+                'avg': round(sum(latencies) / len(latencies) * 1000, 1),
+                'p50': round(latencies[len(latencies) // 2] * 1000, 1),
+                'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1),
+                'max': round(latencies[-1] * 1000, 1)
+            }
+        sends = stats['sent'] + stats['failed']
+        stats['messages_per_handshake'] = round(stats['sent'] / stats['handshakes'], 2) if stats['handshakes'] else 0.0
+        stats['success_rate'] = round(stats['sent'] / sends, 3) if sends else 0.0
+        return stats
+
+smtp_pool = SMTPConnectionPool()
+
 def send_email(to_email, subject, html_body, text_body=None):
     """Send email using GoDaddy SMTP with better error handling"""
     try:
         print(f"📧 Sending email to: {to_email}")
         print(f"📧 Subject: {subject}")
-        print(f"📧 Using server: {MAIL_SERVER}:{MAIL_PORT}")
         
         msg = MIMEMultipart('alternative')
         msg['From'] = MAIL_USERNAME
@@ -517,138 +2604,365 @@ def send_email(to_email, subject, html_body, text_body=None):
         html_part = MIMEText(html_body, 'html')
         msg.attach(html_part)
         
-        # Try different connection methods
-        server = None
         try:
-            # Method 1: Regular SMTP with STARTTLS (port 587)
-            if MAIL_PORT == 587:
-                print("🔗 Connecting with STARTTLS...")
-                server = smtplib.SMTP(MAIL_SERVER, MAIL_PORT, timeout=30)
-                server.starttls()
-            
-            # Method 2: SMTP_SSL (port 465)  
-            elif MAIL_PORT == 465:
-                print("🔗 Connecting with SSL...")
-                server = smtplib.SMTP_SSL(MAIL_SERVER, MAIL_PORT, timeout=30)
-            
-            # Method 3: Regular SMTP (port 25)
-            else:
-                print("🔗 Connecting without encryption...")
-                server = smtplib.SMTP(MAIL_SERVER, MAIL_PORT, timeout=30)
-            
-            print("👤 Logging in...")
-            server.login(MAIL_USERNAME, MAIL_PASSWORD)
-            
-            print("📤 Sending message...")
-            server.send_message(msg)
-            server.quit()
-            
+            smtp_pool.send(msg)
             print(f"✅ Email sent successfully to {to_email}")
             return True
         
         except smtplib.SMTPAuthenticationError as auth_error:
             print(f"❌ Authentication failed: {auth_error}")
             print("🔧 Try: Check password, enable app access, disable 2FA")
-            return False
         
         except smtplib.SMTPConnectError as conn_error:
             print(f"❌ Connection failed: {conn_error}")
             print("🔧 Try: Different port (465 instead of 587)")
-            return False
         
         except Exception as smtp_error:
             print(f"❌ SMTP error: {smtp_error}")
-            return False
         
-        finally:
-            if server:
-                try:
-                    server.quit()
-                except:
-                    pass
+        smtp_pool.record_failure()
+        return False
         
     except Exception as e:
         print(f"❌ Email error: {e}")
         print(f"❌ Error type: {type(e).__name__}")
         return False
+
+# Email templates - templates/email/<name>.html + <name>.txt, CSS inlined and compiled once at startup
+EMAIL_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'email')
+CSS_RULE = re.compile(r'([^{}]+)\{([^{}]*)\}')
+HTML_TAG = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)((?:\s[^<>]*?)?)(/?)>')
+STYLE_BLOCK = re.compile(r'\s*<style[^>]*>(.*?)</style>', re.S)
+
+def parse_css(css):
+    """[(selector, [(property, value), ...]), ...] in source order"""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    rules = []
+    for selectors, body in CSS_RULE.findall(css):
+        declarations = [tuple(part.strip() for part in item.split(':', 1)) for item in body.split(';') if ':' in item]
+        rules.extend((selector.strip(), declarations) for selector in selectors.split(','))
+    return rules
+
+def inline_css(markup, rules):
+    """Copy tag and .class rules into style="" attributes; anything else stays in a <style> block
+
+    Email clients ignore or strip <style> more often than not. Later rules win over
+    earlier ones, classes over tags and an existing style="" over both.
+    """
+    simple = [(selector, declarations) for selector, declarations in rules
+              if re.fullmatch(r'[a-zA-Z][a-zA-Z0-9]*|\.[\w-]+', selector)]
+    leftover = [(selector, declarations) for selector, declarations in rules
+                if (selector, declarations) not in simple]
+
+    def apply(match):
+        tag, attributes, self_closing = match.groups()
+        classes = re.search(r'\sclass="([^"]*)"', attributes)
+        classes = set(classes.group(1).split()) if classes else set()
+        style = {}
+        for selector, declarations in sorted(simple, key=lambda rule: rule[0].startswith('.')):
+            if selector == tag.lower() or (selector.startswith('.') and selector[1:] in classes):
+                style.update(declarations)
+        existing = re.search(r'\sstyle="([^"]*)"', attributes)
+        if existing:
+            style.update(tuple(part.strip() for part in item.split(':', 1))
+                         for item in existing.group(1).split(';') if ':' in item)
+            attributes = attributes.replace(existing.group(0), '')
+        if style:
+            attributes += ' style="' + '; '.join(f"{name}: {value}" for name, value in style.items()) + ';"'
+        return f"<{tag}{attributes}{self_closing}>"
+
+    markup = HTML_TAG.sub(apply, markup)
+    if leftover:
+        css = '\n'.join(f"{selector} {{ {'; '.join(f'{n}: {v}' for n, v in declarations)}; }}" for selector, declarations in leftover)
+        markup = markup.replace('</head>', f"<style>\n{css}\n</style>\n</head>", 1)
+    return markup
+
+EXTENDS_TAG = re.compile(r'{%-?\s*extends\s+["\']([^"\']+)["\']')
+
+def inline_css_loader(directory, shared_rules):
+    """FileSystemLoader that inlines CSS into .html sources as Jinja loads them
+
+    A template gets email.css, its own <style> rules and those of every layout it
+    {% extends %}, so a child's blocks are styled like the layout they end up in.
+    """
+    from jinja2 import FileSystemLoader
+
+    class InlineCssLoader(FileSystemLoader):
+        def style_rules(self, environment, name):
+            source = super().get_source(environment, name)[0]
+            parent = EXTENDS_TAG.search(source)
+            rules = self.style_rules(environment, parent.group(1)) if parent else []
+            return rules + [rule for block in STYLE_BLOCK.findall(source) for rule in parse_css(block)]
+
+        def get_source(self, environment, name):
+            source, filename, uptodate = super().get_source(environment, name)
+            if name.endswith('.html'):
+                source = inline_css(STYLE_BLOCK.sub('', source), shared_rules + self.style_rules(environment, name))
+            return source, filename, uptodate
+
+    return InlineCssLoader(directory)
+
+class EmailTemplates:
+    """Precompiled HTML + plain-text email templates
+
+    Each <name>.html has email.css plus its own <style> block inlined into the
+    markup before Jinja compiles it, so a render is just the compiled template
+    filling in the fields. HTML is autoescaped (customer input ends up in admin mail).
+    Files starting with _ are layouts for {% extends %} (e.g. _apk_layout.html),
+    not emails of their own.
+    """
+
+    def __init__(self, directory=EMAIL_TEMPLATE_DIR):
+        from jinja2 import Environment, FileSystemLoader, StrictUndefined
+        
+        self.directory = directory
+        self._html_env = Environment(autoescape=True, undefined=StrictUndefined)
+        self._text_env = Environment(loader=FileSystemLoader(directory), autoescape=False, undefined=StrictUndefined,
+                                     trim_blocks=True, lstrip_blocks=True)
+        for env in (self._html_env, self._text_env):
+            env.filters['display_date'] = lambda value: format_date_display(value)
+        self.templates = {}
+        self.load()
+
+    def load(self):
+        with open(os.path.join(self.directory, 'email.css'), encoding='utf-8') as f:
+            shared_rules = parse_css(f.read())
+        
+        # A fresh loader (and so a fresh template cache) picks up edited files and email.css
+        self._html_env.loader = inline_css_loader(self.directory, shared_rules)
+        self._text_env.cache.clear()
+        
+        templates = {}
+        for filename in sorted(os.listdir(self.directory)):
+            name, extension = os.path.splitext(filename)
+            if extension != '.html' or name.startswith('_'):
+                continue
+            html = self._html_env.get_template(filename)
+            
+            text = None
+            if os.path.exists(os.path.join(self.directory, name + '.txt')):
+                text = self._text_env.get_template(name + '.txt')
+            templates[name] = (html, text)
+        self.templates = templates
+        print(f"📧 Email templates compiled: {', '.join(templates)}")
+
+    def render(self, template_name, /, **context):
+        """(html, text) for one email; text is None when there is no .txt template"""
+        html, text = self.templates[template_name]
+        return html.render(**context), text.render(**context) if text is not None else None
+
+email_templates = EmailTemplates()
+
+# Email outbox - confirmations are queued with the booking and sent in the background
+OUTBOX_POLL_SECONDS = int(os.environ.get('OUTBOX_POLL_SECONDS', 30))
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_LEASE_SECONDS = 300
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_BACKOFF_SECONDS = 30
+OUTBOX_BACKOFF_MAX_SECONDS = 6 * 3600
+
+class EmailOutboxWorker:
+    """Background thread that drains email_outbox with exponential backoff
+
+    wake() is called after a booking commits so mail goes out right away; otherwise
+    the thread polls every OUTBOX_POLL_SECONDS, which also picks up retries and rows
+    left behind by a restart. Failed attempts wait 30 s, 60 s, 120 s, ... (capped at
+    6 h) and a message is marked 'failed' after OUTBOX_MAX_ATTEMPTS. The thread is
+    started when the process starts (application.py, __main__) and again by wake()
+    in any process that does not have one yet, e.g. a forked gunicorn worker.
+    """
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.stats = {'sent': 0, 'retried': 0, 'failed': 0, 'last_error': None}
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+            self._thread.start()
+            print("✅ Email outbox worker started")
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                while self.drain():
+                    pass
+            except Exception as e:
+                print(f"❌ Email outbox worker error: {e}")
+            self._wake.wait(OUTBOX_POLL_SECONDS)
+            self._wake.clear()
+
+    def drain(self):
+        """Send one batch of due messages; returns how many were claimed"""
+        claimed = self.outbox.claim_due(OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS)
+        for outbox_id, to_email, subject, html_body, text_body, attempts in claimed:
+            try:
+                sent = send_email(to_email, subject, html_body, text_body)
+                error = None if sent else 'send_email returned False'
+            except Exception as e:
+                sent, error = False, str(e)
+
+            if sent:
+                self.outbox.mark_sent(outbox_id)
+                self.stats['sent'] += 1
+                continue
+
+            give_up = attempts >= OUTBOX_MAX_ATTEMPTS
+            delay = min(OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX_SECONDS)
+            self.outbox.mark_retry(outbox_id, delay, error, give_up)
+            self.stats['failed' if give_up else 'retried'] += 1
+            self.stats['last_error'] = error
+            if give_up:
+                print(f"❌ Giving up on email #{outbox_id} to {to_email} after {attempts} attempts: {error}")
+            else:
+                print(f"⚠️ Email #{outbox_id} to {to_email} failed (attempt {attempts}), retrying in {delay}s")
+        return len(claimed)
+
+    def get_stats(self):
+        stats = dict(self.stats, running=self._thread is not None and self._thread.is_alive())
+        stats['queue'] = self.outbox.counts()
+        return stats
+
+email_outbox = EmailOutboxWorker(storage.outbox)
 import requests
-import threading
 
-def init_apk_database():
-    """Initialize APK database tables if they don't exist"""
-    try:
-        print("🔧 Initializing APK database tables...")
-        
-        connection = get_db_connection()
-        if connection is None:
-            print("❌ Could not connect to database")
-            return False
-        
-        cursor = connection.cursor()
-        
-        # Create APK clients table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS apk_clients (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                email TEXT NOT NULL,
-                phone TEXT,
-                licence_plate TEXT NOT NULL UNIQUE,
-                car_brand TEXT,
-                car_model TEXT,
-                car_year INTEGER,
-                apk_expiry_date DATE,
-                last_reminder_sent DATE,
-                reminder_count INTEGER DEFAULT 0,
-                is_active BOOLEAN DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Create APK reminder log table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS apk_reminder_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                client_id INTEGER,
-                client_name TEXT,
-                client_email TEXT,
-                client_licence_plate TEXT,
-                reminder_type TEXT DEFAULT 'automatic',
-                email_subject TEXT,
-                days_until_expiry INTEGER,
-                email_sent BOOLEAN DEFAULT 0,
-                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                error_message TEXT,
-                FOREIGN KEY (client_id) REFERENCES apk_clients (id)
-            )
-        """)
+# RDW open data - vehicle lookups go through one pooled session and a persistent cache
+RDW_API_URL = 'https://opendata.rdw.nl/resource/m9d7-ebf2.json'
+RDW_APP_TOKEN = os.environ.get('RDW_APP_TOKEN')  # optional Socrata app token, raises the rate limit
+RDW_TIMEOUT_SECONDS = 10
+RDW_CACHE_TTL_SECONDS = int(os.environ.get('RDW_CACHE_TTL_HOURS', 24 * 7)) * 3600
+RDW_NOT_FOUND_TTL_SECONDS = 3600
+RDW_MEMORY_CACHE_SIZE = 1024
+
+class RdwClient:
+    """Vehicle data from the RDW open data API
+
+    Lookups are answered from an in-process LRU, then from rdw_vehicle_cache (the
+    full RDW answer per kenteken, valid for RDW_CACHE_TTL_SECONDS; unknown plates
+    for RDW_NOT_FOUND_TTL_SECONDS), and only then over HTTP on a keep-alive
+    session. Concurrent lookups of one plate wait for the first one instead of
+    each calling RDW. When RDW is down an expired cache entry is better than none.
+    """
+
+    def __init__(self, cache, memory_size=RDW_MEMORY_CACHE_SIZE):
+        self.cache = cache
+        self.memory_size = memory_size
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._inflight = {}
+        self._session = None
+        self.stats = {'memory_hits': 0, 'cache_hits': 0, 'fetches': 0, 'coalesced': 0, 'stale_served': 0, 'errors': 0}
+
+    @staticmethod
+    def clean_plate(licence_plate):
+        # Remove spaces and dashes, convert to uppercase
+        return licence_plate.replace(" ", "").replace("-", "").upper()
+
+    def session(self):
+        if self._session is None:
+            from requests.adapters import HTTPAdapter
+            
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+            session.headers['Accept'] = 'application/json'
+            if RDW_APP_TOKEN:
+                session.headers['X-App-Token'] = RDW_APP_TOKEN
+            self._session = session
+        return self._session
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+    def _remember(self, kenteken, rows, expires_at):
+        with self._lock:
+            self._memory[kenteken] = (rows, expires_at)
+            self._memory.move_to_end(kenteken)
+            if len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def lookup(self, licence_plate):
+        """The RDW rows for a plate ([] when RDW does not know it), or None when RDW could not be reached"""
+        kenteken = self.clean_plate(licence_plate)
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        
+        with self._lock:
+            entry = self._memory.get(kenteken)
+            if entry is not None and entry[1] > now:
+                self._memory.move_to_end(kenteken)
+                self.stats['memory_hits'] += 1
+                return entry[0]
+            
+            waiter = self._inflight.get(kenteken)
+            leader = waiter is None
+            if leader:
+                waiter = self._inflight[kenteken] = {'done': threading.Event(), 'rows': None}
         
-        connection.commit()
-        cursor.close()
-        connection.close()
+        if not leader:
+            self._count('coalesced')
+            waiter['done'].wait(RDW_TIMEOUT_SECONDS * 2)
+            return waiter['rows']
         
-        print("✅ APK database tables initialized successfully")
-        return True
+        try:
+            waiter['rows'] = self._load(kenteken, now)
+            return waiter['rows']
+        finally:
+            with self._lock:
+                self._inflight.pop(kenteken, None)
+            waiter['done'].set()
+
+    def _load(self, kenteken, now):
+        cached = self.cache.find(kenteken)
+        if cached is not None and cached[1] > now:
+            self._count('cache_hits')
+            rows = app.json.loads(cached[0])
+            self._remember(kenteken, rows, cached[1])
+            return rows
         
-    except Exception as e:
-        print(f"❌ APK database initialization error: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+        try:
+            self._count('fetches')
+            response = self.session().get(RDW_API_URL, params={'kenteken': kenteken}, timeout=RDW_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            rows = response.json()
+        except Exception as e:
+            self._count('errors')
+            print(f"⚠️ RDW API error for {kenteken}: {e}")
+            if cached is None:
+                return None
+            self._count('stale_served')
+            return app.json.loads(cached[0])
+        
+        expires_at = self.cache.store(kenteken, app.json.dumps(rows),
+                                      RDW_CACHE_TTL_SECONDS if rows else RDW_NOT_FOUND_TTL_SECONDS)
+        self._remember(kenteken, rows, expires_at)
+        return rows
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, memory_entries=len(self._memory), inflight=len(self._inflight))
+        stats['cached_plates'] = self.cache.count()
+        return stats
+
+rdw_client = RdwClient(storage.rdw_cache)
 
 def fetch_rdw_vehicle_data(licence_plate):
-    """Fetch vehicle info from RDW API"""
+    """Fetch vehicle info from RDW API (cached, see RdwClient)"""
     try:
-        # Clean the plate - remove spaces and dashes, convert to uppercase
-        clean_plate = licence_plate.replace(" ", "").replace("-", "").upper()
-        
-        url = f"https://opendata.rdw.nl/resource/m9d7-ebf2.json?kenteken={clean_plate}"
-        response = requests.get(url, timeout=10)
-        
-        if response.status_code == 200 and response.json():
-            vehicle_data = response.json()[0]
-            print(f"✅ RDW data found for {clean_plate}: {vehicle_data.get('merk')} {vehicle_data.get('handelsbenaming')}")
+        rows = rdw_client.lookup(licence_plate)
+        if rows:
+            vehicle_data = rows[0]
+            print(f"✅ RDW data found for {rdw_client.clean_plate(licence_plate)}: {vehicle_data.get('merk')} {vehicle_data.get('handelsbenaming')}")
             return vehicle_data
     except Exception as e:
         print(f"⚠️ RDW API error for {licence_plate}: {e}")
@@ -812,20 +3126,7 @@ END:VCALENDAR"""
 def download_calendar_event(booking_id):
     """Download ICS calendar file for booking"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            return "Database error", 500
-        
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT id, name, email, phone, service, date, time, message 
-            FROM bookings 
-            WHERE id = ?
-        """, (booking_id,))
-        
-        booking = cursor.fetchone()
-        cursor.close()
-        connection.close()
+        booking = storage.bookings.get(booking_id)
         
         if not booking:
             return "Booking not found", 404
@@ -868,96 +3169,28 @@ def download_calendar_event(booking_id):
     except Exception as e:
         print(f"❌ Calendar download error: {e}")
         return "Calendar download error", 500
-def send_apk_reminder_email(client_data, days_until_expiry):
+def apk_reminder_template(stage):
+    """Template of a reminder stage: apk_expired for stage 0, apk_reminder_<days> if present, else apk_reminder"""
+    if stage == 0:
+        return 'apk_expired'
+    return f'apk_reminder_{stage}' if f'apk_reminder_{stage}' in email_templates.templates else 'apk_reminder'
+
+def send_apk_reminder_email(client_data, days_until_expiry, stage=30):
     """Send APK reminder email using existing email configuration"""
     try:
-        subject = f"APK Herinnering - {client_data['licence_plate']} verloopt over {days_until_expiry} dagen"
-        
-        # Create professional HTML email
-        html_body = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8">
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: linear-gradient(135deg, #d32f2f 0%, #f44336 100%); color: white; padding: 25px; text-align: center; border-radius: 10px 10px 0 0; }}
-                .content {{ padding: 25px; background: #f9f9f9; }}
-                .warning-box {{ background: #fff3cd; border: 1px solid #ffeaa7; padding: 15px; border-radius: 8px; margin: 20px 0; }}
-                .vehicle-details {{ background: white; padding: 20px; border-radius: 8px; margin: 20px 0; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }}
-                .contact-info {{ background: #e3f2fd; padding: 20px; border-radius: 8px; margin: 20px 0; }}
-                .footer {{ text-align: center; padding: 20px; color: #666; background: #f5f5f5; border-radius: 0 0 10px 10px; }}
-                .urgent {{ color: #d32f2f; font-weight: bold; }}
-                .btn {{ background: #d32f2f; color: white; padding: 12px 25px; text-decoration: none; border-radius: 5px; display: inline-block; margin: 10px 0; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>🚗 APK Herinnering</h1>
-                    <h2>Autobedrijf Koree</h2>
-                    <p>Uw APK verloopt binnenkort!</p>
-                </div>
-                
-                <div class="content">
-                    <h2>Beste {client_data['name']},</h2>
-                    
-                    <div class="warning-box">
-                        <h3>⚠️ Belangrijke herinnering</h3>
-                        <p class="urgent">Uw APK verloopt over {days_until_expiry} dagen!</p>
-                        <p>Plan nu uw APK keuring in om problemen te voorkomen.</p>
-                    </div>
-                    
-                    <div class="vehicle-details">
-                        <h3>🚙 Voertuiggegevens</h3>
-                        <table style="width: 100%; border-collapse: collapse;">
-                            <tr><td style="padding: 8px; border-bottom: 1px solid #eee;"><strong>Kenteken:</strong></td><td style="padding: 8px; border-bottom: 1px solid #eee;">{client_data['licence_plate']}</td></tr>
-                            <tr><td style="padding: 8px; border-bottom: 1px solid #eee;"><strong>Merk:</strong></td><td style="padding: 8px; border-bottom: 1px solid #eee;">{client_data.get('car_brand', 'Onbekend')}</td></tr>
-                            <tr><td style="padding: 8px; border-bottom: 1px solid #eee;"><strong>Model:</strong></td><td style="padding: 8px; border-bottom: 1px solid #eee;">{client_data.get('car_model', 'Onbekend')}</td></tr>
-                            <tr><td style="padding: 8px; border-bottom: 1px solid #eee;"><strong>APK vervalt op:</strong></td><td style="padding: 8px; border-bottom: 1px solid #eee; color: #d32f2f; font-weight: bold;">{format_date_display(client_data['apk_expiry_date'])}</td></tr>
-                        </table>
-                    </div>
-                    
-                    <div class="contact-info">
-                        <h3>📞 Maak nu een afspraak!</h3>
-                        <p><strong>Autobedrijf Koree - Uw specialist voor APK keuringen</strong></p>
-                        <p>📍 <strong>Adres:</strong> Haven 45-48, 3143 BD Maassluis</p>
-                        <p>📞 <strong>Telefoon:</strong> 010 592 8497</p>
-                        <p>📧 <strong>Email:</strong> info@koreeautoservices.nl</p>
-                        <p>🌐 <strong>Website:</strong> <a href="https://koreeautoservices.nl">koreeautoservices.nl</a></p>
-                        
-                        <a href="https://koreeautoservices.nl" class="btn">💻 Online Afspraak Maken</a>
-                    </div>
-                    
-                    <p><strong>Waarom kiezen voor Autobedrijf Koree?</strong></p>
-                    <ul>
-                        <li>✅ Erkend APK keuringsstation</li>
-                        <li>✅ Snelle en betrouwbare service</li>
-                        <li>✅ Eerlijke prijzen</li>
-                        <li>✅ Ervaren monteurs</li>
-                        <li>✅ Directe reparaties mogelijk</li>
-                    </ul>
-                    
-                    <p>Neem vandaag nog contact met ons op om uw APK keuring in te plannen!</p>
-                    
-                    <p style="margin-top: 30px;">
-                        Met vriendelijke groet,<br>
-                        <strong>Team Autobedrijf Koree</strong>
-                    </p>
-                </div>
-                
-                <div class="footer">
-                    <p><small>Dit is een automatische herinnering. Heeft u al een afspraak gemaakt? Dan kunt u deze email negeren.</small></p>
-                    <p><small>Haven 45-48, 3143 BD Maassluis | 010 592 8497 | info@koreeautoservices.nl</small></p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        if stage == 0:
+            subject = f"APK Verlopen - {client_data['licence_plate']}"
+        else:
+            subject = f"APK Herinnering - {client_data['licence_plate']} verloopt over {days_until_expiry} dagen"
+        
+        html_body, text_body = email_templates.render(
+            apk_reminder_template(stage), days_until_expiry=days_until_expiry,
+            name=client_data['name'], licence_plate=client_data['licence_plate'],
+            car_brand=client_data.get('car_brand'), car_model=client_data.get('car_model'),
+            apk_expiry_date=client_data['apk_expiry_date'])
         
         # Send email using your existing function
-        email_success = send_email(client_data['email'], subject, html_body)
+        email_success = send_email(client_data['email'], subject, html_body, text_body)
         
         if email_success:
             print(f"✅ APK reminder email sent to {client_data['email']}")
@@ -969,92 +3202,158 @@ def send_apk_reminder_email(client_data, days_until_expiry):
         error_msg = f"Error sending APK reminder email: {str(e)}"
         print(f"❌ {error_msg}")
         return False, error_msg
-def check_and_send_apk_reminders():
-    """Check for expiring APK dates and send reminders (only at 30 days)"""
+# Reminder runs send from a small thread pool; results are written back in batches
+APK_REMINDER_WORKERS = int(os.environ.get('APK_REMINDER_WORKERS', SMTP_POOL_SIZE))
+APK_REMINDER_WRITE_BATCH = 100
+apk_reminder_run_lock = threading.Lock()
+
+def due_apk_reminder_stage(client, today):
+    """Stage to send now for a client popped from the queue, or None when nothing is worth sending
+
+    After missed runs several stages can be due at once; only the latest of them
+    is sent. An expired notice more than APK_EXPIRED_NOTICE_GRACE_DAYS late is dropped.
+    """
+    apk_date = datetime.strptime(str(client[6])[:10], '%Y-%m-%d').date()
+    due_stages = [stage for stage in APK_REMINDER_STAGES
+                  if stage <= client[8] and apk_date - timedelta(days=stage) <= today]
+    if not due_stages or (due_stages[-1] == 0 and (today - apk_date).days > APK_EXPIRED_NOTICE_GRACE_DAYS):
+        return None
+    return due_stages[-1]
+
+def send_apk_reminder(client, stage, today):
+    """Render and send one stage's reminder; (client_id, subject, days_until, email_sent, error_message, next_due, next_stage)"""
+    apk_date = datetime.strptime(str(client[6])[:10], '%Y-%m-%d').date()
+    days_until = (apk_date - today).days
+    
+    client_data = {
+        'name': client[1],
+        'email': client[2],
+        'licence_plate': client[3],
+        'car_brand': client[4],
+        'car_model': client[5],
+        'apk_expiry_date': client[6]
+    }
+    
+    email_success, email_message = send_apk_reminder_email(client_data, days_until, stage)
+    if email_success:
+        print(f"✅ Reminder sent to {client[1]} ({client[3]}) - {days_until} days until expiry")
+    next_due, next_stage = apk_reminder_schedule(apk_date, stage)
+    return (client[0], f"APK Reminder - {client[3]}", days_until, email_success,
+            None if email_success else email_message, next_due, next_stage)
+
+def check_and_send_apk_reminders(workers=APK_REMINDER_WORKERS):
+    """Send the APK reminders that are due (every stage in APK_REMINDER_STAGES)
+
+    Selection is one indexed pop of next_reminder_due <= today, so days the job
+    did not run are caught up on the next run; sending runs on `workers` threads (sharing the
+    SMTP pool) while this thread writes the log rows and last_reminder_sent in
+    transactions of APK_REMINDER_WRITE_BATCH, so the database is never held during
+    a send. Each run's counts, duration and throughput go to apk_reminder_runs.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    
+    if not apk_reminder_run_lock.acquire(blocking=False):
+        print("⚠️ APK reminder run already in progress, skipping")
+        return False
     try:
         print("🔍 Checking for APK reminders...")
         
-        connection = get_db_connection()
-        if connection is None:
-            print("❌ Database connection failed for APK check")
-            return False
-        
-        cursor = connection.cursor()
-        
-        # Get clients with APK expiring in exactly 30 days (or 29-31 days to handle weekends)
-        cursor.execute("""
-            SELECT id, name, email, licence_plate, car_brand, car_model, apk_expiry_date, last_reminder_sent
-            FROM apk_clients 
-            WHERE is_active = 1 
-            AND apk_expiry_date IS NOT NULL
-            AND DATE(apk_expiry_date) >= DATE('now', '+29 days')
-            AND DATE(apk_expiry_date) <= DATE('now', '+31 days')
-            AND (last_reminder_sent IS NULL OR DATE(last_reminder_sent) < DATE('now', '-25 days'))
-            ORDER BY apk_expiry_date ASC
-        """)
+        started_at = datetime.now()
+        started = time.monotonic()
+        today = started_at.date()
         
-        clients_to_remind = cursor.fetchall()
+        clients_to_remind = []
+        skipped = []
+        for client in storage.apk_clients.reminders_due(today):
+            stage = due_apk_reminder_stage(client, today)
+            if stage is None:
+                skipped.append((None, None, client[0]))
+            else:
+                clients_to_remind.append((client, stage))
+        storage.apk_clients.skip_reminders(skipped)
         
         if not clients_to_remind:
             print("ℹ️ No APK reminders needed today")
-            cursor.close()
-            connection.close()
             return True
         
-        today = datetime.now().date()
-        success_count = 0
+        success_count = failure_count = 0
+        pending = []
         
-        for client in clients_to_remind:
-            try:
-                client_id = client[0]
-                apk_date = datetime.strptime(client[6], '%Y-%m-%d').date()
-                days_until = (apk_date - today).days
-                
-                client_data = {
-                    'name': client[1],
-                    'email': client[2],
-                    'licence_plate': client[3],
-                    'car_brand': client[4],
-                    'car_model': client[5],
-                    'apk_expiry_date': client[6]
-                }
-                
-                # Send reminder email
-                email_success, email_message = send_apk_reminder_email(client_data, days_until)
-                
-                # Log the reminder
-                cursor.execute("""
-                    INSERT INTO apk_reminder_log (client_id, reminder_type, email_subject, days_until_expiry, email_sent, error_message)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (client_id, 'automatic', f"APK Reminder - {client[3]}", days_until, email_success, None if email_success else email_message))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='apk-reminder') as executor:
+            futures = {executor.submit(send_apk_reminder, client, stage, today): client
+                       for client, stage in clients_to_remind}
+            for future in as_completed(futures):
+                client = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"❌ Error sending reminder to {client[1]}: {e}")
+                    result = (client[0], f"APK Reminder - {client[3]}", None, False, str(e), None, None)
                 
-                if email_success:
-                    # Update last reminder sent
-                    cursor.execute("""
-                        UPDATE apk_clients 
-                        SET last_reminder_sent = DATE('now'), reminder_count = reminder_count + 1
-                        WHERE id = ?
-                    """, (client_id,))
+                if result[3]:
                     success_count += 1
-                    print(f"✅ Reminder sent to {client[1]} ({client[3]}) - {days_until} days until expiry")
-                
-                connection.commit();
-                
-            except Exception as e:
-                print(f"❌ Error sending reminder to {client[1]}: {e}")
-        
-        cursor.close()
-        connection.close()
-        
-        print(f"✅ APK reminder check complete: {success_count} reminders sent")
+                else:
+                    failure_count += 1
+                pending.append(result)
+                if len(pending) >= APK_REMINDER_WRITE_BATCH:
+                    storage.apk_clients.record_reminders(pending, today)
+                    pending = []
+        
+        storage.apk_clients.record_reminders(pending, today)
+        
+        duration = time.monotonic() - started
+        storage.apk_clients.record_run(started_at.isoformat(timespec='seconds'), duration,
+                                       len(clients_to_remind), success_count, failure_count, workers)
+        print(f"✅ APK reminder check complete: {success_count} reminders sent, {failure_count} failed "
+              f"in {duration:.1f}s ({len(clients_to_remind) / duration if duration else 0:.1f}/s, {workers} workers)")
         return True
         
     except Exception as e:
         print(f"❌ APK reminder check error: {e}")
         return False
+    finally:
+        apk_reminder_run_lock.release()
+
+# One scheduler per host: every web worker calls start_daily_apk_check(), the one holding this lock runs the jobs
+SCHEDULER_LOCK_FILE = os.environ.get('SCHEDULER_LOCK_FILE', DB_FILE + '.scheduler.lock')
+_scheduler_lock = None
+
+def try_file_lock(path):
+    """Non-blocking exclusive flock on `path`; the open lock file, or None when another process holds it
+
+    The lock lasts until the file is closed (or the process exits).
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return open(path, 'a')  # No flock (Windows dev machine): a single process anyway
+
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+def acquire_scheduler_lock():
+    """Lock SCHEDULER_LOCK_FILE for the life of the process"""
+    global _scheduler_lock
+    if _scheduler_lock is None:
+        _scheduler_lock = try_file_lock(SCHEDULER_LOCK_FILE)
+    return _scheduler_lock is not None
+
 def start_daily_apk_check():
-    """Start daily APK reminder check using scheduler"""
+    """Start the scheduled jobs (APK reminders, snapshots, log retention) in one process
+
+    Called at startup by application.py and __main__; returns None without starting
+    anything when another process on this host already runs the scheduler.
+    """
     try:
+        if not acquire_scheduler_lock():
+            print(f"⏭️ Scheduler already running in another process ({SCHEDULER_LOCK_FILE})")
+            return None
+        
         # BackgroundScheduler is already imported at top of file
         scheduler = BackgroundScheduler()
         
@@ -1068,8 +3367,29 @@ def start_daily_apk_check():
             replace_existing=True
         )
         
+        # Keep a fresh database snapshot ready for /admin/download-db
+        scheduler.add_job(
+            func=create_db_snapshot,
+            trigger='interval',
+            minutes=SNAPSHOT_MAX_AGE_MINUTES,
+            id='db_snapshot',
+            replace_existing=True
+        )
+        
+        # Move old visitor/admin login rows out of the main database at night
+        scheduler.add_job(
+            func=apply_log_retention,
+            trigger='cron',
+            hour=3,
+            minute=30,
+            id='log_retention',
+            replace_existing=True
+        )
+        
         scheduler.start()
         print("✅ APK daily check scheduled for 9:00 AM")
+        print(f"✅ Database snapshots scheduled every {SNAPSHOT_MAX_AGE_MINUTES} minutes")
+        print(f"✅ Log retention ({LOG_RETENTION_MODE}, {LOG_RETENTION_DAYS} days) scheduled for 3:30 AM")
         
         return scheduler
         
@@ -1147,36 +3467,6 @@ def get_google_reviews():
     except Exception as e:
         print(f"❌ Error loading manual reviews: {e}")
         return {'success': False, 'error': f'Error: {str(e)}'}
-def ensure_apk_tables_exist():
-    """Ensure APK tables exist before using them"""
-    try:
-        connection = get_db_connection()
-        if connection is None:
-            return False
-        
-        cursor = connection.cursor()
-        
-        # Check if APK tables exist
-        cursor.execute("""
-            SELECT name FROM sqlite_master 
-            WHERE type='table' AND name IN ('apk_clients', 'apk_reminder_log')
-        """)
-        
-        existing_tables = [row[0] for row in cursor.fetchall()]
-        
-        if len(existing_tables) < 2:
-            print("🔧 APK tables missing, creating them...")
-            cursor.close()
-            connection.close()
-            return init_apk_database()
-        
-        cursor.close()
-        connection.close()
-        return True
-        
-    except Exception as e:
-        print(f"❌ Error checking APK tables: {e}")
-        return False
 # Authentication decorator
 def require_admin_auth(f):
     @wraps(f)
@@ -1199,17 +3489,21 @@ def require_admin_auth(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def get_client_ip(request):
+    """Client IP address (works with AWS load balancers)"""
+    ip_address = request.headers.get('X-Forwarded-For', 
+                request.headers.get('X-Real-IP', 
+                request.remote_addr or 'unknown'))
+    
+    # Handle comma-separated IPs from load balancers
+    if ',' in ip_address:
+        ip_address = ip_address.split(',')[0].strip()
+    return ip_address
+
 def get_client_info(request):
     """Extract client information from request (works in cloud and local)"""
     try:
-        # Get IP address (works with AWS load balancers)
-        ip_address = request.headers.get('X-Forwarded-For', 
-                    request.headers.get('X-Real-IP', 
-                    request.remote_addr or 'unknown'))
-        
-        # Handle comma-separated IPs from load balancers
-        if ',' in ip_address:
-            ip_address = ip_address.split(',')[0].strip()
+        ip_address = get_client_ip(request)
         
         user_agent_string = request.headers.get('User-Agent', '')
         user_agent = parse(user_agent_string)
@@ -1243,6 +3537,108 @@ def get_client_info(request):
             'city': 'unknown'
         }
 
+# Rate limiting - per-IP and global token buckets, checked before a route touches the database
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 10000))
+
+class RateLimiter:
+    """Token buckets per client IP plus one shared bucket for all clients
+
+    A bucket holds up to `burst` tokens and refills at `per_minute` tokens a
+    minute; a request takes one token from its IP bucket and one from the global
+    bucket, or neither. Buckets live in an OrderedDict in least-recently-used
+    order, so a check is O(1) and memory is bounded: beyond max_keys the most
+    idle IP is dropped (it would have refilled to a full bucket anyway, unless
+    thousands of other clients came by in between).
+    """
+
+    def __init__(self, name, per_minute, burst, global_per_minute, global_burst, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.global_rate = global_per_minute / 60.0
+        self.global_burst = global_burst
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._global = None
+        self.stats = {'allowed': 0, 'limited_ip': 0, 'limited_global': 0, 'evicted': 0}
+
+    @staticmethod
+    def _refill(bucket, rate, burst, now):
+        """Tokens in a bucket at `now`; a bucket not seen before (None) is full"""
+        if bucket is None:
+            return float(burst)
+        tokens, updated = bucket
+        return min(burst, tokens + max(0.0, now - updated) * rate)
+
+    def acquire(self, key, now=None):
+        """0 when the request may go ahead, else the seconds until it would be allowed"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            tokens = self._refill(bucket, self.rate, self.burst, now)
+            global_tokens = self._refill(self._global, self.global_rate, self.global_burst, now)
+            
+            retry_after = 0
+            if tokens < 1:
+                retry_after = (1 - tokens) / self.rate
+                self.stats['limited_ip'] += 1
+            elif global_tokens < 1:
+                retry_after = (1 - global_tokens) / self.global_rate
+                self.stats['limited_global'] += 1
+            else:
+                tokens -= 1
+                global_tokens -= 1
+                self.stats['allowed'] += 1
+            
+            # Re-inserted at the end: the front of the dict is always the most idle IP
+            self._buckets[key] = (tokens, now)
+            self._global = (global_tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.stats['evicted'] += 1
+            return retry_after
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, name=self.name, tracked_ips=len(self._buckets))
+
+booking_limiter = RateLimiter(
+    'booking',
+    per_minute=int(os.environ.get('RATE_LIMIT_BOOK_PER_MINUTE', 10)), burst=int(os.environ.get('RATE_LIMIT_BOOK_BURST', 5)),
+    global_per_minute=int(os.environ.get('RATE_LIMIT_BOOK_GLOBAL_PER_MINUTE', 300)), global_burst=int(os.environ.get('RATE_LIMIT_BOOK_GLOBAL_BURST', 60)))
+login_limiter = RateLimiter(
+    'admin-login',
+    per_minute=int(os.environ.get('RATE_LIMIT_LOGIN_PER_MINUTE', 5)), burst=int(os.environ.get('RATE_LIMIT_LOGIN_BURST', 5)),
+    global_per_minute=int(os.environ.get('RATE_LIMIT_LOGIN_GLOBAL_PER_MINUTE', 60)), global_burst=int(os.environ.get('RATE_LIMIT_LOGIN_GLOBAL_BURST', 20)))
+
+def rate_limited(limiter, form_template=None):
+    """Answer 429 + Retry-After once the client's (or everybody's) bucket is empty
+
+    API routes get the message as JSON. Browser form posts pass form_template: the
+    message is flashed and the form page is served again (a browser does not follow
+    a Location header on a 429, so a redirect would leave a blank "Redirecting" page).
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            retry_after = limiter.acquire(get_client_ip(request))
+            if retry_after:
+                seconds = max(1, int(retry_after + 0.999))
+                message = f"Te veel verzoeken, probeer het over {seconds} seconden opnieuw"
+                print(f"🚦 Rate limited ({limiter.name}): {get_client_ip(request)}, retry in {seconds}s")
+                if form_template:
+                    flash(message, 'error')
+                    response = app.make_response(render_template(form_template))
+                else:
+                    response = jsonify({"error": message})
+                response.status_code = 429
+                response.headers['Retry-After'] = str(seconds)
+                return response
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
 def track_visitor(request, page_name, page_url):
     """Track website visitor (works in cloud and local)"""
     try:
@@ -1254,33 +3650,7 @@ def track_visitor(request, page_name, page_url):
             session_id = str(uuid.uuid4())
             session['visitor_session_id'] = session_id
         
-        connection = get_db_connection()
-        if connection is None:
-            return False
-        
-        cursor = connection.cursor()
-        
-        cursor.execute("""
-            INSERT INTO visitor_logs 
-            (ip_address, user_agent, page_visited, referrer, country, city, 
-             device_type, browser, os, session_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            client_info['ip_address'],
-            client_info['user_agent'],
-            page_name,
-            client_info['referrer'],
-            client_info['country'],
-            client_info['city'],
-            client_info['device_type'],
-            client_info['browser'],
-            client_info['os'],
-            session_id
-        ))
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        storage.analytics.record_visit(client_info, page_name, session_id)
         
         print(f"📊 Tracked visitor: {client_info['ip_address']} -> {page_name}")
         return True
@@ -1294,32 +3664,7 @@ def track_admin_login(request, username, success, failure_reason=None):
     try:
         client_info = get_client_info(request)
         
-        connection = get_db_connection()
-        if connection is None:
-            return False
-        
-        cursor = connection.cursor()
-        
-        cursor.execute("""
-            INSERT INTO admin_login_logs 
-            (username, ip_address, user_agent, login_successful, failure_reason,
-             country, city, browser, os)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            username,
-            client_info['ip_address'],
-            client_info['user_agent'],
-            success,
-            failure_reason,
-            client_info['country'],
-            client_info['city'],
-            client_info['browser'],
-            client_info['os']
-        ))
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        storage.analytics.record_admin_login(client_info, username, success, failure_reason)
         
         status = "✅ SUCCESS" if success else "❌ FAILED"
         print(f"🔐 Admin login {status}: {username} from {client_info['ip_address']}")
@@ -1335,14 +3680,7 @@ def get_services():
     try:
         print("🔧 Getting services...")
         
-        connection = get_db_connection()
-        if connection is None:
-            print("❌ Database connection failed")
-            return jsonify({"error": "Database connection failed"}), 500
-        
-        cursor = connection.cursor()
-        cursor.execute("SELECT id, name, description, duration_minutes FROM services WHERE active = 1")
-        services_raw = cursor.fetchall()
+        services_raw = storage.services.list_active()
         
         print(f"📊 Raw services from database: {len(services_raw)} rows")
         
@@ -1357,9 +3695,6 @@ def get_services():
             services.append(service_dict)
             print(f"  📝 Service: {service_dict['name']}")
         
-        cursor.close()
-        connection.close()
-        
         print(f"✅ Returning {len(services)} services (without prices)")
         return jsonify({"success": True, "services": services})
         
@@ -1422,37 +3757,51 @@ def get_available_times():
                     "message": f"Op {day_name} zijn we gesloten"
                 })
         
-        connection = get_db_connection()
-        if connection is None:
-            print("❌ Database connection failed")
-            return jsonify({
-                "success": False,
-                "error": "Database connection failed",
-                "available_times": [],
-                "message": "Database fout"
-            })
-        
-        cursor = connection.cursor()
-        
-        # Get all booked times for this date
-        cursor.execute("""
-            SELECT time FROM bookings 
-            WHERE date = ? AND status != 'cancelled'
-        """, (date,))
+        # Serve from the availability cache / answer revalidations with one version lookup.
+        # Today's answer also changes as slots pass, so the number of passed slots is in the key.
+        now = datetime.now()
+        passed_slots = -1
+        if booking_date == now.date():
+            passed_slots = bisect.bisect_right(get_slot_template(booking_date.weekday()).offsets,
+                                               now.hour * 60 + now.minute + now.second / 60)
+        cache_key = (date, request.args.get('service_id', ''), request.args.get('service', ''), passed_slots)
+        cache_version = availability_cache.version(date)
+        etag = availability_cache.etag(cache_key, cache_version)
+        
+        if availability_cache.is_fresh(request.if_none_match, etag):
+            return availability_response('', etag, 304)
+        
+        cached_body = availability_cache.get(cache_key, cache_version)
+        if cached_body is not None:
+            return availability_response(cached_body, etag)
+        
+        # Requested service decides how many consecutive slots are needed and which bays can do it
+        service_id = request.args.get('service_id', type=int)
+        service_name = request.args.get('service')
+        duration = SLOT_MINUTES
+        if service_id is not None or service_name:
+            found = storage.services.find(service_id=service_id, name=service_name)
+            if found is None:
+                return jsonify({
+                    "success": False,
+                    "error": "Unknown service",
+                    "available_times": [],
+                    "message": "Onbekende service"
+                }), 400
+            service_id, duration = found
+        resource_ids = storage.resources.for_service(service_id)
         
-        booked_times_raw = cursor.fetchall()
-        booked_times = [row[0] for row in booked_times_raw]
+        # Get all bookings (start + duration + resource) for this date
+        booked_slots = storage.bookings.booked_slots(date)
+        booked_times = sorted({booked_time for booked_time, _, _ in booked_slots})
         
         print(f"📊 Booked times for {date}: {booked_times}")
         
-        cursor.close()
-        connection.close()
-        
-        # Generate time slots based on business hours for this day
-        all_time_slots = generate_time_slots(date)
+        # Slot grid for this weekday, compiled once from BUSINESS_HOURS
+        template = get_slot_template(booking_date.weekday())
         
         # If no time slots (day is closed), return empty
-        if not all_time_slots:
+        if not template.mask:
             print(f"⛔ No time slots available for {day_name} - day is closed")
             return jsonify({
                 "success": False,
@@ -1462,54 +3811,45 @@ def get_available_times():
                 "day_name": day_name
             })
         
-        print(f"⏰ Generated time slots for {day_name}: {all_time_slots}")
-        
-        # Get current time for today's comparison
-        now = datetime.now()
-        is_today = booking_date == now.date()
-        print(f"📅 Is today: {is_today}, Current time: {now.strftime('%H:%M')}")
-        
-        # Filter available times
-        available_times = []
-        
-        for time_slot in all_time_slots:
-            is_booked = time_slot in booked_times
-            
-            # Check if time has passed for today
-            is_past_time = False
-            if is_today:
-                try:
-                    slot_time = datetime.strptime(time_slot, '%H:%M').time()
-                    slot_datetime = datetime.combine(booking_date, slot_time)
-                    is_past_time = slot_datetime <= now
-                    if is_past_time:
-                        print(f"  ⏰ Past time: {time_slot}")
-                except Exception as te:
-                    print(f"❌ Time parsing error for {time_slot}: {te}")
-                    is_past_time = False
-            
-            is_available = not is_booked and not is_past_time
-            
-            # Only add to available_times if actually available
-            if is_available:
-                available_times.append(time_slot)
-                print(f"  ✅ Available: {time_slot}")
-            elif is_booked:
-                print(f"  ❌ Booked: {time_slot}")
+        # Holiday / closure covering the whole opening hours
+        if not template.mask & ~closure_index.blocked_bits(template, booking_date):
+            reason = closure_index.overlaps(booking_date, 0, 24 * 60)
+            print(f"⛔ {date} is closed: {reason}")
+            return jsonify({
+                "success": False,
+                "error": f"We are closed on {date}",
+                "available_times": [],
+                "message": f"Gesloten op {date}: {reason}",
+                "day_name": day_name
+            })
+        
+        is_today = booking_date == now.date()
+        
+        # Start times where the whole service duration fits
+        all_time_slots = template.labels
+        per_resource = resource_start_bits(template, booking_date, booked_slots, resource_ids, duration, now)
+        capacity = slot_capacity(template, per_resource)
+        available_times = list(capacity)
         
         print(f"✅ Total slots: {len(all_time_slots)}, Available: {len(available_times)}, Booked: {len(booked_times)}")
         
-        return jsonify({
+        body = app.json.dumps({
             "success": True,
             "date": date,
             "day_name": day_name,
             "available_times": available_times,
             "booked_times": booked_times,
+            "duration_minutes": duration,
+            "capacity": capacity,
+            "resources": len(resource_ids),
             "total_slots": len(all_time_slots),
             "available_count": len(available_times),
             "is_today": is_today,
             "message": f"{len(available_times)} beschikbare tijden gevonden" if available_times else f"Geen beschikbare tijden op {day_name}"
         })
+        availability_cache.put(cache_key, cache_version, body)
+        
+        return availability_response(body, etag)
         
     except Exception as e:
         print(f"❌ Available times error: {str(e)}")
@@ -1522,7 +3862,276 @@ def get_available_times():
             "message": "Fout bij laden tijden"
         }), 500
 
+AVAILABILITY_MAX_DAYS = 93
+
+@app.route("/api/availability", methods=["GET"])
+def get_availability():
+    """Per-day free slot counts and earliest free time for a date range (for the date picker)"""
+    try:
+        try:
+            first_date = datetime.strptime(request.args.get('from', ''), '%Y-%m-%d').date()
+            last_date = datetime.strptime(request.args.get('to', ''), '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({"success": False, "error": "from and to must be YYYY-MM-DD"}), 400
+        
+        if last_date < first_date or (last_date - first_date).days >= AVAILABILITY_MAX_DAYS:
+            return jsonify({"success": False, "error": f"Range must be 1-{AVAILABILITY_MAX_DAYS} days"}), 400
+        
+        duration = SLOT_MINUTES
+        service_id = request.args.get('service_id', type=int)
+        if service_id is not None:
+            found = storage.services.find(service_id=service_id)
+            if found is None:
+                return jsonify({"success": False, "error": "Unknown service"}), 400
+            duration = found[1]
+        resource_ids = storage.resources.for_service(service_id)
+        
+        # One query for the whole range; the slot grids come from the weekday templates
+        booked_by_date = storage.bookings.booked_slots_between(first_date.isoformat(), last_date.isoformat())
+        now = datetime.now()
+        
+        days = {}
+        booking_date = first_date
+        while booking_date <= last_date:
+            date_key = booking_date.isoformat()
+            template = get_slot_template(booking_date.weekday())
+            
+            if booking_date < now.date():
+                days[date_key] = {"status": "past", "free_slots": 0, "earliest": None}
+            elif not template.mask or not template.mask & ~closure_index.blocked_bits(template, booking_date):
+                days[date_key] = {"status": "closed", "free_slots": 0, "earliest": None}
+            else:
+                bits = free_start_bits(template, booking_date, booked_by_date.get(date_key, ()), resource_ids, duration, now)
+                free_count = bin(bits).count('1')
+                days[date_key] = {
+                    "status": "open" if free_count else "full",
+                    "free_slots": free_count,
+                    "earliest": template.labels[(bits & -bits).bit_length() - 1] if bits else None
+                }
+            booking_date += timedelta(days=1)
+        
+        return jsonify({
+            "success": True,
+            "from": first_date.isoformat(),
+            "to": last_date.isoformat(),
+            "duration_minutes": duration,
+            "days": days
+        })
+        
+    except Exception as e:
+        print(f"❌ Availability range error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"success": False, "error": "Failed to fetch availability"}), 500
+
+NEXT_AVAILABLE_MAX_COUNT = 20
+NEXT_AVAILABLE_CHUNK_DAYS = 28
+
+def next_free_starts(duration, resource_ids, count, now=None, max_days=AVAILABILITY_MAX_DAYS):
+    """First `count` (date, 'HH:MM') starts from now on where one of the resources fits `duration`
+
+    Bookings are fetched one range query per NEXT_AVAILABLE_CHUNK_DAYS instead of one
+    per day; each day is then a handful of bitmask operations on its weekday template
+    (closures and today's past slots included), so even a fully booked quarter is cheap.
+    """
+    now = now or datetime.now()
+    found = []
+    chunk_start = now.date()
+    last_date = chunk_start + timedelta(days=max_days - 1)
+    while chunk_start <= last_date and len(found) < count:
+        chunk_end = min(chunk_start + timedelta(days=NEXT_AVAILABLE_CHUNK_DAYS - 1), last_date)
+        booked_by_date = storage.bookings.booked_slots_between(chunk_start.isoformat(), chunk_end.isoformat())
+        
+        booking_date = chunk_start
+        while booking_date <= chunk_end and len(found) < count:
+            template = get_slot_template(booking_date.weekday())
+            if template.mask:
+                date_key = booking_date.isoformat()
+                bits = free_start_bits(template, booking_date, booked_by_date.get(date_key, ()), resource_ids, duration, now)
+                for label in template.labels_for(bits)[:count - len(found)]:
+                    found.append((booking_date, label))
+            booking_date += timedelta(days=1)
+        chunk_start = chunk_end + timedelta(days=1)
+    return found
+
+@app.route("/api/next-available", methods=["GET"])
+def get_next_available():
+    """Earliest N bookable start times for a service, scanning forward from now"""
+    try:
+        count = request.args.get('count', 5, type=int)
+        if not 1 <= count <= NEXT_AVAILABLE_MAX_COUNT:
+            return jsonify({"success": False, "error": f"count must be 1-{NEXT_AVAILABLE_MAX_COUNT}"}), 400
+        
+        service_id = request.args.get('service_id', type=int)
+        service_name = request.args.get('service')
+        duration = SLOT_MINUTES
+        if service_id is not None or service_name:
+            found = storage.services.find(service_id=service_id, name=service_name)
+            if found is None:
+                return jsonify({"success": False, "error": "Unknown service"}), 400
+            service_id, duration = found
+        resource_ids = storage.resources.for_service(service_id)
+        
+        slots = [{
+            "date": booking_date.isoformat(),
+            "time": label,
+            "day_name": booking_date.strftime('%A').lower()
+        } for booking_date, label in next_free_starts(duration, resource_ids, count)]
+        
+        return jsonify({
+            "success": True,
+            "duration_minutes": duration,
+            "slots": slots,
+            "message": f"{len(slots)} beschikbare tijden gevonden" if slots else f"Geen beschikbare tijden in de komende {AVAILABILITY_MAX_DAYS} dagen"
+        })
+        
+    except Exception as e:
+        print(f"❌ Next available error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"success": False, "error": "Failed to find available times"}), 500
+
+def booking_confirmation_emails(booking_id, name, email, phone, service, date, time, message):
+    """(to, subject, html, text) of the customer confirmation and the admin notification"""
+    context = {
+        'booking_id': booking_id, 'name': name, 'email': email, 'phone': phone,
+        'service': service, 'date': date, 'time': time, 'message': message,
+        'calendar': generate_calendar_event_data(name, service, date, time, message, booking_id)
+    }
+    return [
+        (email, "Bevestiging afspraak - Autobedrijf Koree", *email_templates.render('booking_customer', **context)),
+        (ADMIN_EMAIL, f"Nieuwe afspraak: {name} - {date} {time}", *email_templates.render('booking_admin', **context)),
+    ]
+
+def batch_confirmation_emails(partner, contact_email, bookings):
+    """(to, subject, html, text) of one consolidated confirmation for a batch and its admin summary"""
+    context = {'partner': partner, 'contact_email': contact_email, 'bookings': bookings}
+    return [
+        (contact_email, f"Bevestiging {len(bookings)} afspraken - Autobedrijf Koree",
+         *email_templates.render('booking_batch', admin=False, **context)),
+        (ADMIN_EMAIL, f"{len(bookings)} nieuwe afspraken via {partner}",
+         *email_templates.render('booking_batch', admin=True, **context)),
+    ]
+
+@app.route("/api/slot-events", methods=["GET"])
+def slot_events_stream():
+    """Server-sent events: slot-taken / slot-freed for the watched ?dates=YYYY-MM-DD,..."""
+    from flask import Response
+    
+    try:
+        dates = sorted({datetime.strptime(value, '%Y-%m-%d').date().isoformat()
+                        for value in request.args.get('dates', '').split(',') if value})
+    except ValueError:
+        return jsonify({"success": False, "error": "dates must be YYYY-MM-DD,..."}), 400
+    if not 1 <= len(dates) <= SLOT_EVENTS_MAX_DATES:
+        return jsonify({"success": False, "error": f"Watch 1-{SLOT_EVENTS_MAX_DATES} dates"}), 400
+    
+    client_queue = slot_events.subscribe(dates)
+    if client_queue is None:
+        return jsonify({"success": False, "error": "Too many listeners, try again later"}), 503
+    
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            # Streams end after a while; EventSource reconnects on its own, which frees the worker meanwhile
+            deadline = time.monotonic() + SLOT_EVENTS_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    event = client_queue.get(timeout=SLOT_EVENTS_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {app.json.dumps(event)}\n\n"
+        finally:
+            slot_events.unsubscribe(client_queue, dates)
+    
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+BOOKING_EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+def check_booking(name, email, phone, service, date, time, message, find_service=None):
+    """(error, None) for an invalid booking request, else (None, (booking_date, service id, duration))
+
+    The checks of /api/book, shared with the bulk import and the batch API. Unknown
+    services are allowed with a single-slot duration; find_service(name) defaults to
+    a services query and can be swapped for a preloaded lookup.
+    """
+    # Validate required fields
+    if not all([name, email, phone, service, date, time]):
+        return "Alle velden zijn verplicht", None
+    # Special validation for "Overig" service
+    if service == "Overig" and not message.strip():
+        return "Voor de service 'Overig' is een beschrijving verplicht in het berichtenveld", None
+    # Validate email format
+    if not BOOKING_EMAIL_PATTERN.match(email):
+        return "Ongeldig email adres", None
+    
+    try:
+        booking_date = datetime.strptime(date, '%Y-%m-%d').date()
+    except ValueError:
+        return "Ongeldige datum", None
+    
+    # The whole service duration has to fit in the grid before closing time
+    found = find_service(service) if find_service else storage.services.find(name=service)
+    service_id, duration = found or (None, SLOT_MINUTES)
+    template = get_slot_template(booking_date.weekday())
+    if time not in template.index or minutes_of_day(time) + duration > template.closes:
+        return "Deze tijd past niet binnen de openingstijden", None
+    closed_reason = closure_index.overlaps(booking_date, minutes_of_day(time), minutes_of_day(time) + duration)
+    if closed_reason:
+        return f"We zijn gesloten op dit tijdstip: {closed_reason}", None
+    return None, (booking_date, service_id, duration)
+
+def prepare_booking_requests(rows):
+    """Validate booking dicts for BookingRepository.reserve_many(), with one services and one resources query
+
+    Returns one (request, error) pair per row; request is None when the row is invalid.
+    """
+    active_services = storage.services.list_active()
+    services = {row[1]: (row[0], row[3]) for row in active_services}
+    service_names = {row[0]: row[1] for row in active_services}
+    resources_by_service = {}
+    prepared = []
+    for row in rows:
+        fields = {field: str(row.get(field) or '').strip()
+                  for field in ('name', 'email', 'phone', 'service', 'date', 'time', 'message')}
+        if not fields['service'] and row.get('service_id') is not None:
+            fields['service'] = service_names.get(row['service_id'], '')
+        error, checked = check_booking(find_service=services.get, **fields)
+        if error:
+            prepared.append((None, error))
+            continue
+        _, service_id, duration = checked
+        if service_id not in resources_by_service:
+            resources_by_service[service_id] = storage.resources.for_service(service_id)
+        prepared.append((dict(fields, duration_minutes=duration, resource_ids=resources_by_service[service_id]), None))
+    return prepared
+
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24)) * 3600
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+def idempotency_hash(value):
+    """Compact fixed-size digest used for stored keys and request fingerprints"""
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:32]
+
+def idempotent_replay(key_hash, request_hash):
+    """Stored response for a repeated Idempotency-Key, a 422 for a reused key, or None"""
+    stored = storage.idempotency.find(key_hash)
+    if stored is None:
+        return None
+    if stored[0] != request_hash:
+        return jsonify({"error": "Idempotency-Key is al gebruikt voor een andere boeking"}), 422
+    
+    print("🔁 Replaying stored response for repeated Idempotency-Key")
+    response = app.response_class(stored[2], status=stored[1], mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
 @app.route("/api/book", methods=["POST"])
+@rate_limited(booking_limiter)
 def book_appointment():
     """Book an appointment"""
     try:
@@ -1537,225 +4146,58 @@ def book_appointment():
         time = request.form.get('time', '').strip()
         message = request.form.get('message', '').strip()
         
-        # Validate required fields
-        if not all([name, email, phone, service, date, time]):
-            return jsonify({"error": "Alle velden zijn verplicht"}), 400
-        # Special validation for "Overig" service
-        if service == "Overig" and not message.strip():
-            return jsonify({"error": "Voor de service 'Overig' is een beschrijving verplicht in het berichtenveld"}), 400
-        # Validate email format
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(email_pattern, email):
-            return jsonify({"error": "Ongeldig email adres"}), 400
+        # A retried submission with the same Idempotency-Key gets the original answer
+        idempotency_key = request.headers.get('Idempotency-Key', '').strip()
+        key_hash = request_hash = None
+        if idempotency_key:
+            if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                return jsonify({"error": "Ongeldige Idempotency-Key"}), 400
+            key_hash = idempotency_hash(idempotency_key)
+            request_hash = idempotency_hash('\x1f'.join([name, email, phone, service, date, time, message]))
+            replay = idempotent_replay(key_hash, request_hash)
+            if replay is not None:
+                return replay
         
         print(f"👤 Booking for: {name} ({email})")
         print(f"📅 Date/Time: {date} at {time}")
         print(f"🔧 Service: {service}")
         
-        connection = get_db_connection()
-        if connection is None:
-            return jsonify({"error": "Database verbinding mislukt"}), 500
-        
-        cursor = connection.cursor()
-        
-        # Check if time slot is still available
-        cursor.execute("""
-            SELECT COUNT(*) FROM bookings 
-            WHERE date = ? AND time = ? AND status != 'cancelled'
-        """, (date, time))
-        
-        if cursor.fetchone()[0] > 0:
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "Deze tijd is al geboekt"}), 400
+        error, checked = check_booking(name, email, phone, service, date, time, message)
+        if error:
+            return jsonify({"error": error}), 400
+        booking_date, service_id, duration = checked
+        
+        # Allocate a free bay that can do this service and insert it together with its confirmation
+        # emails and (with an Idempotency-Key) the response, so all three commit or none does
+        response_json = None
+        
+        def queue_confirmations(connection, booking_id):
+            nonlocal response_json
+            storage.outbox.enqueue(connection, booking_confirmation_emails(
+                booking_id, name, email, phone, service, date, time, message), booking_id)
+            response_json = app.json.dumps({
+                "message": f"Afspraak succesvol geboekt voor {booking_date.strftime('%d-%m-%Y')} om {time}. Bevestiging verzonden naar {email}.",
+                "booking_id": booking_id,
+                "calendar_links": generate_calendar_event_data(name, service, date, time, message, booking_id)
+            })
+            if key_hash:
+                storage.idempotency.store(connection, key_hash, request_hash, 200,
+                                          response_json, IDEMPOTENCY_TTL_SECONDS)
         
-        # Insert booking
-        cursor.execute("""
-            INSERT INTO bookings (name, email, phone, service, date, time, message, status) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, 'confirmed')
-        """, (name, email, phone, service, date, time, message))
+        booking_id = storage.bookings.reserve(name, email, phone, service, date, time, message, duration,
+                                              storage.resources.for_service(service_id), queue_confirmations)
         
-        booking_id = cursor.lastrowid
-        connection.commit()
-        cursor.close()
-        connection.close()
+        if booking_id is None:
+            # A concurrent duplicate may have just committed this very request
+            replay = idempotent_replay(key_hash, request_hash) if key_hash else None
+            return replay if replay is not None else (jsonify({"error": "Deze tijd is al geboekt"}), 400)
         
         print(f"✅ Booking saved with ID: {booking_id}")
         
-        # Generate calendar event data
-        calendar_data = generate_calendar_event_data(name, service, date, time, message, booking_id)
-        
-        # Send confirmation emails with calendar integration
-        try:
-            # Customer email with calendar buttons
-            customer_html = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <style>
-                    body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                    .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                    .header {{ background: #2c3e50; color: white; padding: 20px; text-align: center; }}
-                    .content {{ padding: 20px; background: #f9f9f9; }}
-                    .booking-details {{ background: white; padding: 15px; border-radius: 5px; margin: 15px 0; }}
-                    .calendar-buttons {{ background: #e8f5e8; padding: 20px; border-radius: 8px; margin: 20px 0; text-align: center; }}
-                    .calendar-btn {{ display: inline-block; padding: 12px 25px; margin: 5px; text-decoration: none; border-radius: 5px; font-weight: bold; color: white; }}
-                    .outlook-btn {{ background: #0078d4; }}
-                    .google-btn {{ background: #4285f4; }}
-                    .ics-btn {{ background: #28a745; }}
-                    .footer {{ text-align: center; padding: 20px; color: #666; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h1>🚗 Autobedrijf Koree</h1>
-                        <p>Bevestiging van uw afspraak</p>
-                    </div>
-                    <div class="content">
-                        <h2>Beste {name},</h2>
-                        <p>Bedankt voor uw afspraak bij Autobedrijf Koree. Hieronder vindt u de details:</p>
-                        
-                        <div class="booking-details">
-                            <h3>📅 Afspraak Details</h3>
-                            <p><strong>Service:</strong> {service}</p>
-                            <p><strong>Datum:</strong> {datetime.strptime(date, '%Y-%m-%d').strftime('%d-%m-%Y')}</p>
-                            <p><strong>Tijd:</strong> {time}</p>
-                            <p><strong>Naam:</strong> {name}</p>
-                            <p><strong>Telefoon:</strong> {phone}</p>
-                            <p><strong>Email:</strong> {email}</p>
-                            {f'<p><strong>Bericht:</strong> {message}</p>' if message else ''}
-                            {f'<div style="background: #fff3cd; padding: 10px; border-radius: 5px; margin: 10px 0;"><strong>ℹ️ Specifieke wensen ({service}):</strong><br>{message}</div>' if service == 'Overig' and message else ''}
-                        </div>
-                        
-                        <div class="calendar-buttons">
-                            <h3>📅 Voeg toe aan uw agenda</h3>
-                            <p>Klik op één van onderstaande knoppen om deze afspraak toe te voegen aan uw agenda:</p>
-                            
-                            <a href="{calendar_data['outlook_url']}" class="calendar-btn outlook-btn" target="_blank">
-                                📅 Outlook Agenda
-                            </a>
-                            
-                            <a href="{calendar_data['google_url']}" class="calendar-btn google-btn" target="_blank">
-                                📅 Google Agenda
-                            </a>
-                            
-                            <a href="{calendar_data['ics_url']}" class="calendar-btn ics-btn">
-                                📅 Download ICS Bestand
-                            </a>
-                        </div>
-                        
-                        <p>Wij zien u graag op de afgesproken tijd. Heeft u vragen? Bel ons op 010 592 8497.</p>
-                        
-                        <p><strong>🏢 Autobedrijf Koree</strong><br>
-                        Haven 45-48, 3143 BD Maassluis<br>
-                        📞 010 592 8497<br>
-                        📧 info@koreeautoservices.nl</p>
-                        
-                        <p>Met vriendelijke groet,<br>
-                        Team Autobedrijf Koree</p>
-                    </div>
-                    <div class="footer">
-                        <p>Haven 45-48, 3143 BD Maassluis | info@koreeautoservices.nl</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            send_email(email, "Bevestiging afspraak - Autobedrijf Koree", customer_html)
-            
-            # Admin email
-            admin_html = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <style>
-                    body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                    .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                    .header {{ background: #e74c3c; color: white; padding: 20px; text-align: center; }}
-                    .content {{ padding: 20px; background: #f9f9f9; }}
-                    .booking-details {{ background: white; padding: 15px; border-radius: 5px; margin: 15px 0; }}
-                    .calendar-section {{ background: #f0f8ff; padding: 20px; border-radius: 8px; margin: 20px 0; text-align: center; }}
-                    .calendar-btn {{ display: inline-block; padding: 12px 25px; margin: 5px; text-decoration: none; border-radius: 5px; font-weight: bold; color: white; }}
-                    .ics-btn {{ background: #28a745; }}
-                    .google-btn {{ background: #4285f4; }}
-                    .outlook-btn {{ background: #0078d4; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h1>🔔 Nieuwe Afspraak</h1>
-                        <p>Autobedrijf Koree</p>
-                    </div>
-                    <div class="content">
-                        <h2>Nieuwe afspraak geboekt!</h2>
-                        
-                        <div class="booking-details">
-                            <h3>📅 Afspraak Details</h3>
-                            <p><strong>Booking ID:</strong> {booking_id}</p>
-                            <p><strong>Service:</strong> {service}</p>
-                            <p><strong>Datum:</strong> {datetime.strptime(date, '%Y-%m-%d').strftime('%d-%m-%Y')}</p>
-                            <p><strong>Tijd:</strong> {time}</p>
-                            <p><strong>Naam:</strong> {name}</p>
-                            <p><strong>Telefoon:</strong> {phone}</p>
-                            <p><strong>Email:</strong> {email}</p>
-                            {f'<p><strong>Bericht:</strong> {message}</p>' if message else ''}
-                            {f'<div style="background: #e8f5e8; padding: 15px; border-radius: 5px; margin: 10px 0; border-left: 4px solid #28a745;"><strong>🔧 Specifieke Service Wens:</strong><br>{message}</div>' if service == 'Overig' and message else f'<p><strong>Bericht:</strong> {message}</p>' if message else ''}
-                        </div>
-                        
-                        <div class="calendar-section">
-                            <h3>📅 Voeg toe aan uw agenda</h3>
-                            <p>Klik op onderstaande knoppen om deze afspraak toe te voegen aan uw agenda:</p>
-                            
-                            <a href="{calendar_data['ics_url']}" class="calendar-btn ics-btn">
-                                📥 Download ICS Bestand
-                            </a>
-                            
-                            <a href="{calendar_data['google_url']}" class="calendar-btn google-btn" target="_blank">
-                                📅 Google Agenda
-                            </a>
-                            
-                            <a href="{calendar_data['outlook_url']}" class="calendar-btn outlook-btn" target="_blank">
-                                📅 Outlook Web
-                            </a>
-                            
-                            <p style="margin-top: 15px; font-size: 13px; color: #666;">
-                                <strong>💡 Tip:</strong> Het ICS bestand werkt met alle agenda applicaties
-                            </p>
-                        </div>
-                        
-                        <div style="background: #fff3cd; padding: 15px; border-radius: 5px; margin: 15px 0;">
-                            <h4 style="margin: 0 0 10px 0;">📋 Actie vereist:</h4>
-                            <ul style="margin: 0; padding-left: 20px;">
-                                <li>✅ Bevestig de afspraak in uw agenda</li>
-                                <li>📞 Bel klant indien nodig: {phone}</li>
-                                <li>📧 Klant heeft bevestiging ontvangen op: {email}</li>
-                            </ul>
-                        </div>
-                        
-                        <p style="margin-top: 20px;">
-                            <strong>Deze afspraak is automatisch bevestigd en de klant heeft een bevestigingsmail ontvangen.</strong>
-                        </p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-
-            send_email(ADMIN_EMAIL, f"Nieuwe afspraak: {name} - {date} {time}", admin_html)
-        except Exception as email_error:
-            print(f"⚠️ Email error: {email_error}")
-            # Don't fail the booking if email fails
+        # Confirmation emails were queued in the booking transaction; the outbox worker sends them
+        email_outbox.wake()
         
-        return jsonify({
-            "message": f"Afspraak succesvol geboekt voor {datetime.strptime(date, '%Y-%m-%d').strftime('%d-%m-%Y')} om {time}. Bevestiging verzonden naar {email}.",
-            "booking_id": booking_id,
-            "calendar_links": calendar_data
-        })
+        return app.response_class(response_json, mimetype='application/json')
         
     except Exception as e:
         print(f"❌ Booking error: {str(e)}")
@@ -1763,6 +4205,127 @@ def book_appointment():
         traceback.print_exc()
         return jsonify({"error": "Er is een fout opgetreden bij het boeken"}), 500
 
+BATCH_MAX_ITEMS = 50
+
+def partner_for_request():
+    """Partner name for a valid X-API-Key header, or None"""
+    import hmac
+    
+    supplied = request.headers.get('X-API-Key', '')
+    for partner, key in PARTNER_API_KEYS.items():
+        if supplied and hmac.compare_digest(supplied, key):
+            return partner
+    return None
+
+@app.route("/api/book/batch", methods=["POST"])
+@rate_limited(booking_limiter)
+def book_batch():
+    """Book several appointments in one call (partners / fleet customers)
+
+    JSON: {"bookings": [{name, email, phone, service or service_id, date, time, message}, ...],
+           "mode": "all_or_nothing" (default) | "best_effort", "contact_email": optional}
+    All items are validated together and reserved in one transaction; the response
+    has a result per item and one consolidated confirmation goes to contact_email
+    (default: the first item's email) plus one to the admin.
+    """
+    try:
+        partner = partner_for_request()
+        if partner is None:
+            return jsonify({"success": False, "error": "Invalid or missing X-API-Key"}), 401
+        
+        payload = request.get_json(silent=True)
+        items = payload.get('bookings') if isinstance(payload, dict) else None
+        mode = payload.get('mode', 'all_or_nothing') if isinstance(payload, dict) else None
+        if not isinstance(items, list) or not 1 <= len(items) <= BATCH_MAX_ITEMS or not all(isinstance(item, dict) for item in items):
+            return jsonify({"success": False, "error": f"bookings must be a list of 1-{BATCH_MAX_ITEMS} objects"}), 400
+        if mode not in ('all_or_nothing', 'best_effort'):
+            return jsonify({"success": False, "error": "mode must be all_or_nothing or best_effort"}), 400
+        all_or_nothing = mode == 'all_or_nothing'
+        
+        # Same Idempotency-Key handling as /api/book, keyed per partner
+        idempotency_key = request.headers.get('Idempotency-Key', '').strip()
+        key_hash = request_hash = None
+        if idempotency_key:
+            if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                return jsonify({"success": False, "error": "Invalid Idempotency-Key"}), 400
+            key_hash = idempotency_hash(f"batch:{partner}:{idempotency_key}")
+            request_hash = idempotency_hash(app.json.dumps(payload))
+            replay = idempotent_replay(key_hash, request_hash)
+            if replay is not None:
+                return replay
+        
+        prepared = prepare_booking_requests(items)
+        results = [{"index": index, "status": "error", "error": error} if error else None
+                   for index, (booking, error) in enumerate(prepared)]
+        valid = [(index, booking) for index, (booking, error) in enumerate(prepared) if booking is not None]
+        contact_email = str(payload.get('contact_email') or '').strip() or str(items[0].get('email') or '').strip()
+        if not BOOKING_EMAIL_PATTERN.match(contact_email):
+            return jsonify({"success": False, "error": "Invalid contact_email"}), 400
+        
+        def build_response(booking_ids):
+            # Without a booking id a valid item either had no free slot or was rolled back with the rest
+            failed = all_or_nothing and not all(booking_ids)
+            for (index, booking), booking_id in zip(valid, booking_ids):
+                if booking_id is not None:
+                    results[index] = {"index": index, "status": "booked", "booking_id": booking_id,
+                                      "date": booking['date'], "time": booking['time'], "service": booking['service']}
+                elif failed and index not in conflict_indexes:
+                    results[index] = {"index": index, "status": "rolled_back", "error": "Niet geboekt omdat andere afspraken faalden"}
+                else:
+                    results[index] = {"index": index, "status": "conflict", "error": "Deze tijd is al geboekt",
+                                      "date": booking['date'], "time": booking['time']}
+            booked = sum(1 for result in results if result['status'] == 'booked')
+            return {
+                "success": booked > 0 and (booked == len(items) or not all_or_nothing),
+                "mode": mode,
+                "booked": booked,
+                "failed": len(items) - booked,
+                "results": results,
+                "message": f"{booked} van {len(items)} afspraken geboekt." + (f" Bevestiging verzonden naar {contact_email}." if booked else "")
+            }
+        
+        response_json = None
+        conflict_indexes = set()
+        
+        def queue_confirmation(connection, inserted):
+            # One mail for the whole batch, committed together with the bookings (and the stored response)
+            nonlocal response_json
+            if not inserted:
+                return
+            ids = {id(booking): booking_id for booking, booking_id in inserted}
+            storage.outbox.enqueue(connection, batch_confirmation_emails(
+                partner, contact_email, [dict(booking, booking_id=booking_id) for booking, booking_id in inserted]))
+            response_json = app.json.dumps(build_response([ids.get(id(booking)) for index, booking in valid]))
+            if key_hash:
+                storage.idempotency.store(connection, key_hash, request_hash, 200, response_json, IDEMPOTENCY_TTL_SECONDS)
+        
+        if valid and not (all_or_nothing and len(valid) < len(items)):
+            booking_ids, conflicts = storage.bookings.reserve_many(
+                [booking for index, booking in valid], all_or_nothing, queue_confirmation)
+            conflict_indexes.update(valid[position][0] for position in conflicts)
+        else:
+            # all_or_nothing with invalid items: nothing is reserved
+            booking_ids = [None] * len(valid)
+        
+        if response_json is None:
+            # A concurrent duplicate may have just committed this very request
+            replay = idempotent_replay(key_hash, request_hash) if key_hash else None
+            if replay is not None:
+                return replay
+            response = build_response(booking_ids)
+            print(f"⚠️ Batch from {partner}: nothing booked ({response['failed']} failed)")
+            return jsonify(response), 400 if any(result['status'] == 'error' for result in results) else 409
+        
+        print(f"✅ Batch from {partner}: {sum(1 for booking_id in booking_ids if booking_id)} of {len(items)} booked")
+        email_outbox.wake()
+        return app.response_class(response_json, mimetype='application/json')
+        
+    except Exception as e:
+        print(f"❌ Batch booking error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"success": False, "error": "Er is een fout opgetreden bij het boeken"}), 500
+
 @app.route('/admin')
 def admin_redirect():
     """Redirect /admin to login or dashboard"""
@@ -1780,6 +4343,7 @@ def admin_login():
     return render_template('admin_login.html')
 
 @app.route('/admin/authenticate', methods=['POST'])
+@rate_limited(login_limiter, form_template='admin_login.html')
 def admin_authenticate():
     try:
         username = request.form.get('username', '').strip()
@@ -1831,67 +4395,14 @@ def admin_logout():
 def admin_dashboard():
     """Admin dashboard with APK statistics"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database connection failed', 'error')
-            return redirect(url_for('admin_login'))
-        
-        cursor = connection.cursor()
+        today = datetime.now().date()
         
         # Existing booking stats
-        cursor.execute("SELECT COUNT(*) FROM bookings")
-        total_bookings = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM bookings 
-            WHERE date >= date('now', '-7 days')
-        """)
-        recent_bookings = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM bookings 
-            WHERE date >= date('now') AND status = 'confirmed'
-        """)
-        upcoming_bookings = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT id, name, email, phone, service, date, time, status, created_at 
-            FROM bookings 
-            ORDER BY created_at DESC 
-            LIMIT 8
-        """)
-        recent_bookings_details = cursor.fetchall()
-        
-        # APK statistics (check if table exists first)
-        try:
-            cursor.execute("SELECT COUNT(*) FROM apk_clients WHERE is_active = 1")
-            apk_result = cursor.fetchone()
-            total_apk_clients = apk_result[0] if apk_result else 0
-            
-            cursor.execute("""
-                SELECT COUNT(*) FROM apk_clients 
-                WHERE is_active = 1 AND apk_expiry_date IS NOT NULL
-                AND DATE(apk_expiry_date) >= DATE('now') 
-                AND DATE(apk_expiry_date) <= DATE('now', '+30 days')
-            """)
-            apk_result = cursor.fetchone()
-            apk_expiring_soon = apk_result[0] if apk_result else 0
-            
-            cursor.execute("""
-                SELECT COUNT(*) FROM apk_clients 
-                WHERE is_active = 1 AND apk_expiry_date IS NOT NULL
-                AND DATE(apk_expiry_date) < DATE('now')
-            """)
-            apk_result = cursor.fetchone()
-            apk_expired = apk_result[0] if apk_result else 0
-        except:
-            # APK tables don't exist yet
-            total_apk_clients = 0
-            apk_expiring_soon = 0
-            apk_expired = 0
+        total_bookings, recent_bookings, upcoming_bookings = storage.bookings.dashboard_counts(today)
+        recent_bookings_details = storage.bookings.recent(8)
         
-        cursor.close()
-        connection.close()
+        # APK statistics
+        total_apk_clients, apk_expiring_soon, apk_expired = storage.apk_clients.dashboard_counts(today)
         
         stats = {
             'total_bookings': total_bookings,
@@ -1914,58 +4425,19 @@ def admin_dashboard():
         return render_template('admin_dashboard.html', 
                              stats=stats, 
                              apk_stats=apk_stats,
-                             admin_info=admin_info)
+                             admin_info=admin_info,
+                             snapshots=list_db_snapshots())
         
     except Exception as e:
         print(f"❌ Dashboard error: {e}")
         flash('Dashboard error occurred', 'error')
         return redirect(url_for('admin_login'))
-def upgrade_database_schema():
-    """Upgrade database schema to add missing columns"""
-    try:
-        connection = get_db_connection()
-        if connection is None:
-            return False
-        
-        cursor = connection.cursor()
-        
-        # Check if duration_minutes column exists in services table
-        cursor.execute("PRAGMA table_info(services)")
-        columns = [row[1] for row in cursor.fetchall()]
-        
-        if 'duration_minutes' not in columns:
-            print("🔧 Adding duration_minutes column to services table...")
-            cursor.execute("ALTER TABLE services ADD COLUMN duration_minutes INTEGER DEFAULT 60")
-            connection.commit()
-            print("✅ duration_minutes column added successfully")
-        
-        cursor.close()
-        connection.close()
-        return True
-        
-    except Exception as e:
-        print(f"❌ Database upgrade error: {e}")
-        return False    
 @app.route('/admin/bookings')
 @require_admin_auth
 def admin_bookings():
     """View all bookings"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database connection failed', 'error')
-            return redirect(url_for('admin_dashboard'))
-        
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT id, name, email, phone, service, date, time, message, status, created_at 
-            FROM bookings 
-            ORDER BY date DESC, time DESC
-        """)
-        
-        bookings = cursor.fetchall()
-        cursor.close()
-        connection.close()
+        bookings = storage.bookings.list_all()
         
         return render_template('admin_bookings.html', bookings=bookings)
         
@@ -1974,35 +4446,287 @@ def admin_bookings():
         flash('Error loading bookings', 'error')
         return redirect(url_for('admin_dashboard'))
 
+IMPORT_MAX_ROWS = 10000
+IMPORT_FIELD_ALIASES = {'naam': 'name', 'telefoon': 'phone', 'datum': 'date', 'tijd': 'time', 'bericht': 'message'}
+
+def parse_booking_import(raw, filename=''):
+    """Rows of a CSV (with a header line) or JSON ([...] or {"bookings": [...]}) upload as dicts
+
+    Headers are matched case-insensitively, so a file from /admin/export-csv can be
+    imported again; cancelled rows in such a file are skipped. Dates may also be
+    DD-MM-YYYY and times H:MM, as phone diary exports often have them.
+    """
+    import csv
+    from io import StringIO
+    
+    text = raw.decode('utf-8-sig') if isinstance(raw, bytes) else raw
+    if filename.lower().endswith('.json') or text.lstrip().startswith(('[', '{')):
+        data = app.json.loads(text)
+        rows = data.get('bookings', []) if isinstance(data, dict) else data
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("JSON moet een lijst met boekingen zijn")
+    else:
+        rows = list(csv.DictReader(StringIO(text), delimiter=';' if text.split('\n', 1)[0].count(';') > text.split('\n', 1)[0].count(',') else ','))
+    
+    parsed = []
+    for row in rows:
+        fields = {}
+        for key, value in row.items():
+            if key is None:
+                continue
+            key = key.strip().lower().replace(' ', '_')
+            fields[IMPORT_FIELD_ALIASES.get(key, key)] = value if value is not None else ''
+        if str(fields.get('status', '')).strip().lower() == 'cancelled':
+            fields['skip'] = True
+        date_value = str(fields.get('date') or '').strip()
+        if re.fullmatch(r'\d{1,2}-\d{1,2}-\d{4}', date_value):
+            day, month, year = date_value.split('-')
+            fields['date'] = f"{year}-{int(month):02d}-{int(day):02d}"
+        time_value = str(fields.get('time') or '').strip()
+        if re.fullmatch(r'\d{1,2}:\d{2}(:\d{2})?', time_value):
+            fields['time'] = f"{int(time_value.split(':')[0]):02d}:{time_value.split(':')[1]}"
+        parsed.append(fields)
+    return parsed
+
+@app.route('/admin/import-bookings', methods=['GET', 'POST'])
+@require_admin_auth
+def admin_import_bookings():
+    """Bulk import bookings from CSV/JSON: validated per row, conflicts checked in memory, one transaction"""
+    if request.method == 'GET':
+        return render_template('admin_import_bookings.html', report=None)
+    
+    want_json = request.args.get('format') == 'json'
+    try:
+        upload = request.files.get('file')
+        if upload and upload.filename:
+            rows = parse_booking_import(upload.read(), upload.filename)
+        else:
+            rows = parse_booking_import(request.form.get('data', ''))
+    except Exception as e:
+        print(f"❌ Booking import parse error: {e}")
+        if want_json:
+            return jsonify({"success": False, "error": f"Bestand kon niet gelezen worden: {e}"}), 400
+        flash(f'Bestand kon niet gelezen worden: {e}', 'error')
+        return redirect(url_for('admin_import_bookings'))
+    
+    if not rows or len(rows) > IMPORT_MAX_ROWS:
+        if want_json:
+            return jsonify({"success": False, "error": f"1-{IMPORT_MAX_ROWS} rijen per import"}), 400
+        flash(f'Een import moet 1-{IMPORT_MAX_ROWS} rijen bevatten', 'error')
+        return redirect(url_for('admin_import_bookings'))
+    
+    try:
+        started = time.perf_counter()
+        send_emails = request.form.get('send_emails') == 'on'
+        all_or_nothing = request.form.get('all_or_nothing') == 'on'
+        
+        report = [{"row": number, "status": "skipped", "message": "Geannuleerd in bronbestand", "booking_id": None}
+                  if row.get('skip') else None for number, row in enumerate(rows, start=1)]
+        prepared = prepare_booking_requests([row for row in rows if not row.get('skip')])
+        numbers = [number for number, row in enumerate(rows, start=1) if not row.get('skip')]
+        for number, (booking, error) in zip(numbers, prepared):
+            if error:
+                report[number - 1] = {"row": number, "status": "error", "message": error, "booking_id": None}
+        
+        valid = [(number, booking) for number, (booking, error) in zip(numbers, prepared) if booking is not None]
+        
+        def queue_confirmations(connection, inserted):
+            # Only the customers get mail; the admin is the one importing
+            for booking, booking_id in inserted:
+                storage.outbox.enqueue(connection, booking_confirmation_emails(
+                    booking_id, booking['name'], booking['email'], booking['phone'], booking['service'],
+                    booking['date'], booking['time'], booking['message'])[:1], booking_id)
+        
+        if all_or_nothing and len(valid) < len(prepared):
+            # Invalid rows already sink an all-or-nothing import; nothing to reserve
+            booking_ids, conflicts = [None] * len(valid), []
+        else:
+            booking_ids, conflicts = storage.bookings.reserve_many([booking for _, booking in valid], all_or_nothing,
+                                                                   queue_confirmations if send_emails else None)
+        
+        conflicts = set(conflicts)
+        for index, ((number, booking), booking_id) in enumerate(zip(valid, booking_ids)):
+            if booking_id is not None:
+                entry = {"status": "imported", "message": f"{booking['date']} {booking['time']}"}
+            elif index in conflicts:
+                entry = {"status": "conflict", "message": f"{booking['date']} {booking['time']} is al bezet"}
+            else:
+                entry = {"status": "rolled_back", "message": "Niet geïmporteerd: andere rijen hadden fouten (alles of niets)"}
+            report[number - 1] = dict(entry, row=number, booking_id=booking_id)
+        
+        if send_emails:
+            email_outbox.wake()
+        
+        counts = {}
+        for entry in report:
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        elapsed = time.perf_counter() - started
+        print(f"📥 Booking import: {len(rows)} rows, {counts} in {elapsed:.2f}s")
+        
+        if want_json:
+            return jsonify({"success": True, "counts": counts, "seconds": round(elapsed, 3), "rows": report})
+        return render_template('admin_import_bookings.html', report=report, counts=counts, seconds=elapsed)
+        
+    except Exception as e:
+        print(f"❌ Booking import error: {e}")
+        import traceback
+        traceback.print_exc()
+        if want_json:
+            return jsonify({"success": False, "error": "Import mislukt"}), 500
+        flash('Import mislukt - er is niets opgeslagen', 'error')
+        return redirect(url_for('admin_import_bookings'))
+
+_snapshot_lock = threading.Lock()
+
+def create_db_snapshot(compress=SNAPSHOT_COMPRESS):
+    """Write a consistent copy of the live database into SNAPSHOT_DIR using the sqlite3 backup API
+
+    The copy is made SNAPSHOT_PAGES_PER_STEP pages at a time with a short sleep between
+    steps, so writers are never blocked for long, and it includes committed WAL content.
+    """
+    import gzip
+    import shutil
+
+    if database.dialect != 'sqlite':
+        print("ℹ️ Snapshots are only made for the SQLite backend - use pg_dump for PostgreSQL")
+        return None
+
+    with _snapshot_lock:
+        try:
+            os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')[:-3]
+            snapshot_name = f'koree_snapshot_{timestamp}.db' + ('.gz' if compress else '')
+            snapshot_path = os.path.join(SNAPSHOT_DIR, snapshot_name)
+            partial_path = os.path.join(SNAPSHOT_DIR, f'.koree_snapshot_{timestamp}.partial')
+
+            started = time.perf_counter()
+            source = get_db_connection()
+            if source is None:
+                return None
+
+            target = sqlite3.connect(partial_path)
+            try:
+                source.backup(target, pages=SNAPSHOT_PAGES_PER_STEP, sleep=0.005)
+            finally:
+                target.close()
+                source.close()
+
+            if compress:
+                with open(partial_path, 'rb') as raw, gzip.open(partial_path + '.gz', 'wb', compresslevel=6) as packed:
+                    shutil.copyfileobj(raw, packed, 1024 * 1024)
+                os.remove(partial_path)
+                partial_path += '.gz'
+
+            # Only complete snapshots ever carry the final name
+            os.replace(partial_path, snapshot_path)
+
+            elapsed = time.perf_counter() - started
+            print(f"💾 Database snapshot created: {snapshot_name} ({os.path.getsize(snapshot_path)} bytes, {elapsed:.2f}s)")
+
+            rotate_db_snapshots()
+            return snapshot_path
+
+        except Exception as e:
+            print(f"❌ Snapshot error: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+
+def list_db_snapshots():
+    """Return available snapshots, newest first"""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+
+    snapshots = []
+    for filename in os.listdir(SNAPSHOT_DIR):
+        if filename.startswith('koree_snapshot_') and (filename.endswith('.db') or filename.endswith('.db.gz')):
+            path = os.path.join(SNAPSHOT_DIR, filename)
+            snapshots.append({
+                'name': filename,
+                'path': path,
+                'size': os.path.getsize(path),
+                'created_at': datetime.fromtimestamp(os.path.getmtime(path)),
+                'compressed': filename.endswith('.gz')
+            })
+
+    snapshots.sort(key=lambda snapshot: snapshot['name'], reverse=True)
+    return snapshots
+
+def rotate_db_snapshots(keep=SNAPSHOT_KEEP):
+    """Delete all but the newest `keep` snapshots"""
+    for snapshot in list_db_snapshots()[keep:]:
+        try:
+            os.remove(snapshot['path'])
+            print(f"🗑️ Removed old snapshot: {snapshot['name']}")
+        except OSError as e:
+            print(f"⚠️ Could not remove snapshot {snapshot['name']}: {e}")
+
+def send_db_snapshot(snapshot, want_compressed):
+    """Stream a snapshot, decompressing on the fly if the admin asked for a plain .db"""
+    from flask import send_file, Response
+
+    if snapshot['compressed'] and not want_compressed:
+        import gzip
+
+        def generate():
+            with gzip.open(snapshot['path'], 'rb') as packed:
+                while True:
+                    chunk = packed.read(256 * 1024)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        return Response(
+            generate(),
+            mimetype='application/x-sqlite3',
+            headers={"Content-Disposition": f"attachment; filename={snapshot['name'][:-3]}"}
+        )
+
+    return send_file(
+        snapshot['path'],
+        as_attachment=True,
+        download_name=snapshot['name'],
+        mimetype='application/gzip' if snapshot['compressed'] else 'application/x-sqlite3'
+    )
+
 @app.route('/admin/download-db')
 @require_admin_auth
 def download_database():
-    """Download database file"""
+    """Download the newest database snapshot (made on demand if it is missing or stale)"""
     try:
-        from flask import send_file
-        import os
+        want_compressed = request.args.get('format', 'gz' if SNAPSHOT_COMPRESS else 'db') == 'gz'
+        snapshots = list_db_snapshots()
+        latest = snapshots[0] if snapshots else None
+        
+        is_stale = latest is None or (datetime.now() - latest['created_at']) > timedelta(minutes=SNAPSHOT_MAX_AGE_MINUTES)
+        if is_stale or request.args.get('fresh') == '1':
+            if create_db_snapshot(compress=want_compressed) is None:
+                flash('Snapshot could not be created', 'error')
+                return redirect(url_for('admin_dashboard'))
+            latest = list_db_snapshots()[0]
         
-        if os.path.exists(DB_FILE):
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            download_name = f'koree_database_{timestamp}.db'
-            
-            print(f"📥 Database download by admin")
-            
-            return send_file(
-                DB_FILE,
-                as_attachment=True,
-                download_name=download_name,
-                mimetype='application/x-sqlite3'
-            )
-        else:
-            flash('Database file not found', 'error')
-            return redirect(url_for('admin_dashboard'))
+        print(f"📥 Database download by admin: {latest['name']}")
+        return send_db_snapshot(latest, want_compressed)
             
     except Exception as e:
         print(f"❌ Download error: {e}")
         flash('Download error occurred', 'error')
         return redirect(url_for('admin_dashboard'))
 
+@app.route('/admin/download-db/<snapshot_name>')
+@require_admin_auth
+def download_database_snapshot(snapshot_name):
+    """Download one specific snapshot from the rotating set"""
+    snapshot = next((s for s in list_db_snapshots() if s['name'] == snapshot_name), None)
+    if snapshot is None:
+        flash('Snapshot not found', 'error')
+        return redirect(url_for('admin_dashboard'))
+    
+    want_compressed = request.args.get('format', 'gz') == 'gz'
+    print(f"📥 Snapshot download by admin: {snapshot_name}")
+    return send_db_snapshot(snapshot, want_compressed)
+
 @app.route('/admin/export-csv')
 @require_admin_auth
 def export_bookings_csv():
@@ -2012,21 +4736,7 @@ def export_bookings_csv():
         from io import StringIO
         from flask import Response
         
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database connection failed', 'error')
-            return redirect(url_for('admin_dashboard'))
-        
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT id, name, email, phone, service, date, time, message, status, created_at 
-            FROM bookings 
-            ORDER BY created_at DESC
-        """)
-        
-        bookings = cursor.fetchall()
-        cursor.close()
-        connection.close()
+        bookings = storage.bookings.list_for_export()
         
         # Create CSV
         output = StringIO()
@@ -2060,6 +4770,9 @@ def export_bookings_csv():
 @app.route('/debug/database')
 def debug_database():
     """Debug database information"""
+    if database.dialect != 'sqlite':
+        return jsonify({'backend': database.dialect, 'stats': database.get_stats()})
+    
     try:
         connection = get_db_connection()
         if connection is None:
@@ -2126,81 +4839,62 @@ def debug_database():
     except Exception as e:
         print(f"❌ Debug error: {e}")
         return f"Debug error: {str(e)}", 500
+@app.route('/debug/db-pool')
+@require_admin_auth
+def debug_db_pool():
+    """Connection pool counters for the active storage backend"""
+    return jsonify(database.get_stats())
+
+@app.route('/debug/availability-cache')
+@require_admin_auth
+def debug_availability_cache():
+    """Availability cache hit/miss/304 counters"""
+    return jsonify(availability_cache.get_stats())
+
+@app.route('/debug/smtp-pool')
+@require_admin_auth
+def debug_smtp_pool():
+    """SMTP handshakes vs messages sent and per-message send latency"""
+    return jsonify(smtp_pool.get_stats())
+
+@app.route('/debug/email-outbox')
+@require_admin_auth
+def debug_email_outbox():
+    """Outbox queue sizes per status and sender counters"""
+    return jsonify(email_outbox.get_stats())
+
+@app.route('/debug/slot-events')
+@require_admin_auth
+def debug_slot_events():
+    """Slot event subscribers and delivery counters"""
+    return jsonify(slot_events.get_stats())
+
+@app.route('/debug/rdw-cache')
+@require_admin_auth
+def debug_rdw_cache():
+    """RDW lookups served from memory/cache vs fetched, coalesced and failed"""
+    return jsonify(rdw_client.get_stats())
+
+@app.route('/debug/rate-limits')
+@require_admin_auth
+def debug_rate_limits():
+    """Allowed vs limited requests per rate limiter"""
+    return jsonify([booking_limiter.get_stats(), login_limiter.get_stats()])
+
 # APK Management Routes
 @app.route('/admin/apk-clients')
 @require_admin_auth
 def admin_apk_clients():
     """View all APK clients"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database verbinding mislukt', 'error')
-            return redirect(url_for('admin_dashboard'))
-        
-        cursor = connection.cursor()
-        
-        # Check if APK tables exist first
-        try:
-            cursor.execute("""
-                SELECT name FROM sqlite_master 
-                WHERE type='table' AND name='apk_clients'
-            """)
-            
-            if not cursor.fetchone():
-                # APK tables don't exist, initialize them
-                print("🔧 APK tables not found, initializing...")
-                cursor.close()
-                connection.close()
-                
-                # Initialize APK database
-                if init_apk_database():
-                    flash('APK systeem succesvol geïnitialiseerd', 'success')
-                else:
-                    flash('Fout bij initialiseren APK systeem', 'error')
-                    return redirect(url_for('admin_dashboard'))
-                
-                # Get new connection after initialization
-                connection = get_db_connection()
-                if connection is None:
-                    flash('Database verbinding mislukt na initialisatie', 'error')
-                    return redirect(url_for('admin_dashboard'))
-                cursor = connection.cursor()
-        except Exception as table_check_error:
-            print(f"❌ Table check error: {table_check_error}")
-            cursor.close()
-            connection.close()
-            
-            # Try to initialize
-            if init_apk_database():
-                flash('APK systeem geïnitialiseerd', 'success')
-                connection = get_db_connection()
-                if connection is None:
-                    flash('Database verbinding mislukt', 'error')
-                    return redirect(url_for('admin_dashboard'))
-                cursor = connection.cursor()
-            else:
-                flash('Kan APK systeem niet initialiseren', 'error')
-                return redirect(url_for('admin_dashboard'))
-        
-        # Now safely query the APK clients
         try:
-            cursor.execute("""
-                SELECT id, name, email, phone, licence_plate, car_brand, car_model, 
-                       apk_expiry_date, last_reminder_sent, reminder_count, is_active, created_at
-                FROM apk_clients 
-                ORDER BY apk_expiry_date ASC, created_at DESC
-            """)
-            
-            apk_clients = cursor.fetchall()
+            apk_clients = storage.apk_clients.list_all()
         except Exception as query_error:
             print(f"❌ Query error: {query_error}")
             # If query fails, return empty list
             apk_clients = []
             flash('Kan APK klanten niet laden - lege lijst getoond', 'warning')
         
-        cursor.close()
-        connection.close()
-        
         # Calculate days until expiry for each client
         today = datetime.now().date()
         clients_with_status = []
@@ -2285,42 +4979,7 @@ def admin_create_apk_client():
             return redirect(url_for('admin_add_apk_client'))
         
         # Check if licence plate already exists
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database verbinding mislukt', 'error')
-            return redirect(url_for('admin_add_apk_client'))
-        
-        cursor = connection.cursor()
-        
-        # Check if APK table exists, if not initialize
-        cursor.execute("""
-            SELECT name FROM sqlite_master 
-            WHERE type='table' AND name='apk_clients'
-        """)
-        
-        if not cursor.fetchone():
-            cursor.close()
-            connection.close()
-            
-            # Initialize APK tables
-            if not init_apk_database():
-                flash('Fout bij initialiseren APK systeem', 'error')
-                return redirect(url_for('admin_add_apk_client'))
-            
-            # Get new connection
-            connection = get_db_connection()
-            if connection is None:
-                flash('Database verbinding mislukt na initialisatie', 'error')
-                return redirect(url_for('admin_add_apk_client'))
-            cursor = connection.cursor()
-        
-        # Check if licence plate already exists
-        cursor.execute("SELECT id FROM apk_clients WHERE licence_plate = ?", (licence_plate,))
-        existing = cursor.fetchone()
-        
-        if existing:
-            cursor.close()
-            connection.close()
+        if storage.apk_clients.plate_exists(licence_plate):
             flash('Kenteken bestaat al in de database', 'error')
             return redirect(url_for('admin_add_apk_client'))
         
@@ -2337,7 +4996,7 @@ def admin_create_apk_client():
             car_brand = vehicle_data.get('merk')
             car_model = vehicle_data.get('handelsbenaming')
             if vehicle_data.get('vervaldatum_apk'):
-                apk_expiry_date = vehicle_data.get('vervaldatum_apk')
+                apk_expiry_date = rdw_date(vehicle_data.get('vervaldatum_apk'))
             if vehicle_data.get('datum_eerste_toelating'):
                 try:
                     first_reg = vehicle_data.get('datum_eerste_toelating')
@@ -2346,14 +5005,7 @@ def admin_create_apk_client():
                     pass
         
         # Save to database
-        cursor.execute("""
-            INSERT INTO apk_clients (name, email, phone, licence_plate, car_brand, car_model, car_year, apk_expiry_date)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (name, email, phone, licence_plate, car_brand, car_model, car_year, apk_expiry_date))
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        storage.apk_clients.create(name, email, phone, licence_plate, car_brand, car_model, car_year, apk_expiry_date)
         
         success_msg = f'APK klant {name} succesvol toegevoegd!'
         if vehicle_data:
@@ -2377,21 +5029,7 @@ def admin_create_apk_client():
 def admin_services():
     """View and manage services"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database connection failed', 'error')
-            return redirect(url_for('admin_dashboard'))
-        
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT id, name, description, price, duration_minutes, active, created_at
-            FROM services 
-            ORDER BY name ASC
-        """)
-        
-        services = cursor.fetchall()
-        cursor.close()
-        connection.close()
+        services = storage.services.list_all()
         
         return render_template('admin_services.html', services=services)
         
@@ -2405,16 +5043,8 @@ def admin_services():
 def admin_toggle_service(service_id):
     """Toggle service active status"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database connection failed', 'error')
-            return redirect(url_for('admin_services'))
-        
-        cursor = connection.cursor()
-        cursor.execute("UPDATE services SET active = NOT active WHERE id = ?", (service_id,))
-        connection.commit()
-        cursor.close()
-        connection.close()
+        storage.services.toggle_active(service_id)
+        availability_cache.invalidate_all()
         
         flash('Service status updated', 'success')
         
@@ -2423,6 +5053,141 @@ def admin_toggle_service(service_id):
         flash('Error updating service', 'error')
     
     return redirect(url_for('admin_services'))
+@app.route('/admin/resources')
+@require_admin_auth
+def admin_resources():
+    """View and manage work bays / mechanics"""
+    try:
+        resources = storage.resources.list_all()
+        services = storage.services.list_active()
+        
+        return render_template('admin_resources.html', resources=resources, services=services)
+        
+    except Exception as e:
+        print(f"❌ Admin resources error: {e}")
+        flash('Error loading resources', 'error')
+        return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/create-resource', methods=['POST'])
+@require_admin_auth
+def admin_create_resource():
+    """Add a work bay / mechanic, optionally restricted to some services"""
+    try:
+        name = request.form.get('name', '').strip()
+        kind = request.form.get('kind', 'bay')
+        service_ids = [int(service_id) for service_id in request.form.getlist('service_ids')]
+        
+        if not name:
+            flash('Naam is verplicht', 'error')
+        elif kind not in ('bay', 'mechanic'):
+            flash('Ongeldig type', 'error')
+        else:
+            storage.resources.create(name, kind, service_ids)
+            availability_cache.invalidate_all()
+            flash(f'Werkplek {name} toegevoegd', 'success')
+        
+    except Exception as e:
+        print(f"❌ Create resource error: {e}")
+        flash('Fout bij toevoegen werkplek (bestaat de naam al?)', 'error')
+    
+    return redirect(url_for('admin_resources'))
+
+@app.route('/admin/toggle-resource/<int:resource_id>')
+@require_admin_auth
+def admin_toggle_resource(resource_id):
+    """Toggle resource active status"""
+    try:
+        storage.resources.toggle_active(resource_id)
+        availability_cache.invalidate_all()
+        flash('Werkplek status bijgewerkt', 'success')
+        
+    except Exception as e:
+        print(f"❌ Toggle resource error: {e}")
+        flash('Error updating resource', 'error')
+    
+    return redirect(url_for('admin_resources'))
+
+@app.route('/admin/cancel-booking/<int:booking_id>')
+@require_admin_auth
+def admin_cancel_booking(booking_id):
+    """Cancel a booking; its slot becomes bookable again"""
+    try:
+        if storage.bookings.cancel(booking_id):
+            flash(f'Afspraak #{booking_id} geannuleerd', 'success')
+        else:
+            flash(f'Afspraak #{booking_id} was al geannuleerd', 'warning')
+        
+    except Exception as e:
+        print(f"❌ Cancel booking error: {e}")
+        flash('Error cancelling booking', 'error')
+    
+    return redirect(url_for('admin_bookings'))
+
+@app.route('/admin/closures')
+@require_admin_auth
+def admin_closures():
+    """View and manage holidays / closures"""
+    try:
+        closures = storage.closures.list_all()
+        return render_template('admin_closures.html', closures=closures)
+        
+    except Exception as e:
+        print(f"❌ Admin closures error: {e}")
+        flash('Error loading closures', 'error')
+        return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/create-closure', methods=['POST'])
+@require_admin_auth
+def admin_create_closure():
+    """Close whole days, or part of the day when start and end time are given"""
+    try:
+        start_date = request.form.get('start_date', '').strip()
+        end_date = request.form.get('end_date', '').strip() or start_date
+        start_time = request.form.get('start_time', '').strip() or None
+        end_time = request.form.get('end_time', '').strip() or None
+        reason = request.form.get('reason', '').strip() or None
+        
+        try:
+            first_day = datetime.strptime(start_date, '%Y-%m-%d').date()
+            last_day = datetime.strptime(end_date, '%Y-%m-%d').date()
+            if start_time or end_time:
+                times_valid = minutes_of_day(start_time) < minutes_of_day(end_time)
+            else:
+                times_valid = True
+        except (AttributeError, ValueError):
+            first_day = last_day = None
+            times_valid = False
+        
+        if first_day is None or last_day < first_day:
+            flash('Ongeldige periode', 'error')
+        elif not times_valid:
+            flash('Vul zowel begin- als eindtijd in (begin voor eind), of laat beide leeg voor de hele dag', 'error')
+        else:
+            storage.closures.create(start_date, end_date, start_time, end_time, reason)
+            closure_index.reload(changed=True)
+            flash('Sluiting toegevoegd', 'success')
+        
+    except Exception as e:
+        print(f"❌ Create closure error: {e}")
+        flash('Fout bij toevoegen sluiting', 'error')
+    
+    return redirect(url_for('admin_closures'))
+
+@app.route('/admin/delete-closure/<int:closure_id>')
+@require_admin_auth
+def admin_delete_closure(closure_id):
+    """Delete closure"""
+    try:
+        storage.closures.delete(closure_id)
+        closure_index.reload(changed=True)
+        flash('Sluiting verwijderd', 'success')
+        
+    except Exception as e:
+        print(f"❌ Delete closure error: {e}")
+        flash('Fout bij verwijderen sluiting', 'error')
+    
+    return redirect(url_for('admin_closures'))
+
 @app.route('/admin/send-apk-reminders')
 @require_admin_auth
 def admin_send_apk_reminders():
@@ -2442,18 +5207,7 @@ def admin_send_apk_reminders():
 def admin_delete_apk_client(client_id):
     """Delete APK client"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database connection failed', 'error')
-            return redirect(url_for('admin_apk_clients'))
-        
-        cursor = connection.cursor()
-        cursor.execute("DELETE FROM apk_clients WHERE id = ?", (client_id,))
-        cursor.execute("DELETE FROM apk_reminder_log WHERE client_id = ?", (client_id,))
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        storage.apk_clients.delete(client_id)
         
         flash('APK client deleted successfully', 'success')
         
@@ -2468,190 +5222,120 @@ def admin_delete_apk_client(client_id):
 def admin_apk_reminder_logs():
     """View APK reminder logs"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database connection failed', 'error')
-            return redirect(url_for('admin_dashboard'))
-        
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT l.id, c.name, c.email, c.licence_plate, l.reminder_type, 
-                   l.email_subject, l.days_until_expiry, l.email_sent, l.sent_at, l.error_message
-            FROM apk_reminder_log l
-            JOIN apk_clients c ON l.client_id = c.id
-            ORDER BY l.sent_at DESC
-            LIMIT 100
-        """)
-        
-        logs = cursor.fetchall()
-        cursor.close()
-        connection.close()
+        logs = storage.apk_clients.recent_reminders(100)
+        runs = storage.apk_clients.recent_runs(10)
         
-        return render_template('admin_apk_logs.html', logs=logs)
+        return render_template('admin_apk_logs.html', logs=logs, runs=runs)
         
     except Exception as e:
         print(f"❌ APK logs error: {e}")
         flash('Error loading APK logs', 'error')
         return redirect(url_for('admin_dashboard'))
+def archive_log_rows(table, columns, rows):
+    """Copy rows into monthly archive files (ARCHIVE_DIR/koree_logs_YYYY-MM.db)
+
+    Rows keep their original id and are inserted with INSERT OR IGNORE, so a batch that
+    was archived but not yet deleted (crash, restart) is simply archived again.
+    """
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(str(row[columns.index('created_at')])[:7], []).append(tuple(row))
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    column_list = ', '.join(columns)
+    placeholders = ', '.join('?' * len(columns))
+
+    for month, month_rows in by_month.items():
+        archive = sqlite3.connect(os.path.join(ARCHIVE_DIR, f'koree_logs_{month}.db'))
+        try:
+            archive.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, {', '.join(columns[1:])})")
+            archive.executemany(f"INSERT OR IGNORE INTO {table} ({column_list}) VALUES ({placeholders})", month_rows)
+            archive.commit()
+        finally:
+            archive.close()
+
+    return sorted(by_month)
+
+def apply_log_retention(retention_days=LOG_RETENTION_DAYS, mode=LOG_RETENTION_MODE,
+                        batch_size=RETENTION_BATCH_SIZE, pause=0.05):
+    """Move visitor/admin login rows older than the retention window out of the main database
+
+    Works in batches of `batch_size` rows; each batch is deleted in its own short write
+    transaction with a short pause in between, so bookings never wait on the job for long.
+    Returns a report with rows moved per table, archive months touched and bytes freed.
+    Only one run at a time across processes: a run started while another one is busy
+    (nightly job vs /admin/log-retention in another worker) returns None.
+    """
+    if mode not in ('archive', 'rollup'):
+        raise ValueError(f"Unknown LOG_RETENTION_MODE: {mode}")
+
+    lock_file = try_file_lock(RETENTION_LOCK_FILE)
+    if lock_file is None:
+        print("⏭️ Log retention already running in another process - skipped")
+        return None
+    try:
+        return _apply_log_retention(retention_days, mode, batch_size, pause)
+    finally:
+        lock_file.close()
+
+def _apply_log_retention(retention_days, mode, batch_size, pause):
+    # created_at is stored as UTC 'YYYY-MM-DD HH:MM:SS' (CURRENT_TIMESTAMP)
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    started = time.perf_counter()
+    free_before = storage.log_retention.free_bytes()
+    report = {'mode': mode, 'cutoff': cutoff, 'rows_moved': {}, 'archive_months': set()}
+
+    for table in LogRetentionRepository.TABLES:
+        moved = 0
+        while True:
+            columns, rows = storage.log_retention.oldest_rows(table, cutoff, batch_size)
+            if not rows:
+                break
+
+            if mode == 'archive':
+                report['archive_months'].update(archive_log_rows(table, columns, rows))
+
+            moved += storage.log_retention.remove(table, [row[0] for row in rows], rollup=(mode == 'rollup'))
+            if len(rows) < batch_size:
+                break
+            time.sleep(pause)
+
+        report['rows_moved'][table] = moved
+
+    report['archive_months'] = sorted(report['archive_months'])
+    report['bytes_reclaimed'] = max(storage.log_retention.free_bytes() - free_before, 0)
+    report['duration_seconds'] = round(time.perf_counter() - started, 2)
+
+    print(f"🧹 Log retention ({mode}, older than {cutoff}): "
+          f"{report['rows_moved']} rows moved, {report['bytes_reclaimed']} bytes reclaimed "
+          f"in {report['duration_seconds']}s")
+    return report
+
+@app.route('/admin/log-retention')
+@require_admin_auth
+def admin_log_retention():
+    """Run the log retention job now"""
+    try:
+        report = apply_log_retention()
+        if report is None:
+            flash('Log retention is already running, try again later', 'warning')
+            return redirect(url_for('admin_analytics'))
+        total = sum(report['rows_moved'].values())
+        flash(f"Log retention: {total} rows moved ({report['mode']}), "
+              f"{report['bytes_reclaimed'] // 1024} KB reclaimed", 'success')
+        
+    except Exception as e:
+        print(f"❌ Log retention error: {e}")
+        flash('Error running log retention', 'error')
+    
+    return redirect(url_for('admin_analytics'))
+
 @app.route('/admin/analytics')
 @require_admin_auth
 def admin_analytics():
     """View website analytics and admin login logs"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database connection failed', 'error')
-            return redirect(url_for('admin_dashboard'))
-        
-        cursor = connection.cursor()
-        
-        # Initialize empty data in case queries fail
-        analytics_data = {
-            'visitor_stats': {
-                'unique_visitors': 0,
-                'total_page_views': 0,
-                'active_days': 0
-            },
-            'popular_pages': [],
-            'browser_stats': [],
-            'device_stats': [],
-            'recent_visitors': [],
-            'admin_logins': [],
-            'daily_stats': []
-        }
-        
-        try:
-            # Check if visitor_logs table exists
-            cursor.execute("""
-                SELECT name FROM sqlite_master 
-                WHERE type='table' AND name='visitor_logs'
-            """)
-            
-            if not cursor.fetchone():
-                print("⚠️ visitor_logs table doesn't exist, creating it...")
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS visitor_logs (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        ip_address TEXT,
-                        user_agent TEXT,
-                        page_visited TEXT,
-                        referrer TEXT,
-                        country TEXT,
-                        city TEXT,
-                        device_type TEXT,
-                        browser TEXT,
-                        os TEXT,
-                        session_id TEXT,
-                        visit_duration INTEGER DEFAULT 0,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-                connection.commit()
-            
-            # Check if admin_login_logs table exists
-            cursor.execute("""
-                SELECT name FROM sqlite_master 
-                WHERE type='table' AND name='admin_login_logs'
-            """)
-            
-            if not cursor.fetchone():
-                print("⚠️ admin_login_logs table doesn't exist, creating it...")
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS admin_login_logs (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT,
-                        ip_address TEXT,
-                        user_agent TEXT,
-                        login_successful BOOLEAN,
-                        failure_reason TEXT,
-                        country TEXT,
-                        city TEXT,
-                        browser TEXT,
-                        os TEXT,
-                        session_duration INTEGER,
-                        logout_time TIMESTAMP,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-                connection.commit()
-            
-            # Get visitor statistics
-            cursor.execute("""
-                SELECT 
-                    COUNT(DISTINCT session_id) as unique_visitors,
-                    COUNT(*) as total_page_views,
-                    COUNT(DISTINCT DATE(created_at)) as active_days
-                FROM visitor_logs 
-                WHERE created_at >= datetime('now', '-30 days')
-            """)
-            visitor_stats = cursor.fetchone()
-            
-            if visitor_stats:
-                analytics_data['visitor_stats'] = {
-                    'unique_visitors': visitor_stats[0] or 0,
-                    'total_page_views': visitor_stats[1] or 0,
-                    'active_days': visitor_stats[2] or 0
-                }
-            
-            # Get popular pages
-            cursor.execute("""
-                SELECT page_visited, COUNT(*) as visits
-                FROM visitor_logs 
-                WHERE created_at >= datetime('now', '-30 days')
-                GROUP BY page_visited
-                ORDER BY visits DESC
-                LIMIT 10
-            """)
-            analytics_data['popular_pages'] = cursor.fetchall()
-            
-            # Get browser statistics
-            cursor.execute("""
-                SELECT browser, COUNT(*) as count
-                FROM visitor_logs 
-                WHERE created_at >= datetime('now', '-30 days')
-                AND browser != 'unknown' AND browser IS NOT NULL AND browser != ''
-                GROUP BY browser
-                ORDER BY count DESC
-                LIMIT 10
-            """)
-            analytics_data['browser_stats'] = cursor.fetchall()
-            
-            # Get device statistics
-            cursor.execute("""
-                SELECT device_type, COUNT(*) as count
-                FROM visitor_logs 
-                WHERE created_at >= datetime('now', '-30 days')
-                AND device_type IS NOT NULL AND device_type != ''
-                GROUP BY device_type
-                ORDER BY count DESC
-            """)
-            analytics_data['device_stats'] = cursor.fetchall()
-            
-            # Get recent visitors
-            cursor.execute("""
-                SELECT ip_address, page_visited, browser, device_type, created_at
-                FROM visitor_logs 
-                ORDER BY created_at DESC
-                LIMIT 50
-            """)
-            analytics_data['recent_visitors'] = cursor.fetchall()
-            
-            # Get admin login attempts
-            cursor.execute("""
-                SELECT username, ip_address, login_successful, failure_reason, 
-                       browser, created_at
-                FROM admin_login_logs 
-                ORDER BY created_at DESC
-                LIMIT 100
-            """)
-            analytics_data['admin_logins'] = cursor.fetchall()
-            
-        except Exception as query_error:
-            print(f"⚠️ Query error in analytics: {query_error}")
-            # Keep default empty data
-        
-        cursor.close()
-        connection.close()
+        analytics_data = storage.analytics.summary(days=30)
         
         print(f"✅ Analytics data prepared: {len(analytics_data['recent_visitors'])} visitors, {len(analytics_data['admin_logins'])} admin logs")
         
@@ -2729,58 +5413,16 @@ def internal_error(error):
 # Debug routes
 @app.route('/debug/init-analytics-tables')
 def debug_init_analytics_tables():
-    """Create analytics tables if they don't exist"""
+    """Apply any pending schema migrations (analytics tables included)"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            return "❌ Database connection failed", 500
-        
-        cursor = connection.cursor()
-        
-        # Create visitor tracking table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS visitor_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ip_address TEXT,
-                user_agent TEXT,
-                page_visited TEXT,
-                referrer TEXT,
-                country TEXT,
-                city TEXT,
-                device_type TEXT,
-                browser TEXT,
-                os TEXT,
-                session_id TEXT,
-                visit_duration INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create admin login tracking table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admin_login_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT,
-                ip_address TEXT,
-                user_agent TEXT,
-                login_successful BOOLEAN,
-                failure_reason TEXT,
-                country TEXT,
-                city TEXT,
-                browser TEXT,
-                os TEXT,
-                session_duration INTEGER,
-                logout_time TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        with database.connection() as connection:
+            if not run_migrations(connection, database.dialect):
+                return "❌ Migration failed - see server log", 500
+            
+            version = get_schema_version(connection)
         
-        return """
-        <h1>✅ Analytics Tables Created Successfully!</h1>
+        return f"""
+        <h1>✅ Database schema up to date (version {version})</h1>
         <p><a href="/admin/analytics">Test Analytics Page</a></p>
         <p><a href="/admin/dashboard">Back to Dashboard</a></p>
         """
@@ -2792,29 +5434,11 @@ def debug_init_analytics_tables():
 def admin_add_overig_service():
     """Manually add Overig service if missing"""
     try:
-        connection = get_db_connection()
-        if connection is None:
-            flash('Database connection failed', 'error')
-            return redirect(url_for('admin_dashboard'))
-        
-        cursor = connection.cursor()
-        
-        # Check if "Overig" already exists
-        cursor.execute("SELECT COUNT(*) FROM services WHERE name = 'Overig'")
-        if cursor.fetchone()[0] > 0:
-            flash('"Overig" service already exists', 'info')
-        else:
-            # Add "Overig" service
-            cursor.execute("""
-                INSERT INTO services (name, description, price, duration_minutes, active) 
-                VALUES (?, ?, ?, ?, ?)
-            """, ("Overig", "Andere diensten en specifieke wensen", 0.0, 60, 1))
-            
-            connection.commit()
+        if storage.services.add_if_missing("Overig", "Andere diensten en specifieke wensen", 0.0, 60):
+            availability_cache.invalidate_all()
             flash('"Overig" service added successfully', 'success')
-        
-        cursor.close()
-        connection.close()
+        else:
+            flash('"Overig" service already exists', 'info')
         
         return redirect(url_for('admin_dashboard'))
         
@@ -2822,35 +5446,6 @@ def admin_add_overig_service():
         print(f"❌ Add Overig service error: {e}")
         flash('Error adding Overig service', 'error')
         return redirect(url_for('admin_dashboard'))
-def ensure_overig_service_exists():
-    """Ensure 'Overig' service exists in database"""
-    try:
-        connection = get_db_connection()
-        if connection is None:
-            return False
-        
-        cursor = connection.cursor()
-        
-        # Check if "Overig" service exists
-        cursor.execute("SELECT COUNT(*) FROM services WHERE name = 'Overig'")
-        if cursor.fetchone()[0] == 0:
-            print("🔧 Adding 'Overig' service to database...")
-            cursor.execute("""
-                INSERT INTO services (name, description, price, duration_minutes, active) 
-                VALUES (?, ?, ?, ?, ?)
-            """, ("Overig", "Andere diensten en specifieke wensen", 0.0, 60, 1))
-            
-            connection.commit()
-            print("✅ 'Overig' service added successfully")
-        
-        cursor.close()
-        connection.close()
-        return True
-        
-    except Exception as e:
-        print(f"❌ Error ensuring Overig service: {e}")
-        return False
-
 def test_all_godaddy_configs():
     """Test all possible GoDaddy SMTP configurations"""
     
@@ -2962,17 +5557,12 @@ if __name__ == "__main__":
     print(f"📋 Found database files: {db_files}")
     print("=" * 60)
     
-    # Consolidate and test database
-    consolidate_databases()
-    upgrade_database_schema()
-    ensure_overig_service_exists()
-    # Initialize APK system
-    print("🔧 Checking APK system...")
-    if not ensure_apk_tables_exist():
-        print("⚠️ APK tables missing, creating them...")
-        init_apk_database()
+    # Consolidate database files and apply schema migrations (booking, analytics and APK tables)
+    print("🔧 Running database migrations...")
+    if ensure_database_initialized():
+        print("✅ Database schema ready")
     else:
-        print("✅ APK system ready")
+        print("⚠️ Database migrations failed - see errors above")
 
     # Test email configuration
     if MAIL_USERNAME and MAIL_PASSWORD:
@@ -2994,6 +5584,9 @@ if __name__ == "__main__":
         # Start APK reminder checker in background
         start_daily_apk_check()
         
+        # Send anything still queued from before the restart
+        email_outbox.start()
+        
         if IS_AWS:
             print("🌐 Running on AWS")
             print("📊 Admin: /admin/dashboard")
@@ -3013,18 +5606,5 @@ if __name__ == "__main__":
         app.run(debug=not IS_AWS, host="0.0.0.0", port=port)
     else:
         print("❌ Database connection failed!")
-        print(f"🔍 Trying to create database at: {DB_FILE}")
-        if init_db():
-            print("✅ Database created successfully!")
-            print("🚀 Starting Flask application...")
-            
-            # Start APK reminder checker
-            start_daily_apk_check()
-            
-            port = int(os.environ.get('PORT', 5000))
-            app.run(debug=not IS_AWS, host="0.0.0.0", port=port)
-        else:
-            print("❌ Failed to create database!")
-            print("Please check your database configuration and permissions.")
-
-
+        print(f"🔍 Database path: {DB_FILE}")
+        print("Please check your database configuration and permissions.")
@@ -10,6 +10,22 @@ try:
 except Exception as e:
     print(f"❌ AWS database initialization failed: {e}")
 
+# Send mail still queued (or backing off) from before the restart without waiting for a new booking;
+# with gunicorn --preload every forked worker starts its own sender thread
+try:
+    from app import email_outbox
+    email_outbox.start()
+    os.register_at_fork(after_in_child=email_outbox.start)
+except Exception as e:
+    print(f"❌ Email outbox worker failed to start: {e}")
+
+# Reminders, database snapshots and log retention; only the first process to start takes the scheduler lock
+try:
+    from app import start_daily_apk_check
+    start_daily_apk_check()
+except Exception as e:
+    print(f"❌ Scheduler failed to start: {e}")
+
 application = app
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+"""Multi-process stress test for the atomic slot reservation in /api/book.
+
+Every worker process tries to book every slot in the same order, so each slot
+is fought over by all workers at once. Reports reservation throughput and
+verifies that no slot ended up with more than one active booking.
+
+Runs against a scratch SQLite file by default; pass --database-url to run the
+same check against a PostgreSQL server, where every worker acts like a
+separate app instance with its own connection pool.
+
+    python benchmarks/booking_stress.py [--workers 8] [--slots 200]
+    python benchmarks/booking_stress.py --database-url postgresql://localhost/koree_test
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py refuses to import without mail settings; the benchmark never sends mail
+for var in ('MAIL_USERNAME', 'MAIL_PASSWORD', 'ADMIN_EMAIL'):
+    os.environ.setdefault(var, 'benchmark@example.com')
+
+import app  # noqa: E402
+
+BENCH_DATE = '2030-01-07'
+
+
+def slot_times(count):
+    return [f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(count)]
+
+
+def open_database(target):
+    if target.startswith(('postgres://', 'postgresql://')):
+        return app.PostgresDatabase(target, size=1)
+    return app.SQLiteDatabase(app.SQLiteConnectionPool(target, size=1))
+
+
+def worker(target, worker_id, slots, start_event, results):
+    bookings = app.BookingRepository(open_database(target))
+    bookings.booked_slots(BENCH_DATE)  # open the connection before the start signal
+    won = lost = 0
+
+    start_event.wait()
+    started = time.perf_counter()
+    for slot in slots:
+        # One-minute bookings on a one-minute grid: neighbouring slots never overlap
+        booking_id = bookings.reserve(f"Worker {worker_id}", "stress@example.com",
+                                      "0612345678", "APK Keuring", BENCH_DATE, slot, "", 1)
+        if booking_id is None:
+            lost += 1
+        else:
+            won += 1
+    elapsed = time.perf_counter() - started
+
+    results.put((won, lost, elapsed))
+
+
+def clear_bench_date(database):
+    with database.connection() as connection:
+        connection.execute("DELETE FROM bookings WHERE date = ?", (BENCH_DATE,))
+        connection.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--slots', type=int, default=200)
+    parser.add_argument('--database-url', help="PostgreSQL URL (default: scratch SQLite file)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        target = args.database_url or os.path.join(tmp, 'booking_stress.db')
+        database = open_database(target)
+        if not database.initialize():
+            print("❌ Migrations failed")
+            return 1
+        clear_bench_date(database)
+
+        slots = slot_times(args.slots)
+        start_event = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=worker, args=(target, i, slots, start_event, results))
+                     for i in range(args.workers)]
+        for process in processes:
+            process.start()
+
+        time.sleep(0.5)  # let every worker open its connection
+        wall_started = time.perf_counter()
+        start_event.set()
+        outcomes = [results.get() for _ in processes]
+        wall = time.perf_counter() - wall_started
+        for process in processes:
+            process.join()
+
+        with database.connection() as connection:
+            double_booked = connection.execute("""
+                SELECT COUNT(*) FROM (
+                    SELECT date, time FROM bookings WHERE date = ? AND status != 'cancelled'
+                    GROUP BY date, time, resource_id HAVING COUNT(*) > 1
+                ) duplicates
+            """, (BENCH_DATE,)).fetchone()[0]
+            booked = connection.execute("SELECT COUNT(*) FROM bookings WHERE date = ?",
+                                        (BENCH_DATE,)).fetchone()[0]
+        clear_bench_date(database)
+
+    attempts = args.workers * args.slots
+    won = sum(outcome[0] for outcome in outcomes)
+    lost = sum(outcome[1] for outcome in outcomes)
+
+    print(f"👷 Workers: {args.workers}, slots: {args.slots}, attempts: {attempts}")
+    print(f"⏱️ Wall time: {wall:.3f}s ({attempts / wall:.0f} reservation attempts/s)")
+    print(f"✅ Won: {won}, ❌ rejected: {lost}, rows in bookings: {booked}")
+    print(f"{'✅' if double_booked == 0 else '❌'} Double-booked slots: {double_booked}")
+
+    return 0 if double_booked == 0 and won == args.slots == booked else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""Render cost of the precompiled email templates.
+
+Measures the one-off load (CSS inlining + Jinja compile) and the per-email
+render time of every template, then renders a reminder batch the way
+check_and_send_apk_reminders() does to show what rendering adds per recipient.
+
+    python benchmarks/email_render.py [--iterations 2000] [--batch 500]
+"""
+import argparse
+import os
+import sys
+import time
+import timeit
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py refuses to import without mail settings; the benchmark never sends mail
+for var in ('MAIL_USERNAME', 'MAIL_PASSWORD', 'ADMIN_EMAIL'):
+    os.environ.setdefault(var, 'benchmark@example.com')
+
+import app  # noqa: E402
+
+
+def booking_context(i):
+    return {
+        'booking_id': i, 'name': f"Klant {i}", 'email': f"klant{i}@example.com", 'phone': '0612345678',
+        'service': 'Overig', 'date': '2030-01-07', 'time': '10:30', 'message': 'Rammelt bij <80 km/u>',
+        'calendar': app.generate_calendar_event_data(f"Klant {i}", 'Overig', '2030-01-07', '10:30', '', i)
+    }
+
+
+def reminder_context(i):
+    return {
+        'name': f"Klant {i}", 'licence_plate': f"AB-{i:03d}-C", 'car_brand': 'Volkswagen', 'car_model': None,
+        'apk_expiry_date': (date.today() + timedelta(days=30)).isoformat(), 'days_until_expiry': 30
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=500)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    templates = app.EmailTemplates()
+    print(f"Load + compile: {(time.perf_counter() - started) * 1000:.1f} ms for {len(templates.templates)} templates")
+
+    contexts = {'booking_customer': booking_context(1), 'booking_admin': booking_context(1),
+                'apk_reminder': reminder_context(1)}
+    print(f"{'template':<20} {'html bytes':>10} {'text bytes':>10} {'render us':>10}")
+    for name, context in contexts.items():
+        html, text = templates.render(name, **context)
+        seconds = min(timeit.repeat(lambda: templates.render(name, **context), number=args.iterations, repeat=3))
+        print(f"{name:<20} {len(html):>10} {len(text or ''):>10} {seconds / args.iterations * 1e6:>10.1f}")
+
+    batch = [reminder_context(i) for i in range(args.batch)]
+    started = time.perf_counter()
+    for context in batch:
+        templates.render('apk_reminder', **context)
+    elapsed = time.perf_counter() - started
+    print(f"Reminder batch: {args.batch} emails rendered in {elapsed * 1000:.1f} ms "
+          f"({elapsed / args.batch * 1e6:.1f} us per email)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
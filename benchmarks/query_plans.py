@@ -0,0 +1,116 @@
+"""EXPLAIN QUERY PLAN check for the hot queries on a seeded large database.
+
+Seeds a throwaway SQLite file with realistic volumes, applies the app's
+migrations and fails (exit code 1) if any query in app.HOT_QUERIES
+regresses to a full table scan.
+
+    python benchmarks/query_plans.py [--bookings 200000] [--visits 500000]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py refuses to import without mail settings; the check never sends mail
+for var in ('MAIL_USERNAME', 'MAIL_PASSWORD', 'ADMIN_EMAIL'):
+    os.environ.setdefault(var, 'benchmark@example.com')
+
+import app  # noqa: E402
+
+
+def seed(connection, bookings, visits, apk_clients):
+    today = date.today()
+    slots = [f"{h:02d}:{m:02d}" for h in range(8, 17) for m in (0, 30)]
+
+    def booking_rows():
+        # Fill every slot backwards from three months ahead (one active booking per slot)
+        for i in range(bookings):
+            day = today + timedelta(days=90 - i // len(slots))
+            status = 'cancelled' if i % 10 == 0 else 'confirmed'
+            yield (f"Klant {i}", f"klant{i}@example.com", "0612345678", "APK Keuring",
+                   day.isoformat(), slots[i % len(slots)], None, status)
+
+    connection.executemany("""
+        INSERT INTO bookings (name, email, phone, service, date, time, message, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, booking_rows())
+
+    now = datetime.utcnow()
+
+    def visit_rows():
+        for i in range(visits):
+            seen = now - timedelta(minutes=random.randint(0, 60 * 24 * 365))
+            yield (f"10.0.{i % 250}.{i % 200}", "Mozilla/5.0", random.choice(['Homepage', 'Admin Login Page']),
+                   'direct', 'Desktop', 'Chrome 120', f"session-{i // 4}",
+                   seen.strftime('%Y-%m-%d %H:%M:%S'))
+
+    connection.executemany("""
+        INSERT INTO visitor_logs (ip_address, user_agent, page_visited, referrer,
+                                  device_type, browser, session_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, visit_rows())
+
+    connection.executemany("""
+        INSERT INTO admin_login_logs (username, ip_address, login_successful, created_at)
+        VALUES (?, ?, ?, ?)
+    """, ((f"user{i}", "10.0.0.1", i % 3 == 0,
+           (now - timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S')) for i in range(visits // 10)))
+
+    def apk_client_rows():
+        for i in range(apk_clients):
+            expiry = today + timedelta(days=random.randint(-365, 365))
+            yield (f"Klant {i}", f"apk{i}@example.com", f"AB-{i:06d}", expiry.isoformat(), int(i % 20 != 0),
+                   *app.apk_reminder_schedule(expiry))
+
+    connection.executemany("""
+        INSERT INTO apk_clients (name, email, licence_plate, apk_expiry_date, is_active, next_reminder_due, next_reminder_stage)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, apk_client_rows())
+
+    connection.executemany("""
+        INSERT INTO apk_reminder_log (client_id, email_subject, days_until_expiry, email_sent)
+        VALUES (?, ?, ?, ?)
+    """, ((random.randint(1, apk_clients), "APK Reminder", 30, 1) for _ in range(apk_clients * 2)))
+
+    connection.commit()
+    connection.execute("ANALYZE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bookings', type=int, default=200000)
+    parser.add_argument('--visits', type=int, default=500000)
+    parser.add_argument('--apk-clients', type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        connection = sqlite3.connect(os.path.join(tmp, 'query_plans.db'))
+        if not app.run_migrations(connection):
+            print("❌ Migrations failed")
+            return 1
+
+        print(f"🌱 Seeding {args.bookings} bookings, {args.visits} visits, {args.apk_clients} APK clients...")
+        seed(connection, args.bookings, args.visits, args.apk_clients)
+
+        failures = 0
+        for name, plan, ok in app.check_query_plans(connection):
+            print(f"{'✅' if ok else '❌'} {name}")
+            for step in plan:
+                print(f"     {step}")
+            failures += not ok
+        connection.close()
+
+    if failures:
+        print(f"❌ {failures} hot queries fall back to a full table scan")
+        return 1
+    print("✅ All hot queries use an index")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())